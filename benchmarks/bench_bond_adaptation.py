@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Bond dimensions adapted by bond_tolerance in fit and fit_dmrg of the Born
+machines, number of parameters within these bond dimensions, and final
+negative log-likelihood, on the bundled datasets.
+
+The adaptation only changes the bond pattern, not the cost of training: the
+parameters keep the layout of width D, padded with zeros beyond the bond
+dimensions, so that m_parameters, the memory and the contractions are those
+of bond dimension D. The free parameters are counted by
+_numberofparameters(padding=False), no time is reported.
+
+    python benchmarks/bench_bond_adaptation.py [D] [n_iter] [bond_tolerances] [datasets]
+
+bond_tolerances is a comma separated list of tolerances, none for no
+adaptation. datasets is a comma separated list of names in datasets/, or all.
+"""
+
+import os
+import sys
+import pickle
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tensornetworks.RealBorn import RealBorn
+from tensornetworks.ComplexBorn import ComplexBorn
+
+path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'datasets')
+
+def init(D_init='8', n_iter_init='10', bond_tolerances_init='none,1e-3,1e-2',
+         datasets_init='lymphography'):
+    """Initialize parameters :
+        ----------
+        D : int, bond dimension
+        n_iter : int, number of iterations over the training dataset
+        bond_tolerances : str, comma separated tolerances, none for no adaptation
+        datasets : str, comma separated names of the datasets, or all
+    """
+    global D, n_iter, bond_tolerances, datasets
+    D = int(D_init)
+    n_iter = int(n_iter_init)
+    bond_tolerances = [None if tolerance == 'none' else float(tolerance)
+                       for tolerance in bond_tolerances_init.split(',')]
+    if datasets_init == 'all':
+        datasets = sorted(os.listdir(path))
+    else:
+        datasets = datasets_init.split(',')
+
+def load(name):
+    with open(os.path.join(path, name), 'rb') as f:
+        a = pickle.load(f, encoding='latin1')
+    return np.asarray(a[0]).astype(int)
+
+def fit(cls, X, method, bond_tolerance):
+    if method == 'fit':
+        model = cls(D=D, learning_rate=0.05, batch_size=20, n_iter=n_iter,
+                    random_state=0, bond_tolerance=bond_tolerance).fit(X)
+    else:
+        model = cls(D=D, learning_rate=0.01, n_iter=n_iter,
+                    random_state=0, bond_tolerance=bond_tolerance).fit_dmrg(X)
+    return model
+
+def run():
+    print("D=%d, n_iter=%d, bond pattern only: no speedup, the parameters "
+          "keep the layout of width D" % (D, n_iter))
+    print("%-14s %-12s %-6s %9s %12s %8s %10s  %s"
+          % ("dataset", "model", "method", "tolerance", "m_parameters", "free",
+             "NLL", "bond dimensions"))
+    for name in datasets:
+        X = load(name)
+        for cls in [RealBorn, ComplexBorn]:
+            for method in ['fit', 'dmrg']:
+                for bond_tolerance in bond_tolerances:
+                    model = fit(cls, X, method, bond_tolerance)
+                    print("%-14s %-12s %-6s %9s %12d %8d %10.4f  %s"
+                          % (name, cls.__name__, method, bond_tolerance,
+                             model.m_parameters, model._numberofparameters(padding=False),
+                             model.likelihood(X),
+                             ','.join(str(k) for k in model.bond_dimensions)))
+
+if __name__ == '__main__':
+    # Main program : initialize with options from command line and run
+    init(*sys.argv[1::])
+    run()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Training throughput of the models in single precision (dtype=np.float32)
+against double precision, and difference of the final negative log-likelihood,
+on the bundled datasets. Both fits start from the same parameters and draw the
+same mini-batches.
+
+    python benchmarks/bench_float32.py [D] [n_iter] [batch_size] [datasets]
+
+datasets is a comma separated list of names in datasets/, or all.
+"""
+
+import os
+import sys
+import time
+import pickle
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tensornetworks.PositiveMPS import PositiveMPS
+from tensornetworks.RealBorn import RealBorn
+from tensornetworks.ComplexBorn import ComplexBorn
+from tensornetworks.RealLPS import RealLPS
+from tensornetworks.ComplexLPS import ComplexLPS
+
+path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'datasets')
+
+def init(D_init='8', n_iter_init='10', batch_size_init='20', datasets_init='all'):
+    """Initialize parameters :
+        ----------
+        D : int, bond dimension
+        n_iter : int, number of iterations over the training dataset
+        batch_size : int, number of examples per minibatch
+        datasets : str, comma separated names of the datasets, or all
+    """
+    global D, n_iter, batch_size, datasets
+    D = int(D_init)
+    n_iter = int(n_iter_init)
+    batch_size = int(batch_size_init)
+    if datasets_init == 'all':
+        datasets = sorted(os.listdir(path))
+    else:
+        datasets = datasets_init.split(',')
+
+def load(name):
+    with open(os.path.join(path, name), 'rb') as f:
+        a = pickle.load(f, encoding='latin1')
+    return np.asarray(a[0]).astype(int)
+
+def fit(cls, X, dtype):
+    model = cls(D=D, learning_rate=0.05, batch_size=batch_size, n_iter=n_iter,
+                random_state=0, dtype=dtype)
+    begin = time.time()
+    model.fit(X)
+    elapsed = time.time()-begin
+    return n_iter*X.shape[0]/elapsed, model.likelihood(X)
+
+def run():
+    print("D=%d, n_iter=%d, batch_size=%d, throughput in samples per second"
+          % (D, n_iter, batch_size))
+    print("%-14s %-12s %10s %10s %8s %10s %10s %10s"
+          % ("dataset", "model", "float64", "float32", "speedup",
+             "NLL64", "NLL32", "NLL32-64"))
+    for name in datasets:
+        X = load(name)
+        for cls in [PositiveMPS, RealBorn, ComplexBorn, RealLPS, ComplexLPS]:
+            throughput64, likelihood64 = fit(cls, X, np.float64)
+            throughput32, likelihood32 = fit(cls, X, np.float32)
+            print("%-14s %-12s %10.0f %10.0f %8.2f %10.4f %10.4f %10.2e"
+                  % (name, cls.__name__, throughput64, throughput32,
+                     throughput32/throughput64, likelihood64, likelihood32,
+                     likelihood32-likelihood64))
+
+if __name__ == '__main__':
+    # Main program : initialize with options from command line and run
+    init(*sys.argv[1::])
+    run()
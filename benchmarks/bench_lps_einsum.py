@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Per-call time of the einsum contractions of the LPS models, with
+np.einsum unoptimized, re-planned at every call, or with the contraction
+paths cached by TN._einsum.
+
+    python benchmarks/bench_lps_einsum.py [D] [mu] [d] [n_features] [number]
+"""
+
+import os
+import sys
+import timeit
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tensornetworks.MPSClass import TN
+from tensornetworks.RealLPS import RealLPS
+from tensornetworks.ComplexLPS import ComplexLPS
+
+cached_einsum = TN._einsum
+
+def plain_einsum(self, subscripts, *operands):
+    return np.einsum(subscripts, *operands)
+
+def replanned_einsum(self, subscripts, *operands):
+    return np.einsum(subscripts, *operands, optimize='optimal')
+
+def init(D_init='8', mu_init='2', d_init='4', n_features_init='10', number_init='200'):
+    """Initialize parameters :
+        ----------
+        D : int, bond dimension
+        mu : int, dimension of the purification link
+        d : int, physical dimension
+        n_features : int, number of sites
+        number : int, number of calls timed per method
+    """
+    global D, mu, d, n_features, number
+    D = int(D_init)
+    mu = int(mu_init)
+    d = int(d_init)
+    n_features = int(n_features_init)
+    number = int(number_init)
+
+def make(cls):
+    model = cls(D=D, mu=mu, random_state=0)
+    model._setdimensions(n_features, d)
+    model._weightinitialization(np.random.RandomState(0))
+    model.norm = model._computenorm()
+    return model
+
+def run():
+    x = np.random.RandomState(1).randint(d, size=n_features)
+    print("D=%d, mu=%d, d=%d, n_features=%d, time per call in ms" % (D, mu, d, n_features))
+    print("%-40s %10s %10s %10s" % ("", "plain", "replanned", "cached"))
+    for cls in [RealLPS, ComplexLPS]:
+        model = make(cls)
+        calls = [('_probability', lambda: model._probability(x)),
+                 ('_derivative', lambda: model._derivative(x)),
+                 ('_computenorm', model._computeleftenvironments),
+                 ('_derivativenorm', model._derivativenorm)]
+        for name, call in calls:
+            times = []
+            for einsum in [plain_einsum, replanned_einsum, cached_einsum]:
+                TN._einsum = einsum
+                call() #warm up, and fill the cache of paths
+                times.append(1000*timeit.timeit(call, number=number)/number)
+            TN._einsum = cached_einsum
+            print("%-40s %10.3f %10.3f %10.3f" % (cls.__name__+'.'+name, *times))
+
+if __name__ == '__main__':
+    # Main program : initialize with options from command line and run
+    init(*sys.argv[1::])
+    run()
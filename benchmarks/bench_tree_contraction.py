@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Time of the forward and backward pass of the batched contraction of the
+torch models, site by site (sequential) or by pairwise products of the site
+matrices in a balanced tree (tree_contraction=True), largest relative
+difference of the log probabilities, and number of log probabilities not
+finite with the sequential contraction, on random data.
+
+    python benchmarks/bench_tree_contraction.py [D] [d] [seqlens] [batch_size] [number]
+
+seqlens is a comma separated list of sequence lengths.
+"""
+
+import os
+import sys
+import timeit
+import torch
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tensornetworks_pytorch.TNModels import PosMPS, Born
+
+def init(D_init='8', d_init='4', seqlens_init='16,128,1024', batch_size_init='64',
+         number_init='10'):
+    """Initialize parameters :
+        ----------
+        D : int, bond dimension
+        d : int, physical dimension
+        seqlens : str, comma separated sequence lengths
+        batch_size : int, number of examples per batch
+        number : int, number of calls timed per method
+    """
+    global D, d, seqlens, batch_size, number
+    D = int(D_init)
+    d = int(d_init)
+    seqlens = [int(seqlen) for seqlen in seqlens_init.split(',')]
+    batch_size = int(batch_size_init)
+    number = int(number_init)
+
+def models(X):
+    yield 'PosMPS', lambda **kwargs: PosMPS(
+        X, d, D, w_randomization='noisy', **kwargs)
+    yield 'rBorn', lambda **kwargs: Born(
+        X, d, D, dtype=torch.float, w_randomization='gaussian_zeros', **kwargs)
+    yield 'cBorn', lambda **kwargs: Born(
+        X, d, D, dtype=torch.cfloat, w_randomization='gaussian_zeros', **kwargs)
+
+def contract(model, X):
+    logprobs = model._log_contract_at_batch(X)
+    logprobs.sum().backward()
+    return logprobs.detach()
+
+def run():
+    print("D=%d, d=%d, batch_size=%d, forward and backward, ms per call"
+          % (D, d, batch_size))
+    print("%-8s %8s %12s %12s %8s %10s %10s"
+          % ("model", "seqlen", "sequential", "tree", "speedup", "rel diff",
+             "nonfinite"))
+    for seqlen in seqlens:
+        torch.manual_seed(0)
+        X = torch.randint(0, d, (batch_size, seqlen))
+        for name, make in models(X):
+            torch.manual_seed(0)
+            sequential = make()
+            torch.manual_seed(0)
+            tree = make(tree_contraction=True)
+            logprobs_sequential = contract(sequential, X)
+            logprobs_tree = contract(tree, X)
+            finite = logprobs_sequential.isfinite()
+            if finite.any():
+                diff = ((logprobs_tree - logprobs_sequential)
+                        / logprobs_sequential)[finite].abs().max().item()
+            else:
+                diff = float('nan')
+            time_sequential = timeit.timeit(
+                lambda: contract(sequential, X), number=number)/number
+            time_tree = timeit.timeit(
+                lambda: contract(tree, X), number=number)/number
+            print("%-8s %8d %12.2f %12.2f %8.2f %10.2e %10d"
+                  % (name, seqlen, 1e3*time_sequential, 1e3*time_tree,
+                     time_sequential/time_tree, diff, (~finite).sum().item()))
+
+if __name__ == '__main__':
+    # Main program : initialize with options from command line and run
+    init(*sys.argv[1::])
+    run()
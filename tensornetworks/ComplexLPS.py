@@ -27,6 +27,17 @@ class ComplexLPS(TN):
         The verbosity level. The default, zero, means silent mode.
     mu : int, optional
         Dimension of the purification link
+    prefix_trie : bool, optional
+        If True, batches are contracted over their prefix trie: each distinct
+        prefix of the configurations is contracted once.
+    homogeneous : bool, optional
+        If True, all the sites between the first and the last share the same
+        tensor (translation invariant network).
+    dtype : numpy dtype, optional
+        Precision of the parameters and of all the contractions, np.float64
+        for complex128 parameters or np.float32 for complex64 parameters.
+        In single precision, fit keeps the tensor of each site rescaled so
+        that the contractions of the norm are of order one.
     ----------
     Attributes
     ----------
@@ -42,11 +53,15 @@ class ComplexLPS(TN):
         physical dimension (dimension of the features)
     m_parameters : int
         number of parameters in the network
+    log_scales : numpy array, shape (n_features,) or None
+        In single precision, logarithm of the factor removed from the tensor
+        of each site by the rescaling of fit, None otherwise
     history : list
         saves the training accuracies during training
     """
     def __init__(self, D=4, learning_rate=0.1, batch_size=10,
-                 n_iter=100, random_state=None, verbose=False, mu=2):
+                 n_iter=100, random_state=None, verbose=False, mu=2,
+                 prefix_trie=False, homogeneous=False, dtype=np.float64):
         self.D = D
         self.learning_rate = float(learning_rate)
         self.batch_size = batch_size
@@ -54,6 +69,9 @@ class ComplexLPS(TN):
         self.random_state = random_state
         self.verbose = verbose
         self.mu = mu
+        self.prefix_trie = prefix_trie
+        self.homogeneous = homogeneous
+        self.dtype = dtype
         
     def _probability(self, x):
         """Unnormalized probability of one configuration P(x)
@@ -65,20 +83,65 @@ class ComplexLPS(TN):
         -------
         probability : float
         """
-        w2 = np.reshape(self.w,(self.n_features,self.d,self.D,self.D,self.mu))
+        x, valid = self._sitevalues(x)
+        w2 = self._cores(self.w)
       
-        tmp = w2[0,x[0],0,:,:]
-        tmp2 = np.einsum('ij,kj->ik',tmp,np.conjugate(tmp)).reshape(self.D*self.D)
+        tmp = w2[0][x[0],0,:,:]
+        tmp2 = self._einsum('ij,kj->ik',tmp,np.conjugate(tmp))
         for i in xrange(1,self.n_features-1):
-            tmp = np.einsum('imj,klj->ikml',w2[i,x[i],:,:,:],
-                            np.conjugate(w2[i,x[i],:,:,:])).reshape((self.D*self.D,self.D*self.D))
-            tmp2 = np.dot(tmp2,tmp)
+            #Environment matrix times core, then times conjugate core, in O(D^3mu)
+            tmp = np.tensordot(tmp2,w2[i][x[i],:,:,:],axes=([0],[0]))
+            tmp2 = np.tensordot(tmp,np.conjugate(w2[i][x[i],:,:,:]),axes=([0,2],[0,2]))
 
-        tmp = np.einsum('ij,kj->ik',w2[self.n_features-1,x[self.n_features-1],:,0,:],
-                        np.conjugate(w2[self.n_features-1,
+        tmp = self._einsum('ij,kj->ik',w2[self.n_features-1][x[self.n_features-1],:,0,:],
+                        np.conjugate(w2[self.n_features-1][
                         x[self.n_features-1],:,0,:])).reshape(self.D*self.D)
-        probability = np.abs(np.inner(tmp2,tmp))
-        return probability
+        probability = np.abs(np.inner(tmp2.reshape(self.D*self.D),tmp))
+        return probability*valid
+
+    def _probability_batch(self, X):
+        """Unnormalized probabilities of a batch of configurations P(x)
+        Parameters
+        ----------
+        X : numpy array, shape (n_samples, n_features)
+            Configurations
+        Returns
+        -------
+        probability : numpy array, shape (n_samples,)
+        """
+        X, valid = self._sitevalues(X)
+        w2 = self._cores(self.w)
+        n_samples = X.shape[0]
+
+        #tmp2[b,:,:] is the left environment of sample b, with the bond index
+        #of the tensor first and the bond index of its conjugate second
+        if self.prefix_trie:
+            #Contract each distinct prefix once, one environment per node of the trie
+            parents, symbols, nodes = self._prefixtrie(X)
+            tmp = w2[0][symbols[0],0,:,:]
+            tmp2 = np.matmul(tmp,np.conjugate(tmp).transpose((0,2,1)))
+            for i in xrange(1,self.n_features-1):
+                n_nodes = len(symbols[i])
+                tmp = w2[i][symbols[i],:,:,:]
+                tmp3 = np.matmul(tmp2[parents[i]].transpose((0,2,1)),tmp.reshape(n_nodes,self.D,self.D*self.mu))
+                tmp3 = tmp3.reshape(n_nodes,self.D,self.D,self.mu).transpose((0,2,1,3))
+                tmp2 = np.matmul(tmp3.reshape(n_nodes,self.D,self.D*self.mu),
+                                 np.conjugate(tmp).transpose((0,1,3,2)).reshape(n_nodes,self.D*self.mu,self.D))
+            tmp2 = tmp2[nodes[self.n_features-2]]
+        else:
+            tmp = w2[0][X[:,0],0,:,:]
+            tmp2 = np.matmul(tmp,np.conjugate(tmp).transpose((0,2,1)))
+            for i in xrange(1,self.n_features-1):
+                tmp = w2[i][X[:,i],:,:,:]
+                tmp3 = np.matmul(tmp2.transpose((0,2,1)),tmp.reshape(n_samples,self.D,self.D*self.mu))
+                tmp3 = tmp3.reshape(n_samples,self.D,self.D,self.mu).transpose((0,2,1,3))
+                tmp2 = np.matmul(tmp3.reshape(n_samples,self.D,self.D*self.mu),
+                                 np.conjugate(tmp).transpose((0,1,3,2)).reshape(n_samples,self.D*self.mu,self.D))
+
+        tmp = w2[self.n_features-1][X[:,self.n_features-1],:,0,:]
+        tmp = np.matmul(tmp,np.conjugate(tmp).transpose((0,2,1)))
+        probability = np.abs(np.sum(tmp2*tmp,(1,2)))
+        return probability*valid
        
     def _computenorm(self):
         """Compute norm of probability distribution
@@ -86,18 +149,138 @@ class ComplexLPS(TN):
         -------
         norm : float
         """
-        w2 = np.reshape(self.w,(self.n_features,self.d,self.D,self.D,self.mu))
+        if self._squaringcheaper(self.D*self.D,2*self.d*self.D**3*self.mu):
+            w2 = self._cores(self.w)
+            left = self._einsum('ijk,ilk->jl',w2[0][:,0,:,:],
+                        np.conj(w2[0][:,0,:,:])).reshape(self.D*self.D)
+            transfer = self._einsum('ijkl,imnl->jmkn',w2[1],
+                        np.conj(w2[1])).reshape(self.D*self.D,self.D*self.D)
+            right = self._einsum('ijk,ilk->jl',w2[self.n_features-1][:,:,0,:],
+                        np.conj(w2[self.n_features-1][:,:,0,:])).reshape(self.D*self.D)
+            return np.exp(self._lognormsquaring(left,transfer,right))
+        tmp = self._leftenvironments()
+        norm = np.abs(tmp[self.n_features-1,0])
+        return norm
 
-        tmp2 = np.einsum('ijk,ilk->jl',w2[0,:,0,:,:],
-                         np.conj(w2[0,:,0,:,:])).reshape(self.D*self.D)
+    def _computeleftenvironments(self):
+        """Compute the contractions of the norm from the left boundary
+        Returns
+        -------
+        tmp : numpy array, shape (n_features, D*D)
+        """
+        w2=self._cores(self.w)
+        tmp=np.zeros((self.n_features,self.D*self.D),dtype=self.w.dtype)
+        tmp[0,:] = self._einsum('ijk,ilk->jl',w2[0][:,0,:,:],np.conj(w2[0][:,0,:,:])).reshape(self.D*self.D)
         for i in xrange(1,self.n_features-1):
-            tmp = np.einsum('pimj,pklj->ikml',w2[i,:,:,:,:],
-                            np.conjugate(w2[i,:,:,:,:])).reshape((self.D*self.D,self.D*self.D))
-            tmp2 = np.dot(tmp2,tmp)
-        tmp = np.einsum('ijk,ilk->jl',w2[self.n_features-1,:,:,0,:],
-                        np.conjugate(w2[self.n_features-1,:,:,0,:])).reshape(self.D*self.D)
-        norm = np.abs(np.inner(tmp2,tmp))
-        return norm
+            #Environment matrix times core, then times conjugate core, in O(dD^3mu)
+            newtmp = np.tensordot(tmp[i-1,:].reshape(self.D,self.D),w2[i],axes=([0],[1]))
+            tmp[i,:] = np.tensordot(newtmp,np.conjugate(w2[i]),
+                                    axes=([0,1,3],[1,0,3])).reshape(self.D*self.D)
+        newtmp = self._einsum('ijk,ilk->jl',w2[self.n_features-1][:,:,0,:],
+                    np.conjugate(w2[self.n_features-1][:,:,0,:])).reshape(self.D*self.D)
+        tmp[self.n_features-1,:]=np.inner(tmp[self.n_features-2,:],newtmp)
+        return tmp
+
+    def _computerightenvironments(self):
+        """Compute the contractions of the norm from the right boundary
+        Returns
+        -------
+        tmp2 : numpy array, shape (n_features, D*D)
+        """
+        w2=self._cores(self.w)
+        tmp2=np.zeros((self.n_features,self.D*self.D),dtype=self.w.dtype)
+        tmp2[self.n_features-1,:] = self._einsum('ijk,ilk->jl',w2[self.n_features-1][:,:,0,:],
+                    np.conjugate(w2[self.n_features-1][:,:,0,:])).reshape(self.D*self.D)
+        for i in xrange(self.n_features-2,0,-1):
+            #Core times environment matrix, then times conjugate core, in O(dD^3mu)
+            newtmp = np.tensordot(w2[i],tmp2[i+1,:].reshape(self.D,self.D),axes=([2],[0]))
+            tmp2[i,:] = np.tensordot(newtmp,np.conjugate(w2[i]),
+                                     axes=([0,2,3],[0,3,2])).reshape(self.D*self.D)
+        newtmp=self._einsum('ijk,ilk->jl',w2[0][:,0,:,:],
+                         np.conj(w2[0][:,0,:,:])).reshape(self.D*self.D)
+        tmp2[0,:]=np.inner(newtmp,tmp2[1,:])
+        return tmp2
+
+    def _conditionalprobability(self, left, i, tmp2):
+        """Unnormalized probabilities of the values of x[i] given x[:i], for sampling
+        Parameters
+        ----------
+        left : numpy array, shape (n_samples, D, D) or None if i=0
+            Contraction of the tensors before site i at x[:i] with their
+            conjugates, up to a factor
+        i : int
+            Site
+        tmp2 : numpy array, shape (n_features, D*D)
+            Right environments of the norm
+        Returns
+        -------
+        probability : numpy array, shape (n_samples, d) or (1, d) if i=0
+        """
+        w2 = self._cores(self.w)
+        core = w2[i]
+        if i == self.n_features-1:
+            core = core[:,:,0:1,:]
+            right = np.ones((1,1),dtype=self.w.dtype)
+        else:
+            right = tmp2[i+1].reshape(self.D,self.D)
+        #weights[j] = sum_m w[j,:,:,m] right w[j,:,:,m]^H
+        weights = self._einsum('ijkl,km,inml->ijn',core,right,np.conj(core))
+        if left is None:
+            return np.abs(weights[None,:,0,0])
+        return np.abs(np.dot(left.reshape(-1,self.D*self.D),
+                             weights.reshape(len(core),self.D*self.D).T))
+
+    def _maskedtransfer(self, left, i, mask):
+        """Contraction of the left contraction of the norm with the tensor of site i
+        and its conjugate, summed over the allowed values of site i only
+        Parameters
+        ----------
+        left : numpy array, shape (n_queries, D*D) or None if i=0
+            Contraction of the norm before site i for each evidence pattern
+        i : int
+            Site
+        mask : numpy array of bool, shape (n_queries, d)
+            Allowed values of site i for each evidence pattern
+        Returns
+        -------
+        left : numpy array, shape (n_queries, D*D)
+        """
+        w2 = self._cores(self.w)
+        n_queries = mask.shape[0]
+        if left is None:
+            core = w2[0][:,0,:,:]
+            return np.dot(mask,self._einsum('ijk,ilk->ijl',core,np.conj(core)).reshape(len(core),-1))
+        left = left.reshape(n_queries,self.D,self.D)
+        newleft = 0
+        for j in xrange(len(w2[i])):
+            tmp = np.tensordot(left,w2[i][j],axes=([1],[0]))
+            newleft = newleft+mask[:,j,None,None]*np.tensordot(tmp,np.conj(w2[i][j]),axes=([1,3],[0,2]))
+        return newleft.reshape(n_queries,-1)
+
+    def _leftstate(self, left, i, x):
+        """Contraction of the tensors up to site i at x[:i+1] with their
+        conjugates, for sampling
+        Parameters
+        ----------
+        left : numpy array, shape (n_samples, D, D) or None if i=0
+            Contraction of the tensors before site i at x[:i]
+        i : int
+            Site
+        x : numpy array, shape (n_samples,)
+            Values of x[i]
+        Returns
+        -------
+        left : numpy array, shape (n_samples, D, D)
+        """
+        w2 = self._cores(self.w)
+        if left is None:
+            return self._einsum('ijk,ilk->ijl',w2[0][x,0,:,:],np.conj(w2[0][x,0,:,:]))
+        newleft = np.zeros(left.shape,dtype=self.w.dtype)
+        for j in xrange(len(w2[i])):
+            mask = (x==j)
+            tmp = np.tensordot(left[mask],w2[i][j],axes=([1],[0]))
+            newleft[mask] = np.tensordot(tmp,np.conj(w2[i][j]),axes=([1,3],[0,2]))
+        return newleft
 
     def _derivative(self, x):
         """Compute the derivative of P(x)
@@ -109,51 +292,126 @@ class ComplexLPS(TN):
         -------
         derivative : numpy array, shape (m_parameters,)
         """
-        w2=np.reshape(self.w,(self.n_features,self.d,self.D,self.D,self.mu))
-        derivative=np.zeros((self.n_features,self.d,self.D,self.D,self.mu),
-                            dtype=np.complex128)
+        w2=self._cores(self.w)
+        derivative=np.zeros(self.m_parameters,dtype=self.w.dtype)
+        dw2=self._cores(derivative)
         
         #Store intermediate tensor contractions for the derivatives: 
         #left to right and right to left
         #tmp stores the contraction of the first i+1 tensors from the left 
         #in tmp[i,:,:], tmp2 the remaining tensors on the right
         #the mps contracted is the remaining contraction tmp[i-1]w[i]tmp2[i+1]
-        tmp=np.zeros((self.n_features,self.D*self.D),dtype=np.complex128)
-        tmp2=np.zeros((self.n_features,self.D*self.D),dtype=np.complex128)
-        tmp[0,:] = np.einsum('ij,kj->ik',w2[0,x[0],0,:,:],
-                    np.conjugate(w2[0,x[0],0,:,:])).reshape(self.D*self.D)
+        tmp=np.zeros((self.n_features,self.D*self.D),dtype=self.w.dtype)
+        tmp2=np.zeros((self.n_features,self.D*self.D),dtype=self.w.dtype)
+        tmp[0,:] = self._einsum('ij,kj->ik',w2[0][x[0],0,:,:],
+                    np.conjugate(w2[0][x[0],0,:,:])).reshape(self.D*self.D)
         for i in xrange(1,self.n_features-1):
-            newtmp = np.einsum('imj,klj->ikml',w2[i,x[i],:,:,:],
-                        np.conjugate(w2[i,x[i],:,:,:])).reshape((self.D*self.D,self.D*self.D))
-            tmp[i,:]=np.dot(tmp[i-1,:],newtmp)  
-        newtmp = np.einsum('ij,kj->ik',w2[self.n_features-1,x[self.n_features-1],:,0,:],
-                    np.conjugate(w2[self.n_features-1,x[self.n_features-1],:,0,:])).reshape(self.D*self.D)
+            newtmp = np.tensordot(tmp[i-1,:].reshape(self.D,self.D),w2[i][x[i],:,:,:],axes=([0],[0]))
+            tmp[i,:] = np.tensordot(newtmp,np.conjugate(w2[i][x[i],:,:,:]),
+                                    axes=([0,2],[0,2])).reshape(self.D*self.D)
+        newtmp = self._einsum('ij,kj->ik',w2[self.n_features-1][x[self.n_features-1],:,0,:],
+                    np.conjugate(w2[self.n_features-1][x[self.n_features-1],:,0,:])).reshape(self.D*self.D)
         mpscontracted=np.inner(tmp[self.n_features-2,:],newtmp)
         tmp[self.n_features-1,:]=mpscontracted
         
         
         tmp2[self.n_features-1,:]=newtmp
-        for i in xrange(self.n_features-2,-1,-1):
-            newtmp = np.einsum('imj,klj->ikml',w2[i,x[i],:,:,:],
-                      np.conjugate(w2[i,x[i],:,:,:])).reshape((self.D*self.D,self.D*self.D))
-            tmp2[i,:]=np.dot(newtmp,tmp2[i+1,:])
-        newtmp=np.einsum('ij,kj->ik',w2[0,x[0],0,:,:],
-                         np.conjugate(w2[0,x[0],0,:,:])).reshape(self.D*self.D)
+        for i in xrange(self.n_features-2,0,-1):
+            newtmp = np.tensordot(w2[i][x[i],:,:,:],tmp2[i+1,:].reshape(self.D,self.D),axes=([1],[0]))
+            tmp2[i,:] = np.tensordot(newtmp,np.conjugate(w2[i][x[i],:,:,:]),
+                                     axes=([1,2],[2,1])).reshape(self.D*self.D)
+        newtmp=self._einsum('ij,kj->ik',w2[0][x[0],0,:,:],
+                         np.conjugate(w2[0][x[0],0,:,:])).reshape(self.D*self.D)
         tmp2[0,:]=np.inner(newtmp,tmp2[1,:])
     
         #Now for each tensor, the derivative is the contraction of the rest of the tensors
         
-        derivative[0,x[0],0,:,:]=2*np.einsum('ij,il->lj',
-                        w2[0,x[0],0,:,:],tmp2[1,:].reshape(self.D,self.D))
-        derivative[self.n_features-1,x[self.n_features-1],:,0,:]=\
-            2*np.einsum('ij,il->lj',w2[self.n_features-1,x[self.n_features-1],:,0,:],
+        dw2[0][x[0],0,:,:]+=2*self._einsum('ij,il->lj',
+                        w2[0][x[0],0,:,:],tmp2[1,:].reshape(self.D,self.D))
+        dw2[self.n_features-1][x[self.n_features-1],:,0,:]+=\
+            2*self._einsum('ij,il->lj',w2[self.n_features-1][x[self.n_features-1],:,0,:],
                         tmp[self.n_features-2,:].reshape(self.D,self.D))
         for i in xrange(1,self.n_features-1):
             temp1=tmp[i-1,:].reshape(self.D,self.D)
             temp2=tmp2[i+1,:].reshape(self.D,self.D)
-            derivative[i,x[i],:,:,:]=2*np.einsum('ikm,ij,kl->jlm',w2[i,x[i],:,:,:],temp1,temp2)
+            dw2[i][x[i],:,:,:]+=2*self._einsum('ikm,ij,kl->jlm',w2[i][x[i],:,:,:],temp1,temp2)
 
-        return derivative.reshape(self.m_parameters)
+        return derivative
+
+    def _logderivative_batch(self, X, weights=None):
+        """Compute the sum of the logderivatives of P(x) over a batch of configurations
+        Parameters
+        ----------
+        X : numpy array, shape (n_samples, n_features)
+            Configurations
+        weights : numpy array, shape (n_samples,) (optional)
+            Weight of each configuration in the sum
+        Returns
+        -------
+        derivative : numpy array, shape (m_parameters,)
+        """
+        w2 = self._cores(self.w)
+        n_samples = X.shape[0]
+        derivative = np.zeros(self.m_parameters,dtype=self.w.dtype)
+        dw2 = self._cores(derivative)
+
+        #Left and right environments of the whole batch, in one sweep each:
+        #tmp[i,b,:,:] is the contraction of the first i+1 tensors for sample b,
+        #tmp2[i,b,:,:] the contraction of the tensors i to n_features-1,
+        #with the bond index of the tensor first and of its conjugate second
+        tmp = np.zeros((self.n_features,n_samples,self.D,self.D),dtype=self.w.dtype)
+        tmp2 = np.zeros((self.n_features,n_samples,self.D,self.D),dtype=self.w.dtype)
+        if self.prefix_trie:
+            #Left environments of the distinct prefixes, read off for each sample
+            parents, symbols, nodes = self._prefixtrie(X)
+            newtmp = w2[0][symbols[0],0,:,:]
+            env = np.matmul(newtmp,np.conjugate(newtmp).transpose((0,2,1)))
+            tmp[0] = env[nodes[0]]
+            for i in xrange(1,self.n_features-1):
+                n_nodes = len(symbols[i])
+                newtmp = w2[i][symbols[i],:,:,:]
+                tmp3 = np.matmul(env[parents[i]].transpose((0,2,1)),newtmp.reshape(n_nodes,self.D,self.D*self.mu))
+                tmp3 = tmp3.reshape(n_nodes,self.D,self.D,self.mu).transpose((0,2,1,3))
+                env = np.matmul(tmp3.reshape(n_nodes,self.D,self.D*self.mu),
+                                np.conjugate(newtmp).transpose((0,1,3,2)).reshape(n_nodes,self.D*self.mu,self.D))
+                tmp[i] = env[nodes[i]]
+        else:
+            newtmp = w2[0][X[:,0],0,:,:]
+            tmp[0] = np.matmul(newtmp,np.conjugate(newtmp).transpose((0,2,1)))
+            for i in xrange(1,self.n_features-1):
+                newtmp = w2[i][X[:,i],:,:,:]
+                tmp3 = np.matmul(tmp[i-1].transpose((0,2,1)),newtmp.reshape(n_samples,self.D,self.D*self.mu))
+                tmp3 = tmp3.reshape(n_samples,self.D,self.D,self.mu).transpose((0,2,1,3))
+                tmp[i] = np.matmul(tmp3.reshape(n_samples,self.D,self.D*self.mu),
+                                   np.conjugate(newtmp).transpose((0,1,3,2)).reshape(n_samples,self.D*self.mu,self.D))
+        newtmp = w2[self.n_features-1][X[:,self.n_features-1],:,0,:]
+        tmp2[self.n_features-1] = np.matmul(newtmp,np.conjugate(newtmp).transpose((0,2,1)))
+        for i in xrange(self.n_features-2,0,-1):
+            newtmp = w2[i][X[:,i],:,:,:]
+            tmp3 = np.matmul(newtmp.transpose((0,1,3,2)).reshape(n_samples,self.D*self.mu,self.D),tmp2[i+1])
+            tmp2[i] = np.matmul(tmp3.reshape(n_samples,self.D,self.mu*self.D),
+                                np.conjugate(newtmp).transpose((0,3,2,1)).reshape(n_samples,self.mu*self.D,self.D))
+        probability = np.abs(np.sum(tmp[self.n_features-2]*tmp2[self.n_features-1],(1,2)))
+
+        #Each sample only touches one slice per tensor: scatter-add the
+        #contraction of the rest of the tensors divided by P(x)
+        ratio = 2/probability
+        if weights is not None:
+            ratio = weights*ratio
+        newtmp = np.matmul(tmp2[1].transpose((0,2,1)),w2[0][X[:,0],0,:,:])
+        np.add.at(dw2[0][:,0,:,:],X[:,0],newtmp*ratio[:,None,None])
+        newtmp = np.matmul(tmp[self.n_features-2].transpose((0,2,1)),
+                           w2[self.n_features-1][X[:,self.n_features-1],:,0,:])
+        np.add.at(dw2[self.n_features-1][:,:,0,:],X[:,self.n_features-1],
+                  newtmp*ratio[:,None,None])
+        for i in xrange(1,self.n_features-1):
+            newtmp = np.matmul(tmp[i-1].transpose((0,2,1)),
+                               w2[i][X[:,i],:,:,:].reshape(n_samples,self.D,self.D*self.mu))
+            newtmp = newtmp.reshape(n_samples,self.D,self.D,self.mu).transpose((0,1,3,2))
+            newtmp = np.matmul(newtmp,tmp2[i+1,:,None,:,:]).transpose((0,1,3,2))
+            np.add.at(dw2[i],X[:,i],newtmp*ratio[:,None,None,None])
+
+        return derivative
 
     def _derivativenorm(self):
         """Compute the derivative of the norm
@@ -162,55 +420,42 @@ class ComplexLPS(TN):
         derivative : numpy array, shape (m_parameters,)
         """   
         
-        w2=np.reshape(self.w,(self.n_features,self.d,self.D,self.D,self.mu))
-        derivative=np.zeros((self.n_features,self.d,self.D,self.D,self.mu),dtype=np.complex128)
-        
-        tmp=np.zeros((self.n_features,self.D*self.D),dtype=np.complex128)
-        tmp2=np.zeros((self.n_features,self.D*self.D),dtype=np.complex128)
+        w2=self._cores(self.w)
+        derivative=np.zeros(self.m_parameters,dtype=self.w.dtype)
+        dw2=self._cores(derivative)
         
-        tmp[0,:] = np.einsum('ijk,ilk->jl',w2[0,:,0,:,:],
-                        np.conj(w2[0,:,0,:,:])).reshape(self.D*self.D)
-        for i in xrange(1,self.n_features-1):
-            newtmp = np.einsum('pimj,pklj->ikml',w2[i,:,:,:,:],
-                               np.conjugate(w2[i,:,:,:,:])).reshape((self.D*self.D,self.D*self.D))
-            tmp[i,:] = np.dot(tmp[i-1,:],newtmp)  
-        newtmp = np.einsum('ijk,ilk->jl',w2[self.n_features-1,:,:,0,:],
-                           np.conjugate(w2[self.n_features-1,:,:,0,:])).reshape(self.D*self.D)
-        mpscontracted=np.inner(tmp[self.n_features-2,:],newtmp)
-        tmp[self.n_features-1,:]=mpscontracted
+        tmp=self._leftenvironments()
+        tmp2=self._rightenvironments()
 
-        tmp2[self.n_features-1,:]=newtmp
-        for i in xrange(self.n_features-2,-1,-1):
-            newtmp = np.einsum('pimj,pklj->ikml',w2[i,:,:,:,:],
-                        np.conjugate(w2[i,:,:,:,:])).reshape((self.D*self.D,self.D*self.D))
-            tmp2[i,:] = np.dot(newtmp,tmp2[i+1,:])
-        newtmp=np.einsum('ijk,ilk->jl',w2[0,:,0,:,:],np.conj(w2[0,:,0,:,:])).reshape(self.D*self.D)
-        tmp2[0,:]=np.inner(newtmp,tmp2[1,:])
-        
-        for j in xrange(self.d):
-            derivative[0,j,0,:,:]=2*np.einsum('ij,il->lj',w2[0,j,0,:,:],
+        for j in xrange(len(w2[0])):
+            dw2[0][j,0,:,:]+=2*self._einsum('ij,il->lj',w2[0][j,0,:,:],
                                             tmp2[1,:].reshape(self.D,self.D))
-            derivative[self.n_features-1,j,:,0,:]=\
-            2*np.einsum('ij,il->lj',w2[self.n_features-1,j,:,0,:],
+        for j in xrange(len(w2[self.n_features-1])):
+            dw2[self.n_features-1][j,:,0,:]+=\
+            2*self._einsum('ij,il->lj',w2[self.n_features-1][j,:,0,:],
                             tmp[self.n_features-2,:].reshape(self.D,self.D))
         for i in xrange(1,self.n_features-1):
             temp1=tmp[i-1,:].reshape(self.D,self.D)
             temp2=tmp2[i+1,:].reshape(self.D,self.D)
-            for j in xrange(self.d):
-                derivative[i,j,:,:,:]=2*np.einsum('ikm,ij,kl->jlm',w2[i,j,:,:,:],temp1,temp2)
+            for j in xrange(len(w2[i])):
+                dw2[i][j,:,:,:]+=2*self._einsum('ikm,ij,kl->jlm',w2[i][j,:,:,:],temp1,temp2)
         
-        return derivative.reshape(self.m_parameters)
+        return derivative
 
 
+    def _parametertype(self):
+        """Complex type of the parameters and of the contractions, given by dtype"""
+        return np.result_type(self.dtype,np.complex64)
+
     def _weightinitialization(self,rng):
         """Initialize weights w randomly
         Parameters
         ----------
         rng : random number generation
         """
-        self.m_parameters = self.n_features*self.d*self.D*self.D*self.mu
-        self.w=np.asarray(rng.normal(0, 1, self.m_parameters))\
-                +1j*np.asarray(rng.normal(0, 1, self.m_parameters))
+        self.m_parameters = self._numberofparameters()
+        self.w=np.asarray(rng.normal(0, 1, self.m_parameters)\
+                +1j*rng.normal(0, 1, self.m_parameters),dtype=self._parametertype())
  
     def _weightinitialization2(self,rng):
         """Initialize weights w randomly
@@ -218,56 +463,10 @@ class ComplexLPS(TN):
         ----------
         rng : random number generation
         """
-        self.m_parameters2 = (self.n_features-2)*self.d*self.D*self.D*self.mu+self.d*self.D*self.mu*2
+        self.m_parameters2 = self._numberofparameters(padding=False)
         return np.asarray(rng.normal(0, 1, self.m_parameters2))\
                 +1j*np.asarray(rng.normal(0, 1, self.m_parameters2))
 
-    def _padding_function(self, w):
-        """Reshaping function to add to the input parameters the unused parameters
-        at the boundary conditions.
-        Parameters
-        ----------
-        w : numpy array, shape (m_parameters2,)
-        Returns
-        -------
-        w : numpy array, shape (m_parameters,)
-        """
-        new_w=np.zeros((self.n_features,self.d,self.D,self.D,self.mu),dtype=w.dtype)
-        new_w[0,:,0,:,:]=w[0:self.D*self.d*self.mu].reshape(self.d,self.D,self.mu)
-        new_w[1:self.n_features-1,:,:,:,:]=w[self.D*self.d*self.mu*2:].reshape((self.n_features-2,self.d,self.D,self.D,self.mu))
-        new_w[self.n_features-1,:,:,0,:]=w[self.D*self.d*self.mu:self.D*self.d*self.mu*2].reshape(self.d,self.D,self.mu)
-        return new_w.reshape(self.m_parameters)
-
-    def _unpadding_function(self, w):
-        """Reshaping function to remove the unused parameters of the boundary conditions.
-        Parameters
-        ----------
-        w : numpy array, shape (m_parameters,)
-        Returns
-        -------
-        w : numpy array, shape (m_parameters2,)
-        """
-        w=w.reshape((self.n_features,self.d,self.D,self.D,self.mu))
-        new_w=np.zeros(self.m_parameters2,dtype=w.dtype)
-        new_w[0:self.D*self.d*self.mu]=w[0,:,0,:,:].reshape(self.d*self.D*self.mu)
-        new_w[self.D*self.d*self.mu:self.D*self.d*self.mu*2]=w[self.n_features-1,:,:,0,:].reshape(self.d*self.D*self.mu)
-        new_w[self.D*self.d*self.mu*2:]=w[1:self.n_features-1,:,:,:,:].reshape((self.n_features-2)*self.d*self.D*self.D*self.mu)
-        return new_w
-                
-    def _likelihood_derivative(self, v):
-        """Compute derivative of log-likelihood of configurations in v
-        Parameters
-        ----------
-        v : numpy array, shape (n_samples,n_features)
-            Configurations
-        Returns
-        -------
-        update_w : numpy array, shape (m_parameters,)
-            array of derivatives of the log-likelihood
-        """
-        update_w=np.zeros(self.m_parameters,dtype=np.complex128)
-        for n in xrange(v.shape[0]):
-            update_w -= self._logderivative(v[n,:])
-        update_w += v.shape[0]*self._logderivativenorm()    
-        update_w /= v.shape[0]
-        return update_w
\ No newline at end of file
+    def _tensorshape(self, D1, D2):
+        """Shape of a tensor of the network with left and right bond dimensions D1 and D2"""
+        return (self.d, D1, D2, self.mu)
@@ -1,11 +1,35 @@
+import os
+import json
 import time
+import inspect
+import multiprocessing
 import numpy as np
 from sklearn.externals.six.moves import xrange
 from sklearn.utils import check_array
 from sklearn.utils import check_random_state
 from functools import partial
 from scipy.optimize import minimize
-import itertools
+
+#Version of the format written by TN.save
+_FORMAT_VERSION = 1
+
+#Model and parameters seen by the worker processes of TN.fit(n_jobs=...)
+_worker_model = None
+_worker_w = None
+
+def _init_worker(model, w_buffer, dtype):
+    """Initialize a worker process with a copy of the model without its parameters,
+    which are read from the shared buffer w_buffer
+    """
+    global _worker_model, _worker_w
+    _worker_model = model
+    _worker_w = np.frombuffer(w_buffer, dtype=dtype)
+
+def _logderivative_worker(args):
+    """Sum of the logderivatives of P(x) over a shard (X, weights) of a batch"""
+    X, weights = args
+    _worker_model.w = _worker_w
+    return _worker_model._logderivative_batch(X, weights)
 
 class TN():
     """Generic Tensor Network Class.
@@ -27,6 +51,17 @@ class TN():
         seed. Defaults to the global numpy random number generator.
     verbose : int, optional
         The verbosity level. The default, zero, means silent mode.
+    prefix_trie : bool, optional
+        If True, batches are contracted over their prefix trie: each distinct
+        prefix of the configurations is contracted once.
+    homogeneous : bool, optional
+        If True, all the sites between the first and the last share the same
+        tensor (translation invariant network): the parameters are the first
+        and last tensors and one bulk tensor, and the norm is computed by
+        repeated squaring of the transfer operator when it is cheaper. Only
+        the evaluation of the norm is O(log(n_features)): the gradient of the
+        norm in each step of fit still contracts the environments of all the
+        sites, in O(n_features).
     ----------
     Attributes
     ----------
@@ -42,19 +77,331 @@ class TN():
         physical dimension (dimension of the categorical features)
     m_parameters : int
         number of parameters in the network
+    bond_dimensions : numpy array, shape (n_features-1,)
+        dimension of the bond between each site and the next one, at most D.
+        The parameters beyond the dimension of a bond are zero.
+    site_dimensions : numpy array, shape (n_features,)
+        physical dimension of each site (number of categories of each feature),
+        at most d. The parameters of the other values are not used.
+    log_scales : numpy array, shape (n_features,) or None
+        In single precision, logarithm of the factor of the tensor of each site
+        removed by the rescaling: the parameters of the same fit in double
+        precision are the tensors of w times exp(log_scales). None if fit did
+        not rescale the tensors.
     history : list
         saves the training accuracies during training
     """
     
     def __init__(self, D=4, learning_rate=0.1, batch_size=10,
-                 n_iter=100, random_state=None, verbose=False):
+                 n_iter=100, random_state=None, verbose=False, prefix_trie=False,
+                 homogeneous=False, dtype=np.float64):
         self.D = D
         self.learning_rate = float(learning_rate)
         self.batch_size = batch_size
         self.n_iter = n_iter
         self.random_state = random_state
         self.verbose = verbose
-        
+        self.prefix_trie = prefix_trie
+        self.homogeneous = homogeneous
+        self.dtype = dtype
+
+    @property
+    def w(self):
+        """Parameters of the tensor network.
+        Every assignment (including in-place updates such as self.w -= update)
+        increments a version counter, used to invalidate cached contractions.
+        """
+        return self._w
+
+    @w.setter
+    def w(self, w):
+        self._w = w
+        self._w_version = getattr(self, '_w_version', 0) + 1
+
+    @property
+    def site_dimensions(self):
+        """Physical dimension of each site, d for all the sites of a network
+        whose dimensions were not set by fit or _setdimensions.
+        """
+        site_dimensions = getattr(self, '_site_dimensions', None)
+        if site_dimensions is None:
+            return np.full(self.n_features,self.d)
+        return site_dimensions
+
+    @site_dimensions.setter
+    def site_dimensions(self, site_dimensions):
+        self._site_dimensions = site_dimensions
+
+    def _cached(self, key, function):
+        """Return function(), cached until the next update of the parameters
+        Parameters
+        ----------
+        key : str
+            Name of the cached quantity
+        function : callable
+            Computes the quantity from the current parameters
+        """
+        if getattr(self, '_cache_version', None) != self._w_version:
+            self._cache = {}
+            self._cache_version = self._w_version
+        if key not in self._cache:
+            self._cache[key] = function()
+        return self._cache[key]
+
+    #Contraction plans of self._einsum, shared by all the instances
+    _einsum_plans = {}
+
+    def _einsum(self, subscripts, *operands):
+        """np.einsum with a contraction plan computed once and then reused.
+        The plan only depends on the subscripts and on the shapes and dtype of
+        the operands, that is on (D, mu, d, dtype) for a given contraction.
+        Parameters
+        ----------
+        subscripts : str
+            Subscripts of the contraction, as for np.einsum (explicit output)
+        operands : numpy arrays
+        """
+        key = (subscripts, tuple(operand.shape for operand in operands),
+               np.result_type(*operands))
+        plan = self._einsum_plans.get(key)
+        if plan is None:
+            plan = self._einsum_plan(subscripts, *operands)
+            self._einsum_plans[key] = plan
+        operands = list(operands)
+        for positions, step in plan:
+            operands.append(step(*[operands.pop(k) for k in positions]))
+        return operands[0]
+
+    def _einsum_plan(self, subscripts, *operands):
+        """Contraction plan of self._einsum: the pairwise contractions of the
+        optimal path of np.einsum_path, each done by np.tensordot (BLAS) when it
+        is a large enough product over shared indices, and by np.einsum otherwise
+        Returns
+        -------
+        plan : list of (positions, step)
+            step is applied to the operands popped at positions, and its
+            result is appended to the operands
+        """
+        inputs, output = subscripts.split('->')
+        inputs = inputs.split(',')
+        sizes = {}
+        for term, operand in zip(inputs, operands):
+            sizes.update(zip(term, operand.shape))
+        path = np.einsum_path(subscripts, *operands, optimize='optimal')[0][1:]
+        plan = []
+        for contraction in path:
+            positions = sorted(contraction, reverse=True)
+            terms = [inputs.pop(k) for k in positions]
+            remaining = set(output).union(*inputs)
+            result = ''
+            for c in ''.join(terms):
+                if c in remaining and c not in result:
+                    result += c
+            step = partial(np.einsum, ','.join(terms)+'->'+result)
+            if len(terms) == 2:
+                a, b = terms
+                shared = set(a) & set(b)
+                flops = np.prod([sizes[c] for c in set(a+b)])
+                if len(set(a)) == len(a) and len(set(b)) == len(b) \
+                        and not shared & remaining and set(a+b)-shared <= remaining \
+                        and flops >= 4096:
+                    contracted = [c for c in a if c in shared]
+                    step = partial(np.tensordot, axes=([a.index(c) for c in contracted],
+                                                       [b.index(c) for c in contracted]))
+                    result = ''.join(c for c in a+b if c not in shared)
+            inputs.append(result)
+            plan.append((positions, step))
+        if inputs[0] != output:
+            plan.append(([0], partial(np.einsum, inputs[0]+'->'+output)))
+        return plan
+
+    def _tensorshape(self, D1, D2):
+        """Shape of a tensor of the network with left and right bond dimensions D1 and D2"""
+        return (self.d, D1, D2)
+
+    def _numberofparameters(self, padding=True):
+        """Number of parameters of the network
+        Parameters
+        ----------
+        padding : bool, optional
+            If False, the unused parameters of the first and last tensors and
+            beyond the bond and site dimensions are not counted (m_parameters2)
+        """
+        bulk = int(np.prod(self._tensorshape(self.D,self.D)))
+        boundary = int(np.prod(self._tensorshape(1,self.D)))
+        if self.homogeneous:
+            return 2*boundary+bulk
+        if padding:
+            return self.n_features*bulk
+        return sum(int(np.prod(shape)) for shape in self._siteshapes())
+
+    def _siteshapes(self):
+        """Shapes of the tensors of the network without their unused parameters,
+        with the physical dimension of each site, and bonds of dimension 1 at the
+        boundaries
+        Returns
+        -------
+        shapes : list of tuples
+        """
+        left, right = self._bonddimensions()
+        return [(int(self.site_dimensions[i]),)+self._tensorshape(left[i],right[i])[1:]
+                for i in xrange(self.n_features)]
+
+    def _setdimensions(self, n_features, d):
+        """Set the dimensions of a network of n_features sites before the
+        initialization of its parameters: the number of parameters, bonds of
+        dimension D and sites of physical dimension d
+        Parameters
+        ----------
+        n_features : int
+            Number of sites
+        d : int
+            Physical dimension
+        """
+        self.n_features = int(n_features)
+        self.d = int(d)
+        self.m_parameters = self._numberofparameters()
+        self.bond_dimensions = np.full(self.n_features-1,self.D)
+        self.site_dimensions = np.full(self.n_features,self.d)
+
+    def _sitedimensions(self, X, site_dimensions=None):
+        """Physical dimension of each site, site_dimensions if given and
+        otherwise the number of categories of each feature of X, or d for all
+        the sites of a homogeneous network
+        Parameters
+        ----------
+        X : numpy array, shape (n_samples, n_features)
+        site_dimensions : array-like, shape (n_features,) (optional)
+            At least the number of categories of each feature of X
+        Returns
+        -------
+        site_dimensions : numpy array, shape (n_features,)
+        """
+        if self.homogeneous:
+            return np.full(self.n_features,self.d)
+        if site_dimensions is None:
+            return np.max(X,0)+1
+        site_dimensions = np.asarray(site_dimensions,dtype=np.int64)
+        if site_dimensions.shape != (self.n_features,) or np.any(site_dimensions<np.max(X,0)+1):
+            raise ValueError("site_dimensions must give for each of the %d features at least "
+                             "its number of categories in X" % self.n_features)
+        return site_dimensions
+
+    def _sitevalues(self, X):
+        """Configurations to contract, with the values beyond the dimension of
+        their site, which have probability 0, replaced by 0
+        Parameters
+        ----------
+        X : numpy array, shape (n_samples, n_features) or (n_features,)
+        Returns
+        -------
+        X : numpy array, same shape
+        valid : numpy array of bool, shape (n_samples,) or bool
+            Whether all the values of each configuration are within the
+            dimensions of their sites
+        """
+        inrange = X<self.site_dimensions
+        return np.where(inrange,X,0), np.all(inrange,-1)
+
+    def _bonddimensions(self):
+        """Left and right bond dimensions of each tensor of the network,
+        with bonds of dimension 1 at the boundaries
+        Returns
+        -------
+        left, right : numpy arrays, shape (n_features,)
+        """
+        bonds = np.concatenate([[1],self.bond_dimensions,[1]]).astype(int)
+        return bonds[:-1], bonds[1:]
+
+    def _truncationrank(self, s, tolerance):
+        """Number of singular values to keep for the discarded weight, the
+        fraction of sum(s**2) carried by the discarded ones, to be at most tolerance
+        Parameters
+        ----------
+        s : numpy array
+            Singular values in decreasing order
+        tolerance : float
+        """
+        weight = np.cumsum(np.square(s[::-1]))[::-1]
+        return max(1,int(np.sum(weight>tolerance*weight[0])))
+
+    def _cores(self, w):
+        """Views of a parameter vector as the list of the n_features tensors of the network.
+        Only row 0 of the first tensor and column 0 of the last tensor are used,
+        and tensor i only has the site_dimensions[i] values of site i.
+        In homogeneous mode, w holds the first tensor, of shape _tensorshape(1, D),
+        the last tensor, of shape _tensorshape(D, 1), and the bulk tensor, which
+        is the same object at every site in between.
+        Parameters
+        ----------
+        w : numpy array, shape (m_parameters,)
+        Returns
+        -------
+        cores : list of numpy arrays
+            cores[i] is a view of w, writing in it writes in w
+        """
+        if self.homogeneous:
+            m_boundary = int(np.prod(self._tensorshape(1,self.D)))
+            first = w[:m_boundary].reshape(self._tensorshape(1,self.D))
+            last = w[m_boundary:2*m_boundary].reshape(self._tensorshape(self.D,1))
+            core = w[2*m_boundary:].reshape(self._tensorshape(self.D,self.D))
+            return [first]+[core]*(self.n_features-2)+[last]
+        w = w.reshape((self.n_features,)+self._tensorshape(self.D,self.D))
+        return [w[i,:self.site_dimensions[i]] for i in xrange(self.n_features)]
+
+    def _parametertype(self):
+        """Type of the parameters and of the contractions, given by dtype"""
+        return np.dtype(self.dtype)
+
+    def _singleprecision(self):
+        """Whether the contractions are in single precision and fit rescales the tensors"""
+        return np.finfo(self._parametertype()).bits < 64
+
+    def _squaringcheaper(self, m, site_cost):
+        """Whether the norm of a homogeneous network is cheaper to compute by
+        repeated squaring of its (m, m) transfer operator, about d*m^2+2*log2(n)*m^3
+        operations, than by a sweep over the n sites at site_cost operations each
+        """
+        n = self.n_features-2
+        if not self.homogeneous or n < 1:
+            return False
+        return self.d*m**2+2*np.log2(n+1)*m**3 < n*site_cost
+
+    def _lognormsquaring(self, left, transfer, right):
+        """Logarithm of the norm left.transfer^(n_features-2).right of a
+        homogeneous network, computed by repeated squaring of the transfer
+        operator with O(log(n_features)) matrix products. Each product is
+        rescaled by its largest element, whose logarithm is accumulated.
+        Used by _computenorm only, _derivativenorm sweeps over all the sites.
+        Parameters
+        ----------
+        left : numpy array, shape (m,)
+            Contraction of the first tensor with its copy
+        transfer : numpy array, shape (m, m)
+            Contraction of the bulk tensor with its copy
+        right : numpy array, shape (m,)
+            Contraction of the last tensor with its copy
+        Returns
+        -------
+        lognorm : float
+        """
+        n = self.n_features-2
+        lognorm = 0.
+        logscale = 0. #transfer^(2^k) = exp(logscale)*transfer at step k
+        while n > 0:
+            if n % 2 == 1:
+                left = np.dot(left,transfer)
+                scale = np.max(np.abs(left))
+                left = left/scale
+                lognorm += logscale+np.log(scale)
+            n = n//2
+            if n > 0:
+                transfer = np.dot(transfer,transfer)
+                scale = np.max(np.abs(transfer))
+                transfer = transfer/scale
+                logscale = 2*logscale+np.log(scale)
+        return lognorm+np.log(np.abs(np.inner(left,right)))
+
     def _probability(self, x): 
         """Unnormalized probability of one configuration P(x)
         Parameters
@@ -66,7 +413,48 @@ class TN():
         probability : float
         """
         pass
+
+    def _probability_batch(self, X):
+        """Unnormalized probabilities of a batch of configurations P(x),
+        0 for the configurations with a value beyond the dimension of its site
+        Parameters
+        ----------
+        X : numpy array, shape (n_samples, n_features)
+            Configurations
+        Returns
+        -------
+        probability : numpy array, shape (n_samples,)
+        """
+        pass
     
+    def _prefixtrie(self, X):
+        """Prefix trie of a batch of configurations
+        Parameters
+        ----------
+        X : numpy array, shape (n_samples, n_features)
+            Configurations
+        Returns
+        -------
+        parents : list of numpy arrays
+            parents[i][k] is the index of the parent of the k-th node of depth i
+            among the nodes of depth i-1 (0 for depth 0, the parent is the root)
+        symbols : list of numpy arrays
+            symbols[i][k] is the value of feature i on the k-th node of depth i
+        nodes : numpy array, shape (n_features, n_samples)
+            nodes[i,b] is the node of depth i of sample b, that is of the prefix X[b,:i+1]
+        """
+        parents = []
+        symbols = []
+        nodes = np.zeros((self.n_features,X.shape[0]),dtype=np.int64)
+        node = np.zeros(X.shape[0],dtype=np.int64)
+        for i in xrange(self.n_features):
+            #A node of depth i is a distinct pair (node of depth i-1, value of feature i)
+            keys, node = np.unique(node*self.d+X[:,i],return_inverse=True)
+            parents.append(keys//self.d)
+            symbols.append(keys%self.d)
+            nodes[i] = node.reshape(-1)
+        return parents, symbols, nodes
+
     def _computenorm(self): 
         """Compute norm of probability distribution
         Returns
@@ -95,6 +483,124 @@ class TN():
         """
         pass
     
+    def _computeleftenvironments(self):
+        """Compute the contractions of the norm from the left boundary
+        Returns
+        -------
+        tmp : numpy array, shape (n_features, ...)
+            tmp[i] is the contraction of the first i+1 tensors,
+            tmp[n_features-1] is the norm
+        """
+        pass
+
+    def _computerightenvironments(self):
+        """Compute the contractions of the norm from the right boundary
+        Returns
+        -------
+        tmp2 : numpy array, shape (n_features, ...)
+            tmp2[i] is the contraction of the tensors i to n_features-1,
+            tmp2[0] is the norm
+        """
+        pass
+
+    def _leftenvironments(self):
+        """Left environments of the norm, computed once per parameter update"""
+        return self._cached('left', self._computeleftenvironments)
+
+    def _rightenvironments(self):
+        """Right environments of the norm, computed once per parameter update"""
+        return self._cached('right', self._computerightenvironments)
+
+    def _conditionalprobability(self, left, i, tmp2):
+        """Unnormalized probabilities of the values of x[i] given x[:i], for sampling
+        Parameters
+        ----------
+        left : numpy array, shape (n_samples, ...) or None if i=0
+            Contraction of the tensors before site i at x[:i], up to a factor
+        i : int
+            Site
+        tmp2 : numpy array, shape (n_features, ...)
+            Right environments of the norm
+        Returns
+        -------
+        probability : numpy array, shape (n_samples, d) or (1, d) if i=0
+        """
+        pass
+
+    def _maskedtransfer(self, left, i, mask):
+        """Contraction of the left contraction of the norm with the tensor of site i
+        and its conjugate, summed over the allowed values of site i only
+        Parameters
+        ----------
+        left : numpy array, shape (n_queries, ...) or None if i=0
+            Contraction of the norm before site i for each evidence pattern
+        i : int
+            Site
+        mask : numpy array of bool, shape (n_queries, d)
+            Allowed values of site i for each evidence pattern
+        Returns
+        -------
+        left : numpy array, shape (n_queries, ...)
+            Same shape as the left environments of the norm
+        """
+        pass
+
+    def _adaptbonds(self):
+        """Adapt the bond dimensions to the parameters, called after each
+        iteration of fit. Does nothing by default.
+        """
+        pass
+
+    def _rescale(self):
+        """Rescale the tensor of each site so that the contraction of the norm
+        up to each site, and the norm, are 1. The probability distribution is
+        unchanged, the logarithm of the factor removed from each site is added
+        to log_scales, and the gradient steps of fit are rescaled accordingly.
+        The tensors of a homogeneous network are rescaled by a common factor.
+        """
+        w2 = self._cores(self.w)
+        logscales = np.zeros(self.n_features)
+        left = None
+        for i in xrange(self.n_features):
+            left = self._maskedtransfer(left, i, np.ones((1,len(w2[i])),dtype=bool))
+            if i == self.n_features-1:
+                #The last tensor only uses its column 0
+                scale = np.abs(left[0,0])
+            else:
+                scale = np.max(np.abs(left))
+            left = left/scale
+            #The contraction of the norm is quadratic in the tensor of each site
+            logscales[i] = np.log(scale)/2
+        if self.homogeneous:
+            logscales[:] = np.mean(logscales)
+            self.w *= np.exp(-logscales[0]).astype(self.w.real.dtype)
+        else:
+            for i in xrange(self.n_features):
+                w2[i] *= np.exp(-logscales[i]).astype(self.w.real.dtype)
+            self.w = self.w
+        self.log_scales = self.log_scales+logscales
+        #Step of the parameters of double precision, exp(log_scales) times w
+        self._steps = np.ones(self.m_parameters,dtype=self.w.real.dtype)
+        for core,logscale in zip(self._cores(self._steps),self.log_scales):
+            core[...] = np.exp(-2*logscale)
+        self.norm = self._computenorm()
+
+    def _leftstate(self, left, i, x):
+        """Contraction of the tensors up to site i at x[:i+1], for sampling
+        Parameters
+        ----------
+        left : numpy array, shape (n_samples, ...) or None if i=0
+            Contraction of the tensors before site i at x[:i]
+        i : int
+            Site
+        x : numpy array, shape (n_samples,)
+            Values of x[i]
+        Returns
+        -------
+        left : numpy array, shape (n_samples, ...)
+        """
+        pass
+
     def _logderivative(self, x):
         """Compute the logderivatives of P(x)
         Parameters
@@ -108,6 +614,77 @@ class TN():
         derivative=self._derivative(x)/self._probability(x)
         return derivative
 
+    def _logderivative_batch(self, X, weights=None):
+        """Compute the sum of the logderivatives of P(x) over a batch of configurations
+        Parameters
+        ----------
+        X : numpy array, shape (n_samples, n_features)
+            Configurations
+        weights : numpy array, shape (n_samples,) (optional)
+            Weight of each configuration in the sum
+        Returns
+        -------
+        derivative : numpy array, shape (m_parameters,)
+        """
+        pass
+
+    def _logderivative_batch_parallel(self, X, weights=None):
+        """Compute the sum of the logderivatives of P(x) over a batch of configurations,
+        split in one shard per worker process. The partial sums are reduced in
+        the order of the shards, so the result does not depend on scheduling.
+        Parameters
+        ----------
+        X : numpy array, shape (n_samples, n_features)
+            Configurations
+        weights : numpy array, shape (n_samples,) (optional)
+            Weight of each configuration in the sum
+        Returns
+        -------
+        derivative : numpy array, shape (m_parameters,)
+        """
+        if self.w is not self._w_shared:
+            np.copyto(self._w_shared, self.w)
+        shards = [s for s in np.array_split(np.arange(X.shape[0]), self._n_jobs) if len(s)>0]
+        if weights is None:
+            args = [(X[s], None) for s in shards]
+        else:
+            args = [(X[s], weights[s]) for s in shards]
+        partials = self._pool.map(_logderivative_worker, args)
+        derivative = partials[0]
+        for partial_derivative in partials[1:]:
+            derivative = derivative + partial_derivative
+        return derivative
+
+    def _start_pool(self, n_jobs):
+        """Start n_jobs worker processes, and move the parameters to a buffer
+        shared with them so that they are never sent to the workers
+        Parameters
+        ----------
+        n_jobs : int
+            Number of processes, -1 for all the processors
+        """
+        if n_jobs < 0:
+            n_jobs = max(multiprocessing.cpu_count()+1+n_jobs, 1)
+        w_buffer = multiprocessing.RawArray('b', self.w.nbytes)
+        self._w_shared = np.frombuffer(w_buffer, dtype=self.w.dtype)
+        np.copyto(self._w_shared, self.w)
+        model = self.__class__.__new__(self.__class__)
+        model.__dict__.update((k, v) for k, v in self.__dict__.items()
+                              if k not in ('_w', '_w_shared', '_cache', 'history'))
+        self._n_jobs = n_jobs
+        self._pool = multiprocessing.Pool(n_jobs, _init_worker,
+                                          (model, w_buffer, self.w.dtype))
+        #The updates self.w -= ... are done in place in the shared buffer
+        self.w = self._w_shared
+
+    def _stop_pool(self):
+        """Stop the worker processes and copy the parameters out of the shared buffer"""
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+        self.w = np.array(self.w)
+        del self._w_shared
+
     def _logderivativenorm(self):
         """Compute the logderivatives of the norm
         Returns
@@ -117,93 +694,286 @@ class TN():
         derivative=self._derivativenorm()/self.norm
         return derivative
         
-    def _fit(self, v):
+    def _fit(self, v, sample_weight=None):
         """Inner fit for one mini-batch of training 
         Updatest the parameters and recomputes the norm
         Parameters
         ----------
         v : numpy array, shape (n_samples, n_features)
             The data to use for training.
+        sample_weight : numpy array, shape (n_samples,) (optional)
+            Number of occurrences of each configuration in the mini-batch
         """
-        update_w = self._likelihood_derivative(v)
+        update_w = self._likelihood_derivative(v, sample_weight)
+        if self.log_scales is not None:
+            update_w *= self._steps
         self.w -= self.learning_rate * update_w
         self.norm = self._computenorm()
+        if self.log_scales is not None and not 10**(-10) < self.norm < 10**10:
+            self._rescale()
 
-    def _likelihood_derivative(self, v):
+    def _likelihood_derivative(self, v, sample_weight=None):
         """Compute derivatives of log-likelihood of configurations in v
         Parameters
         ----------
         v : numpy array, shape (n_samples,n_features)
             Configurations
+        sample_weight : numpy array, shape (n_samples,) (optional)
+            Number of occurrences of each configuration
         Returns
         -------
         update_w : numpy array, shape (m_parameters,)
             array of derivatives of the log-likelihood
         """
-        update_w=np.zeros(self.m_parameters)
-        for n in xrange(v.shape[0]):
-            update_w -= self._logderivative(v[n,:])
-        update_w += v.shape[0]*self._logderivativenorm()    
-        update_w /= v.shape[0]
+        if sample_weight is None:
+            n_samples = v.shape[0]
+        else:
+            sample_weight = np.asarray(sample_weight,dtype=self.w.real.dtype)
+            n_samples = np.sum(sample_weight)
+        if getattr(self, '_pool', None) is None:
+            update_w = -self._logderivative_batch(v, sample_weight)
+        else:
+            update_w = -self._logderivative_batch_parallel(v, sample_weight)
+        update_w += n_samples*self._logderivativenorm()    
+        update_w /= n_samples
         return update_w
         
-    def likelihood(self, v, w=None):
+    def likelihood(self, v, w=None, sample_weight=None):
         """Compute averaged negative log-likelihood of configurations in v
         Parameters
         ----------
         v : numpy array, shape (n_samples,n_features)
             dataset to compute the likelihood of
         w : parameters of tensor network (optional)
+        sample_weight : numpy array, shape (n_samples,) (optional)
+            Number of occurrences of each configuration
         Returns
         -------
         loglikelihood : float
             averaged negative log-likelihood of the data in v
         """
-        loglikelihood=0
         if w is not None:
             self.w=w
         self.norm=self._computenorm()
-        for n in xrange(v.shape[0]):
-            loglikelihood+=np.log(max(self._probability(v[n,:])/self.norm,10** (-50)))
-        return -loglikelihood/v.shape[0]
+        #The log-likelihood is accumulated in double precision
+        probability=np.asarray(self._probability_batch(v),dtype=np.float64)/self.norm
+        loglikelihood=np.log(np.maximum(probability,10**(-50)))
+        if sample_weight is None:
+            return -np.sum(loglikelihood)/v.shape[0]
+        return -np.sum(sample_weight*loglikelihood)/np.sum(sample_weight)
+
+    def _evidencemask(self, evidence):
+        """Allowed values of each site for a batch of evidence patterns
+        Parameters
+        ----------
+        evidence : numpy array, shape (n_queries, n_features) or (n_queries, n_features, d)
+            Integer array of the observed values with -1 for the sites that are
+            summed out, or boolean array of the allowed values of each site
+        Returns
+        -------
+        mask : numpy array of bool, shape (n_queries, n_features, d)
+        """
+        evidence = np.asarray(evidence)
+        if evidence.ndim == 3:
+            return evidence.astype(bool)
+        return (evidence[:,:,None]==np.arange(self.d))|(evidence[:,:,None]<0)
+
+    def marginal(self, evidence):
+        """Probability of partial evidence: the sum of P(x) over all the
+        configurations x allowed by each evidence pattern
+        Only the sites between the first and the last constrained site of the batch
+        are contracted, the summed out sites before and after use the cached
+        environments of the norm.
+        Parameters
+        ----------
+        evidence : numpy array, shape (n_queries, n_features) or (n_queries, n_features, d)
+            Integer array of the observed values with -1 for the sites that are
+            summed out, or boolean array of the allowed values of each site
+        Returns
+        -------
+        probability : numpy array, shape (n_queries,)
+        """
+        mask = self._evidencemask(evidence)
+        n_queries = mask.shape[0]
+        #The values beyond the dimension of a site have probability 0
+        unused = np.arange(mask.shape[2])>=self.site_dimensions[:,None]
+        constrained = np.flatnonzero(~np.all(mask|unused,(0,2)))
+        if len(constrained) == 0:
+            return np.ones(n_queries)
+        first, last = constrained[0], constrained[-1]
+        tmp = self._leftenvironments()
+        tmp2 = self._rightenvironments()
+        if first == 0:
+            left = None
+        else:
+            left = np.repeat(tmp[first-1][None],n_queries,0)
+        logscale = np.zeros(n_queries)
+        for i in xrange(first,last+1):
+            left = self._maskedtransfer(left, i, mask[:,i,:self.site_dimensions[i]])
+            #Rescale each evidence pattern to avoid underflow
+            scale = np.max(np.abs(left),1)
+            scale[scale==0] = 1
+            left = left/scale[:,None]
+            logscale += np.log(scale)
+        if last == self.n_features-1:
+            #The last tensor only uses its column 0
+            probability = np.abs(left[:,0])
+        else:
+            probability = np.abs(np.sum(left*tmp2[last+1],1))
+        return probability*np.exp(logscale)/self._computenorm()
+
+    def conditional(self, query, evidence):
+        """Conditional probability of the query patterns given the evidence patterns,
+        for instance of values of missing sites given the observed ones
+        Parameters
+        ----------
+        query : numpy array, shape (n_queries, n_features) or (n_queries, n_features, d)
+            Integer array with -1 for the sites that are not queried, or boolean array
+            of the allowed values of each site
+        evidence : numpy array, shape (n_queries, n_features) or (n_queries, n_features, d)
+            Integer array with -1 for the sites that are not observed, or boolean array
+            of the allowed values of each site
+        Returns
+        -------
+        probability : numpy array, shape (n_queries,)
+        """
+        evidence = self._evidencemask(evidence)
+        query = self._evidencemask(query)&evidence
+        probability = self.marginal(np.concatenate((query,evidence)))
+        return probability[:len(query)]/probability[len(query):]
+
+    def sample(self, n_samples, random_state=None):
+        """Draw exact samples from the probability distribution of the network
+        Ancestral sampling: the right environments are computed once, then the
+        value of each site is drawn from its distribution conditioned on the
+        previous sites, for all samples at the same time. Samples are grouped by
+        prefix, as in the prefix trie: each distinct prefix is contracted once
+        and its samples are split among its children with multinomial counts.
+        Parameters
+        ----------
+        n_samples : int
+            Number of samples
+        random_state : integer or numpy.RandomState, optional
+            Random number generator, or seed
+        Returns
+        -------
+        X : numpy array, shape (n_samples, n_features)
+            Samples, in random order
+        """
+        rng = check_random_state(random_state)
+        tmp2 = self._rightenvironments()
+        #Number of samples of each distinct prefix, the parent and last value of
+        #the prefixes of each length
+        counts = np.array([n_samples])
+        parents = [None]*self.n_features
+        symbols = [None]*self.n_features
+        left = None
+        for i in xrange(self.n_features):
+            probability = self._conditionalprobability(left, i, tmp2)
+            mass = np.sum(probability,1)
+            children = self._splitcounts(counts, probability/mass[:,None], rng)
+            parents[i], symbols[i] = np.nonzero(children)
+            counts = children[parents[i],symbols[i]]
+            if i < self.n_features-1:
+                if left is not None:
+                    left = left[parents[i]]
+                left = self._leftstate(left, i, symbols[i])
+                #Rescale each prefix to avoid underflow, the conditionals do not depend on it
+                left = left/mass[parents[i]].reshape((-1,)+(1,)*(left.ndim-1))
+        #Read off the prefixes from the last site back to the first
+        X = np.zeros((len(counts),self.n_features),dtype=np.int64)
+        node = np.arange(len(counts))
+        for i in xrange(self.n_features-1,-1,-1):
+            X[:,i] = symbols[i][node]
+            node = parents[i][node]
+        X = np.repeat(X,counts,axis=0)
+        return X[rng.permutation(n_samples)]
+
+    def _splitcounts(self, counts, probability, rng):
+        """Multinomial split of the samples of each prefix among the values of the next site
+        Parameters
+        ----------
+        counts : numpy array, shape (n_prefixes,)
+            Number of samples of each prefix
+        probability : numpy array, shape (n_prefixes, d_i)
+            Conditional probabilities of the values of the next site
+        rng : random number generation
+        Returns
+        -------
+        children : numpy array, shape (n_prefixes, d_i)
+            Number of samples of each prefix and value
+        """
+        d = probability.shape[1]
+        children = np.zeros((len(counts),d),dtype=np.int64)
+        #A single sample is one categorical draw
+        single = np.flatnonzero(counts==1)
+        cumulative = np.cumsum(probability[single],1)
+        threshold = rng.rand(len(single))*cumulative[:,-1]
+        children[single,np.minimum(np.sum(cumulative<=threshold[:,None],1),d-1)] = 1
+        #Several samples are split by a sequence of binomial draws
+        several = np.flatnonzero(counts>1)
+        remaining = counts[several]
+        remaining_probability = np.ones(len(several))
+        for j in xrange(d-1):
+            ratio = probability[several,j]/np.maximum(remaining_probability,10**(-300))
+            children[several,j] = rng.binomial(remaining,np.clip(ratio,0,1))
+            remaining = remaining-children[several,j]
+            remaining_probability = remaining_probability-probability[several,j]
+        children[several,d-1] = remaining
+        return children
 
     def distance(self, X, w=None):
         """Compute distance (here KL-divergence) between tensor X and tensor network
         Parameters
         ----------
         X : array-like, shape (d, d, d, d,...) (dimension d^n_features)
-            Tensor to fit
+            or tuple (indices, values) of arrays of shape (nnz, n_features) and (nnz,)
+            Tensor to fit, dense or given by its non-zero entries
         w : parameters of tensor network (optional)
         Returns
         -------
         distance : float
             KL-divergence between tensor X and the tensor network
         """
-        distance=0
         epsilon=10**(-10)
         if w is not None:
             self.w=self._padding_function(w)
         self.norm=self._computenorm()
-        for i in itertools.product(np.arange(0,self.d), repeat = self.n_features):
-            var=np.array(i)
-            b=self._probability(var)/self.norm
-            a=X[tuple(var)]
-            if a<epsilon:
-                distance+=-a*np.log(b)
-            else:
-                distance+=a*np.log(a)-a*np.log(b)
+        indices,a=self._sparse_tensor(X)
+        #Only the non-zero entries of X contribute to the KL-divergence
+        b=self._probability_batch(indices)/self.norm
+        entropy=a[a>=epsilon]
+        distance=np.sum(entropy*np.log(entropy))-np.sum(a*np.log(b))
         return distance
 
+    def _sparse_tensor(self, X):
+        """Non-zero entries of a tensor
+        Parameters
+        ----------
+        X : array-like, shape (d, d, d, d,...) (dimension d^n_features)
+            or tuple (indices, values) of arrays of shape (nnz, n_features) and (nnz,)
+        Returns
+        -------
+        indices : numpy array, shape (nnz, n_features)
+        values : numpy array, shape (nnz,)
+        """
+        if isinstance(X, tuple):
+            return np.asarray(X[0],dtype=np.int64),np.asarray(X[1])
+        X=np.asarray(X)
+        indices=np.argwhere(X!=0)
+        return indices,X[tuple(indices.T)]
+
     def _function_real_to_complex(self, function, X, w=None):
         """Transforming a function of real inputs into a function of complex inputs,
         and returning the result viewed as a real array.
         """
-        derivative=function(X,w.view(self.w.dtype))
-        return derivative.view(np.float64)   
+        derivative=function(X,np.asarray(w,dtype=self.w.real.dtype).view(self.w.dtype))
+        derivative=np.asarray(derivative)
+        return np.asarray(derivative.view(derivative.real.dtype),dtype=np.float64)
 
     def _padding_function(self, w):
         """Reshaping function to add to the input parameters the unused parameters
-        at the boundary conditions.
+        at the boundary conditions and beyond the bond and site dimensions.
         Parameters
         ----------
         w : numpy array, shape (m_parameters2,)
@@ -211,14 +981,21 @@ class TN():
         -------
         w : numpy array, shape (m_parameters,)
         """
-        new_w=np.zeros((self.n_features,self.d,self.D,self.D),dtype=w.dtype)
-        new_w[0,:,0,:]=w[0:self.D*self.d].reshape(self.d,self.D)
-        new_w[1:self.n_features-1,:,:,:]=w[self.D*self.d*2:].reshape((self.n_features-2,self.d,self.D,self.D))
-        new_w[self.n_features-1,:,:,0]=w[self.D*self.d:self.D*self.d*2].reshape(self.d,self.D)
+        if self.homogeneous:
+            return w
+        shapes=self._siteshapes()
+        new_w=np.zeros((self.n_features,)+self._tensorshape(self.D,self.D),dtype=w.dtype)
+        start=0
+        #First and last tensors, then the tensors in between
+        for i in [0,self.n_features-1]+list(xrange(1,self.n_features-1)):
+            size=int(np.prod(shapes[i]))
+            new_w[i][tuple(slice(0,k) for k in shapes[i])]=w[start:start+size].reshape(shapes[i])
+            start+=size
         return new_w.reshape(self.m_parameters)
 
     def _unpadding_function(self, w):
-        """Reshaping function to remove the unused parameters of the boundary conditions.
+        """Reshaping function to remove the unused parameters of the boundary conditions
+        and beyond the bond and site dimensions.
         Parameters
         ----------
         w : numpy array, shape (m_parameters,)
@@ -226,36 +1003,35 @@ class TN():
         -------
         w : numpy array, shape (m_parameters2,)
         """
-        w=w.reshape((self.n_features,self.d,self.D,self.D))
-        new_w=np.zeros(self.m_parameters2,dtype=w.dtype)
-        new_w[0:self.D*self.d]=w[0,:,0,:].reshape(self.d*self.D)
-        new_w[self.D*self.d:self.D*self.d*2]=w[self.n_features-1,:,:,0].reshape(self.d*self.D)
-        new_w[self.D*self.d*2:]=w[1:self.n_features-1,:,:,:].reshape((self.n_features-2)*self.d*self.D*self.D)
-        return new_w
+        if self.homogeneous:
+            return w
+        shapes=self._siteshapes()
+        w=w.reshape((self.n_features,)+self._tensorshape(self.D,self.D))
+        #First and last tensors, then the tensors in between
+        return np.concatenate([w[i][tuple(slice(0,k) for k in shapes[i])].reshape(-1)
+                               for i in [0,self.n_features-1]+list(xrange(1,self.n_features-1))])
         
     def _derivativedistance(self, X, w=None):
         """Compute derivative of the distance (here KL-divergence) between tensor X and MPS
         Parameters
         ----------
         X : array-like, shape (d, d, d, d,...) (dimension d^n_features)
-            Tensor to fit
+            or tuple (indices, values) of arrays of shape (nnz, n_features) and (nnz,)
+            Tensor to fit, dense or given by its non-zero entries
         w : parameters of MPS
         Returns
         -------
         derivative : numpy array, shape (m_parameters2,)
             array of derivatives of the distance function (KL divergence)
         """
-        derivative=np.zeros(self.m_parameters,dtype=w.dtype)
-        
         if w is not None:
             self.w=self._padding_function(w)
             
         self.norm=self._computenorm()
-        Zlogderivative=self._logderivativenorm()
-        for i in itertools.product(np.arange(0,self.d), repeat = self.n_features):
-            var=np.array(i)
-            a=X[tuple(var)]
-            derivative-=a*(self._logderivative(var)-Zlogderivative)
+        indices,a=self._sparse_tensor(X)
+        #Contract X/P against the environments of the non-zero entries
+        derivative=-self._logderivative_batch(indices,np.asarray(a,dtype=self.w.real.dtype))
+        derivative+=np.sum(a)*self._logderivativenorm()
         return self._unpadding_function(derivative)
         
     def _weightinitialization(self,rng):
@@ -264,7 +1040,7 @@ class TN():
         ----------
         rng : random number generator
         """
-        self.w = np.asarray(rng.normal(0, 1, self.m_parameters))
+        self.w = np.asarray(rng.normal(0, 1, self.m_parameters),dtype=self._parametertype())
 
     def _weightinitialization2(self,rng):
         """Initialize weights w randomly
@@ -272,9 +1048,27 @@ class TN():
         ----------
         rng : random number generator
         """
-        self.m_parameters2=(self.n_features-2)*self.d*self.D*self.D+2*self.D*self.d
+        self.m_parameters2=self._numberofparameters(padding=False)
         return np.asarray(rng.rand(self.m_parameters2))
         
+    def _compress(self, X):
+        """Collapse the repeated rows of a dataset
+        Parameters
+        ----------
+        X : numpy array, shape (n_samples, n_features)
+        Returns
+        -------
+        X_unique : numpy array, shape (n_unique, n_features)
+            unique rows of X
+        inverse : numpy array, shape (n_samples,)
+            index in X_unique of each row of X
+        counts : numpy array, shape (n_unique,)
+            number of occurrences of each unique row in X
+        """
+        X_unique, inverse, counts = np.unique(X, axis=0, return_inverse=True,
+                                              return_counts=True)
+        return X_unique, inverse.reshape(-1), counts
+
     def _gen_even_slices(self, batch_size, n_batches, n_samples, rng):
         """Generate batch slices of a dataset
         Parameters
@@ -300,7 +1094,7 @@ class TN():
                 yield array_rand[np.arange(start, end)]
                 start = end
             
-    def fit(self, X, w_init=None):
+    def fit(self, X, w_init=None, compress=False, n_jobs=None, site_dimensions=None):
         """Fit the model to the data X, with parameters initialized at w_init
         Parameters
         ----------
@@ -308,6 +1102,22 @@ class TN():
             Training data.
         w_init : {numpy array, float or complex} shape (m_parameters,) (optional)
             Initial value of the parameters
+        compress : bool, optional
+            If True, repeated rows of X are collapsed into unique rows with
+            counts, and each configuration is contracted once per mini-batch
+            with a weight equal to its number of occurrences. The mini-batches
+            and the updates are the same as without compression.
+        n_jobs : int, optional
+            Number of processes computing the gradient of each mini-batch,
+            -1 for all the processors. Each mini-batch is split in n_jobs
+            shards whose gradients are summed in a fixed order: for a given
+            random_state and n_jobs the result is deterministic.
+        site_dimensions : array-like, shape (n_features,) (optional)
+            Physical dimension of each site, by default the number of categories
+            of each feature of X. The values of a site beyond its dimension have
+            probability 0, give larger dimensions to keep some probability for
+            values that do not appear in X. A homogeneous network gives the
+            largest one to all the sites.
         Returns
         -------
         self : TN
@@ -320,35 +1130,64 @@ class TN():
 
 #       Initialize parameters of MPS
         self.n_samples = X.shape[0]
-        self.n_features = X.shape[1]
-        self.d = np.max(X)+1
-        self.m_parameters = self.n_features*self.d*self.D*self.D
+        d = np.max(X)+1
+        if site_dimensions is not None:
+            d = max(d,np.max(site_dimensions))
+        self._setdimensions(X.shape[1], d)
+        self.site_dimensions = self._sitedimensions(X, site_dimensions)
         if w_init is None:
             self._weightinitialization(rng)
         else:
-            self.w=w_init
+            self.w=np.array(w_init,dtype=self._parametertype())
+        self.log_scales=None
+        if self._singleprecision():
+            self.log_scales=np.zeros(self.n_features)
+            self._rescale()
         self.norm=self._computenorm()
         self.history=[]
+        if compress:
+            X_unique, inverse, counts = self._compress(X)
 
         n_batches = int(np.ceil(float(self.n_samples) / self.batch_size))
-        begin = time.time()
-        for iteration in xrange(1, self.n_iter + 1):
-            batch_slices = list(self._gen_even_slices(self.batch_size,
-                                            n_batches, self.n_samples, rng))
-            for batch_slice in batch_slices:
-                self._fit(X[batch_slice])  
+        if n_jobs is not None and n_jobs != 1:
+            self._start_pool(n_jobs)
+        try:
+            begin = time.time()
+            for iteration in xrange(1, self.n_iter + 1):
+                batch_slices = list(self._gen_even_slices(self.batch_size,
+                                                n_batches, self.n_samples, rng))
+                for batch_slice in batch_slices:
+                    if compress:
+                        rows, batch_counts = np.unique(inverse[batch_slice], return_counts=True)
+                        self._fit(X_unique[rows], batch_counts)
+                    else:
+                        self._fit(X[batch_slice])  
+                self._adaptbonds()
 
-            end = time.time()
+                end = time.time()
                 
             
-            if self.verbose:
-                train_likelihood=self.likelihood(X)
-                print("Iteration %d, likelihood = %.3f,"
-                  " time = %.2fs"
-                  % (iteration,train_likelihood,
-                     end - begin))
-                self.history.append(train_likelihood)
-            begin = end
+                if self.verbose:
+                    if compress:
+                        train_likelihood=self.likelihood(X_unique, sample_weight=counts)
+                    else:
+                        train_likelihood=self.likelihood(X)
+                    print("Iteration %d, likelihood = %.3f,"
+                      " time = %.2fs"
+                      % (iteration,train_likelihood,
+                         end - begin))
+                    self.history.append(train_likelihood)
+                begin = end
+        except BaseException:
+            #Interrupted training does not wait for the pending shards
+            if n_jobs is not None and n_jobs != 1:
+                self._pool.terminate()
+            raise
+        finally:
+            #The workers are stopped and the parameters copied out of the shared
+            #buffer even if training is interrupted
+            if n_jobs is not None and n_jobs != 1:
+                self._stop_pool()
 
         return self
 
@@ -358,7 +1197,10 @@ class TN():
         Parameters
         ----------
         X : {numpy array, non-negative tensor} shape (d, d, d, d,...) (dimension d^n_features)
-            Tensor to be approximated
+            or tuple (indices, values) of arrays of shape (nnz, n_features) and (nnz,)
+            Tensor to be approximated, dense or given by its non-zero entries
+            (each index appearing once). The cost of the fit scales with the
+            number of non-zero entries.
         w_init : {numpy array, float or complex} shape (m_parameters,) (optional)
             Initial value of the parameters
         Returns
@@ -369,21 +1211,28 @@ class TN():
 
 #       Some initial checks of the data, initialize random number generator
         rng = check_random_state(self.random_state)
-        if np.abs(np.sum(X)-1)>10**(-15):
+        if isinstance(X, tuple):
+            indices,values = self._sparse_tensor(X)
+            self._setdimensions(indices.shape[1], np.max(indices)+1)
+            self.site_dimensions = self._sitedimensions(indices)
+        else:
+            self._setdimensions(len(X.shape), np.max(X.shape))
+            indices,values = self._sparse_tensor(X)
+            self.site_dimensions = self._sitedimensions(np.array([X.shape])-1)
+        if np.abs(np.sum(values)-1)>10**(-15):
             print("Input tensor has been normalized")
-            X=X/np.sum(X) #Tensor needs to be normalized to be a probability mass function
+            values=values/np.sum(values) #Tensor needs to be normalized to be a probability mass function
+        X = (indices,values)
         
 #       Initialize parameters of MPS
-        self.d = int(X.shape[1])
-        self.n_features = len(X.shape)
         
         self.n_samples = self.d**self.n_features
-        self.m_parameters = self.n_features*self.d*self.D*self.D
         
         if w_init is None:
             self._weightinitialization(rng)
         else:
-            self.w=w_init
+            self.w=np.array(w_init,dtype=self._parametertype())
+        self.log_scales=None
         self.norm=self._computenorm()
         self.history=[]
 
@@ -397,10 +1246,307 @@ class TN():
         res=minimize(fun=distancepartial,jac=derivativedistancepartial,x0=initial_value.view(np.float64),\
                      method='L-BFGS-B',options={'maxiter': self.n_iter},tol=10**(-16))
 
-        self.w=self._padding_function(res.x.view(self.w.dtype))
+        self.w=self._padding_function(np.asarray(res.x,dtype=self.w.real.dtype).view(self.w.dtype))
         self.norm=self._computenorm()
         
         end = time.time()
         print("KL divergence = %.6f, time = %.2fs" % (self.distance(X),end - begin))
         return self
 
+    def save(self, path):
+        """Save the model in the directory path: the parameters w in w.npy,
+        which load can open as a memory map, and the class, the options of the
+        constructor and the fitted attributes in the JSON header header.json.
+        The training data is not saved.
+        Parameters
+        ----------
+        path : str
+            Directory, created if it does not exist
+        """
+        parameters = {}
+        for name in inspect.signature(self.__init__).parameters:
+            value = getattr(self, name)
+            if name == 'dtype':
+                value = np.dtype(value).name
+            elif isinstance(value, np.generic):
+                value = value.item()
+            elif name == 'random_state' and not isinstance(value, (int, type(None))):
+                value = None
+            parameters[name] = value
+        attributes = {'n_features': int(self.n_features), 'd': int(self.d),
+                      'm_parameters': int(self.m_parameters), 'norm': float(self.norm),
+                      'bond_dimensions': [int(k) for k in self.bond_dimensions],
+                      'site_dimensions': [int(k) for k in self.site_dimensions]}
+        if getattr(self, 'log_scales', None) is not None:
+            attributes['log_scales'] = [float(k) for k in self.log_scales]
+        header = {'format_version': _FORMAT_VERSION, 'class': self.__class__.__name__,
+                  'parameters': parameters, 'attributes': attributes}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 'w.npy'), self.w)
+        with open(os.path.join(path, 'header.json'), 'w') as f:
+            json.dump(header, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='c'):
+        """Load a model saved by save, without computing anything
+        Parameters
+        ----------
+        path : str
+            Directory written by save
+        mmap_mode : {None, 'r', 'r+', 'c'}, optional
+            Memory map mode of the parameters of a non-homogeneous network,
+            see numpy.load. With 'c', they are read lazily from w.npy when the
+            model is used, and modified in memory only, so that the model can be
+            trained further. The parameters of a homogeneous network are read in memory.
+        Returns
+        -------
+        model : TN
+            Instance of the saved class, which must be cls or a subclass of cls
+        """
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+        if header['format_version'] > _FORMAT_VERSION:
+            raise ValueError("Model saved in format version %d, this version reads up to %d"
+                             % (header['format_version'], _FORMAT_VERSION))
+        classes = [cls]
+        for model_class in classes:
+            classes.extend(model_class.__subclasses__())
+        classes = dict((model_class.__name__, model_class) for model_class in classes)
+        if header['class'] not in classes:
+            raise ValueError("Model of class %s, which is not %s or one of its subclasses"
+                             % (header['class'], cls.__name__))
+        parameters = header['parameters']
+        parameters['dtype'] = np.dtype(parameters['dtype'])
+        model = classes[header['class']](**parameters)
+        attributes = header['attributes']
+        model.n_features = attributes['n_features']
+        model.d = attributes['d']
+        model.m_parameters = attributes['m_parameters']
+        model.bond_dimensions = np.array(attributes['bond_dimensions'])
+        model.site_dimensions = np.array(attributes['site_dimensions'])
+        model.log_scales = None
+        if 'log_scales' in attributes:
+            model.log_scales = np.array(attributes['log_scales'])
+        if model.homogeneous:
+            mmap_mode = None
+        model.w = np.load(os.path.join(path, 'w.npy'), mmap_mode=mmap_mode)
+        model.norm = model.w.real.dtype.type(attributes['norm'])
+        model.history = []
+        return model
+
+
+class Born(TN):
+    """Base class of the Born machines RealBorn and ComplexBorn, with the
+    algorithms that only use the tensors of the network: fit_dmrg and the
+    adaptation of the bond dimensions. They are written for complex
+    parameters, the conjugates are no-ops for real parameters.
+    This class should not be used directly. Use derived classes instead.
+    """
+
+    def fit_dmrg(self, X, w_init=None, cutoff=10**(-10), site_dimensions=None):
+        """Fit the model to the data X with a two-site DMRG-like sweeping algorithm,
+        with parameters initialized at w_init
+        The network is kept in mixed canonical form: the tensors on the left of
+        the two sites being updated are left-orthonormal and those on the right
+        are right-orthonormal, so that the norm is the squared norm of the merged
+        two-site tensor and costs O(d^2D^2). Each step merges two neighbouring
+        tensors, makes a gradient descent step of the negative log-likelihood of
+        the dataset on the merged tensor, and splits it back with an SVD keeping
+        at most D singular values. The environments of the samples are updated
+        incrementally as the sweep moves. One iteration is a sweep from left to
+        right and back. The gradient is over the whole dataset and the merged
+        tensor has norm 1, so that learning rates are typically much smaller
+        than for fit.
+        Parameters
+        ----------
+        X : {numpy array, integer matrix} shape (n_samples, n_features)
+            Training data.
+        w_init : {numpy array, float or complex} shape (m_parameters,) (optional)
+            Initial value of the parameters
+        cutoff : float, optional
+            Singular values smaller than cutoff times the largest one are discarded,
+            and with bond_tolerance those beyond the tolerance on the discarded weight
+        site_dimensions : array-like, shape (n_features,) (optional)
+            Physical dimension of each site, as for fit
+        Returns
+        -------
+        self : Born
+            The fitted model.
+        """
+        if self.homogeneous:
+            raise ValueError("fit_dmrg does not preserve homogeneous networks")
+
+#       Some initial checks of the data, initialize random number generator
+        X = check_array(X, dtype=np.int64)
+        rng = check_random_state(self.random_state)
+
+#       Initialize parameters of MPS
+        self.n_samples = X.shape[0]
+        d = np.max(X)+1
+        if site_dimensions is not None:
+            d = max(d,np.max(site_dimensions))
+        self._setdimensions(X.shape[1], d)
+        self.site_dimensions = self._sitedimensions(X, site_dimensions)
+        if w_init is None:
+            self._weightinitialization(rng)
+        else:
+            self.w=np.array(w_init,dtype=self._parametertype())
+        self.log_scales=None
+        self.history=[]
+
+        #Tensors of shape (d, D_left, D_right), with bond dimension 1 at the boundaries
+        w2 = self._cores(self.w)
+        cores = [w2[0][:,0:1,:]]+[w2[i] for i in xrange(1,self.n_features-1)]\
+                +[w2[self.n_features-1][:,:,0:1]]
+        cores = self._rightcanonical(cores)
+
+        #left[i] is the contraction of the tensors before site i for each sample,
+        #right[i] the contraction of the tensors after site i
+        left = [None]*self.n_features
+        right = [None]*self.n_features
+        left[0] = np.ones((self.n_samples,1),dtype=self.w.dtype)
+        right[self.n_features-1] = np.ones((self.n_samples,1),dtype=self.w.dtype)
+        for i in xrange(self.n_features-1,1,-1):
+            right[i-1] = np.matmul(cores[i][X[:,i]],right[i][:,:,None])[:,:,0]
+
+        begin = time.time()
+        for iteration in xrange(1, self.n_iter + 1):
+            for i in xrange(0,self.n_features-2):
+                self._dmrgupdate(X, cores, left[i], right[i+1], i, True, cutoff)
+                left[i+1] = np.matmul(left[i][:,None,:],cores[i][X[:,i]])[:,0,:]
+            for i in xrange(self.n_features-2,0,-1):
+                self._dmrgupdate(X, cores, left[i], right[i+1], i, False, cutoff)
+                right[i] = np.matmul(cores[i+1][X[:,i+1]],right[i+1][:,:,None])[:,:,0]
+            self.w = self._dmrgparameters(cores)
+            self.bond_dimensions = np.array([cores[i].shape[2] for i in xrange(self.n_features-1)])
+
+            end = time.time()
+            if self.verbose:
+                train_likelihood=self.likelihood(X)
+                print("Iteration %d, likelihood = %.3f,"
+                  " time = %.2fs"
+                  % (iteration,train_likelihood,
+                     end - begin))
+                self.history.append(train_likelihood)
+            begin = end
+        self.norm = self._computenorm()
+
+        return self
+
+    def _rightcanonical(self, cores):
+        """Bring a list of tensors of shape (d, D_left, D_right) to right canonical form,
+        sum_j A[j] A[j]^H = 1 (A[j]^T for real parameters) for all tensors but
+        the first, which is normalized
+        Parameters
+        ----------
+        cores : list of numpy arrays
+        Returns
+        -------
+        cores : list of numpy arrays
+        """
+        cores = list(cores)
+        for i in xrange(self.n_features-1,0,-1):
+            d, Dl, Dr = cores[i].shape
+            #QR decomposition of the transpose, A = R^T Q^T with Q^T having orthonormal rows
+            q, r = np.linalg.qr(cores[i].transpose(1,0,2).reshape(Dl,d*Dr).T)
+            cores[i] = q.T.reshape(q.shape[1],d,Dr).transpose(1,0,2)
+            cores[i-1] = np.tensordot(cores[i-1],r.T,axes=([2],[0]))
+        cores[0] = cores[0]/np.linalg.norm(cores[0])
+        return cores
+
+    def _dmrgupdate(self, X, cores, left, right, i, sweep_right, cutoff):
+        """Gradient descent step on the two-site tensor of sites i and i+1 and truncated
+        SVD splitting, moving the orthogonality center to site i+1 if sweep_right and
+        to site i otherwise. Updates cores in place.
+        Parameters
+        ----------
+        X : numpy array, shape (n_samples, n_features)
+            Configurations
+        cores : list of numpy arrays
+            Tensors in mixed canonical form with orthogonality center at site i or i+1
+        left : numpy array, shape (n_samples, D_left)
+            Contraction of the tensors before site i for each sample
+        right : numpy array, shape (n_samples, D_right)
+            Contraction of the tensors after site i+1 for each sample
+        i : int
+        sweep_right : bool
+        cutoff : float
+        """
+        n_samples = X.shape[0]
+        d1, Dl = cores[i].shape[0], cores[i].shape[1]
+        d2, Dr = cores[i+1].shape[0], cores[i+1].shape[2]
+        #Two-site tensor, shape (d_i, d_i+1, D_left, D_right)
+        B = np.tensordot(cores[i],cores[i+1],axes=([2],[1])).transpose(0,2,1,3)
+
+        #psi(x) = left B[x_i,x_i+1] right, and the norm is the squared norm of B
+        env = left[:,:,None]*right[:,None,:]
+        mpscontracted = np.sum(B[X[:,i],X[:,i+1]]*env,(1,2))
+        norm = np.sum(np.square(np.abs(B)))
+        derivative = 2*B/norm
+        np.add.at(derivative,(X[:,i],X[:,i+1]),
+                  -2*np.conj(env/mpscontracted[:,None,None])/n_samples)
+        B = B - self.learning_rate*derivative
+
+        #Truncated SVD of B, the kept singular values are normalized to keep norm 1
+        u, s, v = np.linalg.svd(B.transpose(2,0,1,3).reshape(Dl*d1,d2*Dr),
+                                full_matrices=False)
+        k = max(1,min(self.D,np.sum(s>cutoff*s[0])))
+        if self.bond_tolerance is not None:
+            k = min(k,self._truncationrank(s,self.bond_tolerance))
+        u, s, v = u[:,:k], s[:k]/np.linalg.norm(s[:k]), v[:k,:]
+        if sweep_right:
+            v = s[:,None]*v
+        else:
+            u = u*s
+        cores[i] = u.reshape(Dl,d1,k).transpose(1,0,2)
+        cores[i+1] = v.reshape(k,d2,Dr).transpose(1,0,2)
+
+    def _adaptbonds(self):
+        """Adapt the bond dimensions with a sweep of SVDs from the left on the
+        right canonical form of the network, where the singular values of each
+        bond are its Schmidt coefficients. Each bond is truncated to the
+        tolerance bond_tolerance on its discarded weight, or grown by one where
+        nothing can be discarded. A grown bond carries a zero singular value:
+        the distribution is unchanged, and the gradient in the new dimension is
+        not zero. The tensors are then rescaled to their norms before the sweep,
+        which leaves the distribution unchanged and keeps the scale of the
+        gradient steps of fit.
+        """
+        if self.bond_tolerance is None:
+            return
+        w2 = self._cores(self.w)
+        left, right = self._bonddimensions()
+        cores = [w2[i][:,:left[i],:right[i]] for i in xrange(self.n_features)]
+        norms = [np.linalg.norm(core) for core in cores]
+        cores = self._rightcanonical(cores)
+        for i in xrange(self.n_features-1):
+            d, Dl, Dr = cores[i].shape
+            u, s, v = np.linalg.svd(cores[i].transpose(1,0,2).reshape(Dl*d,Dr))
+            k = self._truncationrank(s,self.bond_tolerance)
+            if k == Dr and k < min(self.D,Dl*d,cores[i+1].shape[0]*cores[i+1].shape[2]):
+                k += 1
+            r = min(k,len(s))
+            sv = np.zeros((k,Dr),dtype=v.dtype)
+            sv[:r] = s[:r,None]*v[:r]
+            cores[i] = u[:,:k].reshape(Dl,d,k).transpose(1,0,2)
+            cores[i+1] = np.tensordot(sv,cores[i+1],axes=([1],[1])).transpose(1,0,2)
+        cores = [core*norm/np.linalg.norm(core) for core,norm in zip(cores,norms)]
+        self.w = self._dmrgparameters(cores)
+        self.bond_dimensions = np.array([cores[i].shape[2] for i in xrange(self.n_features-1)])
+        self.norm = self._computenorm()
+
+    def _dmrgparameters(self, cores):
+        """Parameters w of a list of tensors of site dimensions at most d and
+        bond dimensions at most D, padded with zeros
+        Parameters
+        ----------
+        cores : list of numpy arrays
+        Returns
+        -------
+        w : numpy array, shape (m_parameters,)
+        """
+        w = np.zeros((self.n_features,self.d,self.D,self.D),dtype=self.w.dtype)
+        for i in xrange(self.n_features):
+            w[i,:cores[i].shape[0],:cores[i].shape[1],:cores[i].shape[2]] = cores[i]
+        return w.reshape(self.m_parameters)
@@ -24,6 +24,16 @@ class PositiveMPS(TN):
         seed. Defaults to the global numpy random number generator.
     verbose : int, optional
         The verbosity level. The default, zero, means silent mode.
+    prefix_trie : bool, optional
+        If True, batches are contracted over their prefix trie: each distinct
+        prefix of the configurations is contracted once.
+    homogeneous : bool, optional
+        If True, all the sites between the first and the last share the same
+        tensor (translation invariant network).
+    dtype : numpy dtype, optional
+        Type of the parameters and of all the contractions, np.float64 or
+        np.float32. In single precision, fit keeps the tensor of each site
+        rescaled so that the contractions of the norm are of order one.
     ----------
     Attributes
     ----------
@@ -39,17 +49,24 @@ class PositiveMPS(TN):
         physical dimension (dimension of the features)
     m_parameters : int
         number of parameters in the network
+    log_scales : numpy array, shape (n_features,) or None
+        In single precision, logarithm of the factor removed from the tensor
+        of each site by the rescaling of fit, None otherwise
     history : list
         saves the training accuracies during training
     """
     def __init__(self, D=4, learning_rate=0.1, batch_size=10,
-                 n_iter=100, random_state=None, verbose=False):
+                 n_iter=100, random_state=None, verbose=False, prefix_trie=False,
+                 homogeneous=False, dtype=np.float64):
         self.D = D
         self.learning_rate = float(learning_rate)
         self.batch_size = batch_size
         self.n_iter = n_iter
         self.random_state = random_state
         self.verbose = verbose
+        self.prefix_trie = prefix_trie
+        self.homogeneous = homogeneous
+        self.dtype = dtype
         
     def _probability(self, x):
         """Unnormalized probability of one configuration P(x)
@@ -61,13 +78,40 @@ class PositiveMPS(TN):
         -------
         probability : float
         """
-        w2 = np.reshape(self.w,(self.n_features,self.d,self.D,self.D))
-        tmp = np.square(w2[0,x[0],0,:]) #First tensor
+        x, valid = self._sitevalues(x)
+        w2 = self._cores(self.w)
+        tmp = np.square(w2[0][x[0],0,:]) #First tensor
         for i in xrange(1,self.n_features-1):
-            tmp = np.dot(tmp,np.square(w2[i,x[i],:,:])) #MPS contraction  
-        probability = np.inner(tmp,np.square(w2[self.n_features-1,
+            tmp = np.dot(tmp,np.square(w2[i][x[i],:,:])) #MPS contraction  
+        probability = np.inner(tmp,np.square(w2[self.n_features-1][
                                                 x[self.n_features-1],:,0]))
-        return probability
+        return probability*valid
+
+    def _probability_batch(self, X):
+        """Unnormalized probabilities of a batch of configurations P(x)
+        Parameters
+        ----------
+        X : numpy array, shape (n_samples, n_features)
+            Configurations
+        Returns
+        -------
+        probability : numpy array, shape (n_samples,)
+        """
+        X, valid = self._sitevalues(X)
+        w2 = [np.square(core) for core in self._cores(self.w)]
+        if self.prefix_trie:
+            #Contract each distinct prefix once, one row per node of the trie
+            parents, symbols, nodes = self._prefixtrie(X)
+            tmp = w2[0][symbols[0],0,:]
+            for i in xrange(1,self.n_features-1):
+                tmp = np.matmul(tmp[parents[i],None,:],w2[i][symbols[i],:,:])[:,0,:]
+            tmp = tmp[nodes[self.n_features-2]]
+        else:
+            tmp = w2[0][X[:,0],0,:] #First tensor, one row per sample
+            for i in xrange(1,self.n_features-1):
+                tmp = np.matmul(tmp[:,None,:],w2[i][X[:,i],:,:])[:,0,:] #Batched MPS contraction
+        probability = np.sum(tmp*w2[self.n_features-1][X[:,self.n_features-1],:,0],1)
+        return probability*valid
 
     def _computenorm(self):
         """Compute norm of probability distribution
@@ -75,13 +119,113 @@ class PositiveMPS(TN):
         -------
         norm : float
         """
-        w2 = np.reshape(self.w,(self.n_features,self.d,self.D,self.D))
-        tmp = np.sum(np.square(w2[0,:,0,:]),0) #First tensor
-        for i in xrange(1,self.n_features-1):
-            tmp = np.dot(tmp,np.sum(np.square(w2[i,:,:,:]),0)) #MPS contraction  
-        norm = np.inner(tmp,np.sum(np.square(w2[self.n_features-1,:,:,0]),0))
+        if self._squaringcheaper(self.D,self.d*self.D*self.D):
+            w2 = self._cores(self.w)
+            return np.exp(self._lognormsquaring(np.sum(np.square(w2[0][:,0,:]),0),
+                            np.sum(np.square(w2[1]),0),
+                            np.sum(np.square(w2[self.n_features-1][:,:,0]),0)))
+        tmp = self._leftenvironments()
+        norm = tmp[self.n_features-1,0]
         return norm
+
+    def _computeleftenvironments(self):
+        """Compute the contractions of the norm from the left boundary
+        Returns
+        -------
+        tmp : numpy array, shape (n_features, D)
+        """
+        w2 = self._cores(self.w)
+        tmp=np.zeros((self.n_features,self.D),dtype=self.w.dtype)
+        tmp[0,:]=np.sum(np.square(w2[0][:,0,:]),0) #First tensor
+        for i in xrange(1,self.n_features-1):
+            tmp[i,:]=np.dot(tmp[i-1,:],np.sum(np.square(w2[i]),0)) #MPS contraction
+        tmp[self.n_features-1,:]=np.inner(tmp[self.n_features-2,:],
+                np.sum(np.square(w2[self.n_features-1][:,:,0]),0))
+        return tmp
+
+    def _computerightenvironments(self):
+        """Compute the contractions of the norm from the right boundary
+        Returns
+        -------
+        tmp2 : numpy array, shape (n_features, D)
+        """
+        w2 = self._cores(self.w)
+        tmp2=np.zeros((self.n_features,self.D),dtype=self.w.dtype)
+        tmp2[self.n_features-1,:]=np.sum(np.square(w2[self.n_features-1][:,:,0]),0)
+        for i in xrange(self.n_features-2,0,-1):
+            tmp2[i,:]=np.dot(np.sum(np.square(w2[i]),0),tmp2[i+1,:])
+        tmp2[0,:]=np.inner(np.sum(np.square(w2[0][:,0,:]),0),tmp2[1,:])
+        return tmp2
         
+    def _conditionalprobability(self, left, i, tmp2):
+        """Unnormalized probabilities of the values of x[i] given x[:i], for sampling
+        Parameters
+        ----------
+        left : numpy array, shape (n_samples, D) or None if i=0
+            Contraction of the tensors before site i at x[:i], up to a factor
+        i : int
+            Site
+        tmp2 : numpy array, shape (n_features, D)
+            Right environments of the norm
+        Returns
+        -------
+        probability : numpy array, shape (n_samples, d) or (1, d) if i=0
+        """
+        w2 = self._cores(self.w)
+        if i == self.n_features-1:
+            weights = np.square(w2[i][:,:,0])
+        else:
+            weights = np.dot(np.square(w2[i]),tmp2[i+1])
+        if left is None:
+            return weights[None,:,0]
+        return np.dot(left,weights.T)
+
+    def _maskedtransfer(self, left, i, mask):
+        """Contraction of the left contraction of the norm with the tensor of site i
+        summed over the allowed values of site i only
+        Parameters
+        ----------
+        left : numpy array, shape (n_queries, D) or None if i=0
+            Contraction of the norm before site i for each evidence pattern
+        i : int
+            Site
+        mask : numpy array of bool, shape (n_queries, d)
+            Allowed values of site i for each evidence pattern
+        Returns
+        -------
+        left : numpy array, shape (n_queries, D)
+        """
+        w2 = self._cores(self.w)
+        if left is None:
+            return np.dot(mask,np.square(w2[0][:,0,:]))
+        newleft = np.zeros((left.shape[0],w2[i].shape[2]),dtype=self.w.dtype)
+        for j in xrange(len(w2[i])):
+            newleft += mask[:,j,None]*np.dot(left,np.square(w2[i][j]))
+        return newleft
+
+    def _leftstate(self, left, i, x):
+        """Contraction of the tensors up to site i at x[:i+1], for sampling
+        Parameters
+        ----------
+        left : numpy array, shape (n_samples, D) or None if i=0
+            Contraction of the tensors before site i at x[:i]
+        i : int
+            Site
+        x : numpy array, shape (n_samples,)
+            Values of x[i]
+        Returns
+        -------
+        left : numpy array, shape (n_samples, D)
+        """
+        w2 = self._cores(self.w)
+        if left is None:
+            return np.square(w2[0][x,0,:])
+        newleft = np.zeros(left.shape,dtype=self.w.dtype)
+        for j in xrange(len(w2[i])):
+            mask = (x==j)
+            newleft[mask] = np.dot(left[mask],np.square(w2[i][j]))
+        return newleft
+
     def _derivative(self, x):
         """Compute the derivative of P(x)
         Parameters
@@ -92,37 +236,92 @@ class PositiveMPS(TN):
         -------
         derivative : numpy array, shape (m_parameters,)
         """
-        w2 = np.reshape(self.w,(self.n_features,self.d,self.D,self.D))
-        derivative = np.zeros((self.n_features,self.d,self.D,self.D))
+        w2 = self._cores(self.w)
+        derivative = np.zeros(self.m_parameters,dtype=self.w.dtype)
+        dw2 = self._cores(derivative)
 
         #Store intermediate tensor contractions for the derivatives: 
         #left to right and right to left
         #tmp stores the contraction of the first i+1 tensors from the left 
         #in tmp[i,:,:], tmp2 the remaining tensors on the right
         #the mps contracted is the remaining contraction tmp[i-1]w[i]tmp2[i+1]
-        tmp = np.zeros((self.n_features,self.D))
-        tmp2 = np.zeros((self.n_features,self.D))
-        tmp[0,:] = np.square(w2[0,x[0],0,:])
+        tmp = np.zeros((self.n_features,self.D),dtype=self.w.dtype)
+        tmp2 = np.zeros((self.n_features,self.D),dtype=self.w.dtype)
+        tmp[0,:] = np.square(w2[0][x[0],0,:])
         for i in xrange(1,self.n_features-1):
-            tmp[i,:] = np.dot(tmp[i-1,:],np.square(w2[i,x[i],:,:]))  
+            tmp[i,:] = np.dot(tmp[i-1,:],np.square(w2[i][x[i],:,:]))  
         tmp[self.n_features-1,:] = np.inner(tmp[self.n_features-2,:],
-                np.square(w2[self.n_features-1,x[self.n_features-1],:,0]))
-        tmp2[self.n_features-1,:] = np.square(w2[self.n_features-1,
+                np.square(w2[self.n_features-1][x[self.n_features-1],:,0]))
+        tmp2[self.n_features-1,:] = np.square(w2[self.n_features-1][
                 x[self.n_features-1],:,0])
-        for i in xrange(self.n_features-2,-1,-1):
-            tmp2[i,:] = np.dot(np.square(w2[i,x[i],:]),tmp2[i+1,:])
-        tmp2[0,:] = np.inner(np.square(w2[0,x[0],0,:]),tmp2[1,:])
+        for i in xrange(self.n_features-2,0,-1):
+            tmp2[i,:] = np.dot(np.square(w2[i][x[i],:]),tmp2[i+1,:])
+        tmp2[0,:] = np.inner(np.square(w2[0][x[0],0,:]),tmp2[1,:])
     
         #The derivative of each tensor is the contraction of the other tensors
-        derivative[0,x[0],0,:] = np.multiply(tmp2[1,:],2*(w2[0,x[0],0,:]))
-        derivative[self.n_features-1,x[self.n_features-1],:,0] = \
+        dw2[0][x[0],0,:] += np.multiply(tmp2[1,:],2*(w2[0][x[0],0,:]))
+        dw2[self.n_features-1][x[self.n_features-1],:,0] += \
                     np.multiply(tmp[self.n_features-2,:],
-                        2*(w2[self.n_features-1,x[self.n_features-1],:,0]))
+                        2*(w2[self.n_features-1][x[self.n_features-1],:,0]))
         for i in xrange(1,self.n_features-1):
-                derivative[i,x[i],:,:]=np.multiply(np.outer(tmp[i-1,:],
-                tmp2[i+1,:]),2*(w2[i,x[i],:]))
+                dw2[i][x[i],:,:]+=np.multiply(np.outer(tmp[i-1,:],
+                tmp2[i+1,:]),2*(w2[i][x[i],:]))
 
-        return derivative.reshape(self.m_parameters)
+        return derivative
+
+    def _logderivative_batch(self, X, weights=None):
+        """Compute the sum of the logderivatives of P(x) over a batch of configurations
+        Parameters
+        ----------
+        X : numpy array, shape (n_samples, n_features)
+            Configurations
+        weights : numpy array, shape (n_samples,) (optional)
+            Weight of each configuration in the sum
+        Returns
+        -------
+        derivative : numpy array, shape (m_parameters,)
+        """
+        w2 = self._cores(self.w)
+        w2sq = [np.square(core) for core in w2]
+        n_samples = X.shape[0]
+        derivative = np.zeros(self.m_parameters,dtype=self.w.dtype)
+        dw2 = self._cores(derivative)
+
+        #Left and right environments of the whole batch, in one sweep each:
+        #tmp[i,b,:] is the contraction of the first i+1 tensors for sample b,
+        #tmp2[i,b,:] the contraction of the tensors i to n_features-1
+        tmp = np.zeros((self.n_features,n_samples,self.D),dtype=self.w.dtype)
+        tmp2 = np.zeros((self.n_features,n_samples,self.D),dtype=self.w.dtype)
+        if self.prefix_trie:
+            #Left environments of the distinct prefixes, read off for each sample
+            parents, symbols, nodes = self._prefixtrie(X)
+            env = w2sq[0][symbols[0],0,:]
+            tmp[0] = env[nodes[0]]
+            for i in xrange(1,self.n_features-1):
+                env = np.matmul(env[parents[i],None,:],w2sq[i][symbols[i],:,:])[:,0,:]
+                tmp[i] = env[nodes[i]]
+        else:
+            tmp[0] = w2sq[0][X[:,0],0,:]
+            for i in xrange(1,self.n_features-1):
+                tmp[i] = np.matmul(tmp[i-1,:,None,:],w2sq[i][X[:,i],:,:])[:,0,:]
+        tmp2[self.n_features-1] = w2sq[self.n_features-1][X[:,self.n_features-1],:,0]
+        for i in xrange(self.n_features-2,0,-1):
+            tmp2[i] = np.matmul(w2sq[i][X[:,i],:,:],tmp2[i+1,:,:,None])[:,:,0]
+        probability = np.sum(tmp[self.n_features-2]*tmp2[self.n_features-1],1)
+
+        #Each sample only touches one slice per tensor: scatter-add its
+        #environments divided by P(x), then apply the chain rule of the square
+        ratio = 1/probability
+        if weights is not None:
+            ratio = weights*ratio
+        np.add.at(dw2[0][:,0,:],X[:,0],tmp2[1]*ratio[:,None])
+        np.add.at(dw2[self.n_features-1][:,:,0],X[:,self.n_features-1],
+                  tmp[self.n_features-2]*ratio[:,None])
+        for i in xrange(1,self.n_features-1):
+            np.add.at(dw2[i],X[:,i],tmp[i-1,:,:,None]*tmp2[i+1,:,None,:]
+                      *ratio[:,None,None])
+        derivative *= 2*self.w
+        return derivative
 
     def _derivativenorm(self):
         """Compute the derivative of the norm
@@ -130,28 +329,21 @@ class PositiveMPS(TN):
         -------
         derivative : numpy array, shape (m_parameters,)
         """
-        w2 = np.reshape(self.w,(self.n_features,self.d,self.D,self.D))
-        derivative = np.zeros((self.n_features,self.d,self.D,self.D)) 
+        w2 = self._cores(self.w)
+        derivative = np.zeros(self.m_parameters,dtype=self.w.dtype)
+        dw2 = self._cores(derivative)
         
-        tmp=np.zeros((self.n_features,self.D))
-        tmp2=np.zeros((self.n_features,self.D))
-        tmp[0,:]=np.sum(np.square(w2[0,:,0,:]),0)
-        for i in xrange(1,self.n_features-1):
-            tmp[i,:]=np.dot(tmp[i-1,:],np.sum(np.square(w2[i,:,:,:]),0)) 
-        tmp[self.n_features-1,:]=np.inner(tmp[self.n_features-2,:],
-                np.sum(np.square(w2[self.n_features-1,:,:,0]),0))
-        tmp2[self.n_features-1,:]=np.sum(np.square(w2[self.n_features-1,:,:,0]),0)
-        for i in xrange(self.n_features-2,-1,-1):
-            tmp2[i,:]=np.dot(np.sum(np.square(w2[i,:,:,:]),0),tmp2[i+1,:])
-        tmp2[0,:]=np.inner(np.sum(np.square(w2[0,:,0,:]),0),tmp2[1,:])
+        tmp=self._leftenvironments()
+        tmp2=self._rightenvironments()
     
-        for j in xrange(self.d):
-            derivative[0,j,0,:]=np.multiply(tmp2[1,:],2*(w2[0,j,0,:]))
-            derivative[self.n_features-1,j,:,0]=\
-                np.multiply(tmp[self.n_features-2,:],2*(w2[self.n_features-1,j,:,0]))
+        for j in xrange(len(w2[0])):
+            dw2[0][j,0,:]+=np.multiply(tmp2[1,:],2*(w2[0][j,0,:]))
+        for j in xrange(len(w2[self.n_features-1])):
+            dw2[self.n_features-1][j,:,0]+=\
+                np.multiply(tmp[self.n_features-2,:],2*(w2[self.n_features-1][j,:,0]))
         for i in xrange(1,self.n_features-1):
             temp3=np.outer(tmp[i-1,:],tmp2[i+1,:])
-            for j in xrange(self.d):
-                derivative[i,j,:,:]=np.multiply(temp3,2*(w2[i,j,:,:]))
-        return derivative.reshape(self.m_parameters)
+            for j in xrange(len(w2[i])):
+                dw2[i][j,:,:]+=np.multiply(temp3,2*(w2[i][j,:,:]))
+        return derivative
 
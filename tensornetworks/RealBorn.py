@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 
-from .MPSClass import TN
+from .MPSClass import Born
 import numpy as np
 from sklearn.externals.six.moves import xrange
 
-class RealBorn(TN):
+class RealBorn(Born):
     """Born machine with real parameters
     Probability is the square of the MPS
     Parameters
@@ -24,6 +24,27 @@ class RealBorn(TN):
         seed. Defaults to the global numpy random number generator.
     verbose : int, optional
         The verbosity level. The default, zero, means silent mode.
+    prefix_trie : bool, optional
+        If True, batches are contracted over their prefix trie: each distinct
+        prefix of the configurations is contracted once.
+    homogeneous : bool, optional
+        If True, all the sites between the first and the last share the same
+        tensor (translation invariant network).
+    bond_tolerance : float, optional
+        If not None, the bond dimensions are adapted during training: after
+        each iteration of fit and at each step of fit_dmrg, each bond is
+        truncated to the fewest singular values whose discarded weight (the
+        fraction of the squared singular values discarded) is at most
+        bond_tolerance. In fit, bonds where nothing can be discarded grow by
+        one, up to D. Not available for homogeneous networks. The parameters
+        keep their layout of width D with zeros beyond the bond dimensions, so
+        that m_parameters, the memory and the cost of the contractions do not
+        decrease: _numberofparameters(padding=False) counts the parameters
+        within the bond dimensions.
+    dtype : numpy dtype, optional
+        Type of the parameters and of all the contractions, np.float64 or
+        np.float32. In single precision, fit keeps the tensor of each site
+        rescaled so that the contractions of the norm are of order one.
     ----------
     Attributes
     ----------
@@ -39,17 +60,29 @@ class RealBorn(TN):
         physical dimension (dimension of the features)
     m_parameters : int
         number of parameters in the network
+    bond_dimensions : numpy array, shape (n_features-1,)
+        dimension of the bond between each site and the next one
+    log_scales : numpy array, shape (n_features,) or None
+        In single precision, logarithm of the factor removed from the tensor
+        of each site by the rescaling of fit, None otherwise
     history : list
         saves the training accuracies during training
     """
     def __init__(self, D=4, learning_rate=0.1, batch_size=10,
-                 n_iter=100, random_state=None, verbose=False):
+                 n_iter=100, random_state=None, verbose=False, prefix_trie=False,
+                 homogeneous=False, bond_tolerance=None, dtype=np.float64):
         self.D = D
         self.learning_rate = float(learning_rate)
         self.batch_size = batch_size
         self.n_iter = n_iter
         self.random_state = random_state
         self.verbose = verbose
+        self.prefix_trie = prefix_trie
+        self.homogeneous = homogeneous
+        self.dtype = dtype
+        self.bond_tolerance = bond_tolerance
+        if homogeneous and bond_tolerance is not None:
+            raise ValueError("Bond dimensions are not adapted for homogeneous networks")
         
     def _probability(self, x):
         """Unnormalized probability of one configuration P(x)
@@ -61,14 +94,42 @@ class RealBorn(TN):
         -------
         probability : float
         """
-        w2 = np.reshape(self.w,(self.n_features,self.d,self.D,self.D))
+        x, valid = self._sitevalues(x)
+        w2 = self._cores(self.w)
         
-        tmp = w2[0,x[0],0,:] #First tensor
+        tmp = w2[0][x[0],0,:] #First tensor
         for i in xrange(1,self.n_features-1):
-            tmp = np.dot(tmp,w2[i,x[i],:,:]) #MPS contraction  
+            tmp = np.dot(tmp,w2[i][x[i],:,:]) #MPS contraction  
         probability = np.inner(tmp,
-                        w2[self.n_features-1,x[self.n_features-1],:,0])**2
-        return probability      
+                        w2[self.n_features-1][x[self.n_features-1],:,0])**2
+        return probability*valid
+
+    def _probability_batch(self, X):
+        """Unnormalized probabilities of a batch of configurations P(x)
+        Parameters
+        ----------
+        X : numpy array, shape (n_samples, n_features)
+            Configurations
+        Returns
+        -------
+        probability : numpy array, shape (n_samples,)
+        """
+        X, valid = self._sitevalues(X)
+        w2 = self._cores(self.w)
+
+        if self.prefix_trie:
+            #Contract each distinct prefix once, one row per node of the trie
+            parents, symbols, nodes = self._prefixtrie(X)
+            tmp = w2[0][symbols[0],0,:]
+            for i in xrange(1,self.n_features-1):
+                tmp = np.matmul(tmp[parents[i],None,:],w2[i][symbols[i],:,:])[:,0,:]
+            tmp = tmp[nodes[self.n_features-2]]
+        else:
+            tmp = w2[0][X[:,0],0,:] #First tensor, one row per sample
+            for i in xrange(1,self.n_features-1):
+                tmp = np.matmul(tmp[:,None,:],w2[i][X[:,i],:,:])[:,0,:] #Batched MPS contraction
+        probability = np.sum(tmp*w2[self.n_features-1][X[:,self.n_features-1],:,0],1)**2
+        return probability*valid
 
     def _computenorm(self):
         """Compute norm of probability distribution
@@ -76,15 +137,130 @@ class RealBorn(TN):
         -------
         norm : float
         """
-        w2 = np.reshape(self.w,(self.n_features,self.d,self.D,self.D))
-        tmp = np.tensordot(w2[0,:,0,:],w2[0,:,0,:],axes=([0],[0])).reshape(self.D*self.D) #First tensor
-        for i in xrange(1,self.n_features-1):
-            tmp = np.dot(tmp,np.tensordot(w2[i,:,:,:],w2[i,:,:,:],
-                    axes=([0],[0])).transpose((0,2,1,3)).reshape(self.D*self.D,self.D*self.D)) #MPS contraction  
-        norm = np.inner(tmp,np.tensordot(w2[self.n_features-1,:,:,0],
-                        w2[self.n_features-1,:,:,0],axes=([0],[0])).reshape(self.D*self.D))
+        if self._squaringcheaper(self.D*self.D,2*self.d*self.D**3):
+            w2 = self._cores(self.w)
+            left = np.tensordot(w2[0][:,0,:],w2[0][:,0,:],axes=([0],[0])).reshape(self.D*self.D)
+            transfer = np.tensordot(w2[1],w2[1],axes=([0],[0])).transpose(0,2,1,3)\
+                        .reshape(self.D*self.D,self.D*self.D)
+            right = np.tensordot(w2[self.n_features-1][:,:,0],w2[self.n_features-1][:,:,0],
+                        axes=([0],[0])).reshape(self.D*self.D)
+            return np.exp(self._lognormsquaring(left,transfer,right))
+        tmp = self._leftenvironments()
+        norm = tmp[self.n_features-1,0]
         return norm
 
+    def _computeleftenvironments(self):
+        """Compute the contractions of the norm from the left boundary
+        Returns
+        -------
+        tmp : numpy array, shape (n_features, D*D)
+        """
+        w2=self._cores(self.w)
+        tmp=np.zeros((self.n_features,self.D*self.D),dtype=self.w.dtype)
+        tmp[0,:]=np.tensordot(w2[0][:,0,:],w2[0][:,0,:],axes=([0],[0])).reshape(self.D*self.D)
+        for i in xrange(1,self.n_features-1):
+            #Environment matrix times core times core, sum_j w[j]^T E w[j], in O(dD^3)
+            temp1=np.matmul(tmp[i-1,:].reshape(self.D,self.D),w2[i])
+            tmp[i,:]=np.tensordot(w2[i],temp1,axes=([0,1],[0,1])).reshape(self.D*self.D)
+        tmp[self.n_features-1,:]=np.inner(tmp[self.n_features-2,:],
+            np.tensordot(w2[self.n_features-1][:,:,0],w2[self.n_features-1][:,:,0],axes=([0],[0])).reshape(self.D*self.D))
+        return tmp
+
+    def _computerightenvironments(self):
+        """Compute the contractions of the norm from the right boundary
+        Returns
+        -------
+        tmp2 : numpy array, shape (n_features, D*D)
+        """
+        w2=self._cores(self.w)
+        tmp2=np.zeros((self.n_features,self.D*self.D),dtype=self.w.dtype)
+        tmp2[self.n_features-1,:]=np.tensordot(w2[self.n_features-1][:,:,0],
+            w2[self.n_features-1][:,:,0],axes=([0],[0])).reshape(self.D*self.D)
+        for i in xrange(self.n_features-2,0,-1):
+            #Core times environment matrix times core, sum_j w[j] E w[j]^T, in O(dD^3)
+            temp2=np.matmul(w2[i],tmp2[i+1,:].reshape(self.D,self.D))
+            tmp2[i,:]=np.tensordot(temp2,w2[i],axes=([0,2],[0,2])).reshape(self.D*self.D)
+        tmp2[0,:]=np.inner(np.tensordot(w2[0][:,0,:],w2[0][:,0,:],
+                axes=([0],[0])).reshape(self.D*self.D),tmp2[1,:])
+        return tmp2
+
+    def _conditionalprobability(self, left, i, tmp2):
+        """Unnormalized probabilities of the values of x[i] given x[:i], for sampling
+        Parameters
+        ----------
+        left : numpy array, shape (n_samples, D) or None if i=0
+            Contraction of the tensors before site i at x[:i], up to a factor
+        i : int
+            Site
+        tmp2 : numpy array, shape (n_features, D*D)
+            Right environments of the norm
+        Returns
+        -------
+        probability : numpy array, shape (n_samples, d) or (1, d) if i=0
+        """
+        w2 = self._cores(self.w)
+        core = w2[i]
+        if i == self.n_features-1:
+            core = core[:,:,0:1]
+            right = np.ones((1,1),dtype=self.w.dtype)
+        else:
+            right = tmp2[i+1].reshape(self.D,self.D)
+        #weights[j] = w[j] right w[j]^T
+        weights = np.matmul(np.matmul(core,right),core.transpose(0,2,1))
+        if left is None:
+            return weights[None,:,0,0]
+        return np.sum(np.matmul(weights,left.T).transpose(2,0,1)*left[:,None,:],2)
+
+    def _maskedtransfer(self, left, i, mask):
+        """Contraction of the left contraction of the norm with the tensor of site i
+        and its conjugate, summed over the allowed values of site i only
+        Parameters
+        ----------
+        left : numpy array, shape (n_queries, D*D) or None if i=0
+            Contraction of the norm before site i for each evidence pattern
+        i : int
+            Site
+        mask : numpy array of bool, shape (n_queries, d)
+            Allowed values of site i for each evidence pattern
+        Returns
+        -------
+        left : numpy array, shape (n_queries, D*D)
+        """
+        w2 = self._cores(self.w)
+        n_queries = mask.shape[0]
+        if left is None:
+            core = w2[0][:,0,:]
+            return np.dot(mask,(core[:,:,None]*core[:,None,:]).reshape(len(core),-1))
+        left = left.reshape(n_queries,self.D,self.D)
+        newleft = 0
+        for j in xrange(len(w2[i])):
+            #w[j]^T E w[j] for each evidence pattern
+            newleft = newleft+mask[:,j,None,None]*np.matmul(np.matmul(w2[i][j].T,left),w2[i][j])
+        return newleft.reshape(n_queries,-1)
+
+    def _leftstate(self, left, i, x):
+        """Contraction of the tensors up to site i at x[:i+1], for sampling
+        Parameters
+        ----------
+        left : numpy array, shape (n_samples, D) or None if i=0
+            Contraction of the tensors before site i at x[:i]
+        i : int
+            Site
+        x : numpy array, shape (n_samples,)
+            Values of x[i]
+        Returns
+        -------
+        left : numpy array, shape (n_samples, D)
+        """
+        w2 = self._cores(self.w)
+        if left is None:
+            return w2[0][x,0,:]
+        newleft = np.zeros(left.shape,dtype=self.w.dtype)
+        for j in xrange(len(w2[i])):
+            mask = (x==j)
+            newleft[mask] = np.dot(left[mask],w2[i][j])
+        return newleft
+
     def _derivative(self, x):
         """Compute the derivative of P(x)
         Parameters
@@ -95,37 +271,90 @@ class RealBorn(TN):
         -------
         derivative : numpy array, shape (m_parameters,)
         """
-        w2 = np.reshape(self.w,(self.n_features,self.d,self.D,self.D))
-        derivative = np.zeros((self.n_features,self.d,self.D,self.D))
+        w2 = self._cores(self.w)
+        derivative = np.zeros(self.m_parameters,dtype=self.w.dtype)
+        dw2 = self._cores(derivative)
         
         #Store intermediate tensor contractions for the derivatives: 
         #left to right and right to left
         #tmp stores the contraction of the first i+1 tensors from the left 
         #in tmp[i,:,:], tmp2 the remaining tensors on the right
         #the mps contracted is the remaining contraction tmp[i-1]w[i]tmp2[i+1]
-        tmp=np.zeros((self.n_features,self.D))
-        tmp2=np.zeros((self.n_features,self.D))
-        tmp[0,:]=w2[0,x[0],0,:]
+        tmp=np.zeros((self.n_features,self.D),dtype=self.w.dtype)
+        tmp2=np.zeros((self.n_features,self.D),dtype=self.w.dtype)
+        tmp[0,:]=w2[0][x[0],0,:]
         for i in xrange(1,self.n_features-1):
-            tmp[i,:]=np.dot(tmp[i-1,:],w2[i,x[i],:,:])  
+            tmp[i,:]=np.dot(tmp[i-1,:],w2[i][x[i],:,:])  
         mpscontracted=np.inner(tmp[self.n_features-2,:],
-                               w2[self.n_features-1,x[self.n_features-1],:,0])
+                               w2[self.n_features-1][x[self.n_features-1],:,0])
         
         tmp[self.n_features-1,:]=np.inner(tmp[self.n_features-2,:],
-                                w2[self.n_features-1,x[self.n_features-1],:,0])
-        tmp2[self.n_features-1,:]=w2[self.n_features-1,x[self.n_features-1],:,0]
-        for i in xrange(self.n_features-2,-1,-1):
-            tmp2[i,:]=np.dot(w2[i,x[i],:,:],tmp2[i+1,:])
-        tmp2[0,:]=np.inner(w2[0,x[0],0,:],tmp2[1,:])
+                                w2[self.n_features-1][x[self.n_features-1],:,0])
+        tmp2[self.n_features-1,:]=w2[self.n_features-1][x[self.n_features-1],:,0]
+        for i in xrange(self.n_features-2,0,-1):
+            tmp2[i,:]=np.dot(w2[i][x[i],:,:],tmp2[i+1,:])
+        tmp2[0,:]=np.inner(w2[0][x[0],0,:],tmp2[1,:])
     
         #The derivative of each tensor is the contraction of the other tensors
-        derivative[0,x[0],0,:]=2*tmp2[1,:]*mpscontracted
-        derivative[self.n_features-1,x[self.n_features-1],:,0]=\
+        dw2[0][x[0],0,:]+=2*tmp2[1,:]*mpscontracted
+        dw2[self.n_features-1][x[self.n_features-1],:,0]+=\
                                 2*tmp[self.n_features-2,:]*mpscontracted
         for i in xrange(1,self.n_features-1):
-                derivative[i,x[i],:,:]=2*np.outer(tmp[i-1,:],tmp2[i+1,:])*mpscontracted
+                dw2[i][x[i],:,:]+=2*np.outer(tmp[i-1,:],tmp2[i+1,:])*mpscontracted
+
+        return derivative
+
+    def _logderivative_batch(self, X, weights=None):
+        """Compute the sum of the logderivatives of P(x) over a batch of configurations
+        Parameters
+        ----------
+        X : numpy array, shape (n_samples, n_features)
+            Configurations
+        weights : numpy array, shape (n_samples,) (optional)
+            Weight of each configuration in the sum
+        Returns
+        -------
+        derivative : numpy array, shape (m_parameters,)
+        """
+        w2 = self._cores(self.w)
+        n_samples = X.shape[0]
+        derivative = np.zeros(self.m_parameters,dtype=self.w.dtype)
+        dw2 = self._cores(derivative)
 
-        return derivative.reshape(self.m_parameters)
+        #Left and right environments of the whole batch, in one sweep each:
+        #tmp[i,b,:] is the contraction of the first i+1 tensors for sample b,
+        #tmp2[i,b,:] the contraction of the tensors i to n_features-1
+        tmp = np.zeros((self.n_features,n_samples,self.D),dtype=self.w.dtype)
+        tmp2 = np.zeros((self.n_features,n_samples,self.D),dtype=self.w.dtype)
+        if self.prefix_trie:
+            #Left environments of the distinct prefixes, read off for each sample
+            parents, symbols, nodes = self._prefixtrie(X)
+            env = w2[0][symbols[0],0,:]
+            tmp[0] = env[nodes[0]]
+            for i in xrange(1,self.n_features-1):
+                env = np.matmul(env[parents[i],None,:],w2[i][symbols[i],:,:])[:,0,:]
+                tmp[i] = env[nodes[i]]
+        else:
+            tmp[0] = w2[0][X[:,0],0,:]
+            for i in xrange(1,self.n_features-1):
+                tmp[i] = np.matmul(tmp[i-1,:,None,:],w2[i][X[:,i],:,:])[:,0,:]
+        tmp2[self.n_features-1] = w2[self.n_features-1][X[:,self.n_features-1],:,0]
+        for i in xrange(self.n_features-2,0,-1):
+            tmp2[i] = np.matmul(w2[i][X[:,i],:,:],tmp2[i+1,:,:,None])[:,:,0]
+        mpscontracted = np.sum(tmp[self.n_features-2]*tmp2[self.n_features-1],1)
+
+        #Each sample only touches one slice per tensor: scatter-add the
+        #derivative of psi(x)^2 divided by P(x), that is 2*env/psi(x)
+        ratio = 2/mpscontracted
+        if weights is not None:
+            ratio = weights*ratio
+        np.add.at(dw2[0][:,0,:],X[:,0],tmp2[1]*ratio[:,None])
+        np.add.at(dw2[self.n_features-1][:,:,0],X[:,self.n_features-1],
+                  tmp[self.n_features-2]*ratio[:,None])
+        for i in xrange(1,self.n_features-1):
+            np.add.at(dw2[i],X[:,i],tmp[i-1,:,:,None]*tmp2[i+1,:,None,:]
+                      *ratio[:,None,None])
+        return derivative
 
     def _derivativenorm(self):
         """Compute the derivative of the norm
@@ -133,38 +362,25 @@ class RealBorn(TN):
         -------
         derivative : numpy array, shape (m_parameters,)
         """        
-        w2=np.reshape(self.w,(self.n_features,self.d,self.D,self.D))
-        derivative=np.zeros((self.n_features,self.d,self.D,self.D)) 
-        
-        tmp=np.zeros((self.n_features,self.D*self.D))
-        tmp2=np.zeros((self.n_features,self.D*self.D))
-        tmp[0,:]=np.tensordot(w2[0,:,0,:],w2[0,:,0,:],axes=([0],[0])).reshape(self.D*self.D)
-        for i in xrange(1,self.n_features-1):
-            tmp[i,:]=np.dot(tmp[i-1,:],np.tensordot(w2[i,:,:,:],w2[i,:,:,:],
-                axes=([0],[0])).transpose((0,2,1,3)).reshape(self.D*self.D,self.D*self.D))
-        tmp[self.n_features-1,:]=np.inner(tmp[self.n_features-2,:],
-            np.tensordot(w2[self.n_features-1,:,:,0],w2[self.n_features-1,:,:,0],axes=([0],[0])).reshape(self.D*self.D))
-        
-        tmp2[self.n_features-1,:]=np.tensordot(w2[self.n_features-1,:,:,0],
-            w2[self.n_features-1,:,:,0],axes=([0],[0])).reshape(self.D*self.D)
-        for i in xrange(self.n_features-2,-1,-1):
-            tmp2[i,:]=np.dot(np.tensordot(w2[i,:,:,:],
-                w2[i,:,:,:],axes=([0],[0])).transpose((0,2,1,3)).reshape(self.D*self.D,self.D*self.D),tmp2[i+1,:])
-        tmp2[0,:]=np.inner(np.tensordot(w2[0,:,0,:],w2[0,:,0,:],
-                axes=([0],[0])).reshape(self.D*self.D),tmp2[1,:])
+        w2=self._cores(self.w)
+        derivative=np.zeros(self.m_parameters,dtype=self.w.dtype)
+        dw2=self._cores(derivative) 
         
+        tmp=self._leftenvironments()
+        tmp2=self._rightenvironments()
 
-        for j in xrange(self.d):
-            derivative[0,j,0,:]=2*np.dot(tmp2[1,:].reshape(self.D,self.D),
-                                                        w2[0,j,0,:])
-            derivative[self.n_features-1,j,:,0]=2*np.dot(tmp[self.n_features-2,:].reshape(self.D,self.D),
-                                    w2[self.n_features-1,j,:,0])
+        for j in xrange(len(w2[0])):
+            dw2[0][j,0,:]+=2*np.dot(tmp2[1,:].reshape(self.D,self.D),
+                                                        w2[0][j,0,:])
+        for j in xrange(len(w2[self.n_features-1])):
+            dw2[self.n_features-1][j,:,0]+=2*np.dot(tmp[self.n_features-2,:].reshape(self.D,self.D),
+                                    w2[self.n_features-1][j,:,0])
         for i in xrange(1,self.n_features-1):
             temp1=tmp[i-1,:].reshape(self.D,self.D)
             temp2=tmp2[i+1,:].reshape(self.D,self.D)
             
-            for j in xrange(self.d):
-                temp3=np.dot(np.dot(temp1,w2[i,j,:,:]),temp2.transpose())
-                derivative[i,j,:,:]=2*np.copy(temp3)
+            for j in xrange(len(w2[i])):
+                temp3=np.dot(np.dot(temp1,w2[i][j,:,:]),temp2.transpose())
+                dw2[i][j,:,:]+=2*np.copy(temp3)
                 
-        return derivative.reshape(self.m_parameters)
\ No newline at end of file
+        return derivative
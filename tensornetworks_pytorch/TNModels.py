@@ -12,12 +12,14 @@ class PosMPS(TTrain):
     def __init__(
             self, dataset, d, D, 
             homogeneous=True, w_randomization=None, gradient_clipping_threshold=None,
-            log_stability=True, 
-            verbose=False):
+            log_stability=True, prefix_trie=False, site_dimensions=None,
+            norm_method='sweep', tree_contraction=False, verbose=False):
         super().__init__(
             dataset, d, D, dtype=torch.float, 
             homogeneous=homogeneous, w_randomization=w_randomization,
             gradient_clipping_threshold=gradient_clipping_threshold,
+            prefix_trie=prefix_trie, site_dimensions=site_dimensions,
+            norm_method=norm_method, tree_contraction=tree_contraction,
             verbose=verbose)
         self.log_stability = log_stability
         self.name = "Positive MPS"
@@ -42,7 +44,7 @@ class PosMPS(TTrain):
         """
         if self.log_stability:
             unnorm_logprob = self._log_contract_at(x)
-            log_normalization = self._log_contract_all()
+            log_normalization = self._cached_log_normalization()
             logprob = unnorm_logprob - log_normalization
             # print(output, unnorm_prob, normalization, logprob)
         else:
@@ -51,36 +53,41 @@ class PosMPS(TTrain):
             logprob = unnorm_prob.log() - normalization.log()
         return logprob
 
-    def _logprob_batch(self, X):
+    def _logprob_batch(self, X, weights=None):
         """Compute log P(x) for all x in a batch X
 
         Args:
             X : shape (batch_size, seqlen)
+            weights (optional) : shape (batch_size,), 
+                multiplicity of each x; if given, the log probs are multiplied by it
 
         Returns:
             logprobs (torch.Tensor): size [batchsize]
         """
         if self.log_stability:
-            unnorm_logprobs = self._log_contract_at_batch(X) # tensor size [batchsize]
+            if self.prefix_trie:
+                unnorm_logprobs = self._log_contract_at_trie(X) # tensor size [batchsize]
+            else:
+                unnorm_logprobs = self._log_contract_at_batch(X) # tensor size [batchsize]
             # print(unnorm_logprobs)
             # print([self._log_contract_at(x).item() for x in X])
-            log_normalization = self._log_contract_all() # scalar
+            log_normalization = self._cached_log_normalization() # scalar
             logprobs = unnorm_logprobs - log_normalization
         else:
             raise NotImplementedError('batched=True not implemented for log_stability=False')
+        if weights is not None:
+            logprobs = weights * logprobs
         return logprobs
 
     def _contract_at(self, x):
         """Contract network at particular values in the physical dimension,
         for computing probability of x.
         """
-        # repeat the core seqlen times
         if self.homogeneous:
-            # repeat the core seqlen times
-            w = self.core[None].repeat(self.seqlen, 1, 1, 1)
+            # the same squared core at every site, without copies
+            w2 = [self.core.square()] * self.seqlen
         else:
-            w = self.core
-        w2 = w.square()
+            w2 = self.core.square()
         left_boundary2 = self.left_boundary.square()
         right_boundary2 = self.right_boundary.square()
         # contract the network, from the left boundary through to the last core
@@ -89,10 +96,10 @@ class PosMPS(TTrain):
             contracting_tensor = torch.einsum(
                 'i, ij -> j',
                 contracting_tensor,
-                w2[i, x[i], :, :])
+                w2[i][x[i], :, :])
             if contracting_tensor.min() < 0:
                 print("contraction < 0")
-                print(w.min())
+                print(self.core.min())
         # contract the final bond dimension
         output = torch.einsum(
             'i, i ->', contracting_tensor, right_boundary2)
@@ -106,25 +113,23 @@ class PosMPS(TTrain):
         """Contract network with a copy of itself across physical index,
         for computing norm.
         """
-        # repeat the core seqlen times
         if self.homogeneous:
-            # repeat the core seqlen times
-            w = self.core[None].repeat(self.seqlen, 1, 1, 1)
+            # the same squared core at every site, without copies
+            w2 = [self.core.square()] * self.seqlen
         else:
-            w = self.core
-        w2 = w.square()
+            w2 = self.core.square()
         left_boundary2 = self.left_boundary.square()
         right_boundary2 = self.right_boundary.square()
         # first, left boundary contraction
         # (note: if real-valued conj will have no effect)
         contracting_tensor = torch.einsum(
-            'j, ijk -> k', left_boundary2, w2[0, :, :, :])
+            'j, ijk -> k', left_boundary2, w2[0][:self.site_dimensions[0]])
         # contract the network
         for i in range(1, self.seqlen):
             contracting_tensor = torch.einsum(
                 'j, ijk -> k',
                 contracting_tensor,
-                w2[i, :, :, :])
+                w2[i][:self.site_dimensions[i]])
         # contract the final bond dimension with right boundary vector
         output = torch.dot(contracting_tensor, right_boundary2)
         # if self.verbose:
@@ -136,11 +141,10 @@ class PosMPS(TTrain):
         for computing probability of x.
         """
         if self.homogeneous:
-            # repeat the core seqlen times
-            w = self.core[None].repeat(self.seqlen, 1, 1, 1)
+            # the same squared core at every site, without copies
+            w2 = [self.core.square()] * self.seqlen
         else:
-            w = self.core
-        w2 = w.square()
+            w2 = self.core.square()
         left_boundary2 = self.left_boundary.square()
         right_boundary2 = self.right_boundary.square()
         Z = self.vec_norm(left_boundary2)
@@ -151,13 +155,13 @@ class PosMPS(TTrain):
             contractor_temp = torch.einsum(
                 'i, ij -> j',
                 contractor_unit,
-                w2[i, x[i], :, :])
+                w2[i][x[i], :, :])
             Z = self.vec_norm(contractor_temp)
-            contractor_unit = contractor_temp / Z
+            contractor_unit = contractor_temp / self._divisor(Z)
             accumulated_lognorm += Z.log()
             if contractor_unit.min() < 0:
                 print("contraction < 0")
-                print(w.min())
+                print(self.core.min())
         # contract the final bond dimension
         output = torch.einsum(
             'i, i ->', contractor_unit, right_boundary2)
@@ -178,22 +182,23 @@ class PosMPS(TTrain):
         Uses log norm stability trick.
         """
         batch_size = X.shape[0]
+        # select the matrix of each site at the observed values by indexing the
+        # squared cores, w2_selected shape is [batchsize, seqlen, D, D]
+        w2 = self.core.square()
         if self.homogeneous:
-            # repeat the core seqlen times, and repeat that batch_size times
-            w = self.core[(None,)*2].repeat(batch_size, self.seqlen, 1, 1, 1)
+            w2_selected = w2[X]
         else:
-            # repeat nonhomogenous core batch_size times
-            w = self.core[None].repeat(batch_size, 1, 1, 1, 1)
-        w2 = w.square() # w shape is [batch_size, seqlen, d, D, D]
-        left_boundaries2 = self.left_boundary[None].repeat(batch_size, 1).square()
-        right_boundaries2 = self.right_boundary[None].repeat(batch_size, 1).square()
+            w2_selected = w2[torch.arange(self.seqlen, device=X.device), X]
+        left_boundaries2 = self.left_boundary.square()[None].expand(batch_size, -1)
+        right_boundaries2 = self.right_boundary.square()[None].expand(batch_size, -1)
+        if self.tree_contraction:
+            output, lognorms = self._tree_contract(
+                left_boundaries2, w2_selected, right_boundaries2)
+            return lognorms + output.log()
         # normalizers, one per batch 
         Zs, _ = left_boundaries2.max(axis=1) # do vec_norm on each row (!note infinity norm is hardcoded here)
         contractor_unit = left_boundaries2 / Zs[:,None]
         accumulated_lognorms = Zs.log()
-        # make one hot encoding of data, and select along physical dimension of weights
-        Xh = torch.nn.functional.one_hot(X, num_classes=self.d)
-        w2_selected = (w2 * Xh[:, :, :, None, None]).sum(2) # w2_selected shape is [batchsize, seqlen, D, D]
         # contract the network, from the left boundary through to the last core
         for i in range(self.seqlen):
             contractor_temp = torch.einsum(
@@ -201,7 +206,7 @@ class PosMPS(TTrain):
                 contractor_unit,
                 w2_selected[:, i, :, :])
             Zs, _ = contractor_temp.abs().max(axis=1)
-            contractor_unit = contractor_temp / Zs[:,None]
+            contractor_unit = contractor_temp / self._divisor(Zs)[:,None]
             accumulated_lognorms += Zs.log()
         # contract the final bond dimension
         output = torch.einsum(
@@ -211,26 +216,67 @@ class PosMPS(TTrain):
             print("Warning! output of contract_at contains negative values...")
         return logprobs
 
+    def _log_contract_at_trie(self, X):
+        """Contract network at particular values in the physical dimension,
+        for computing probability of x, for x in X, over the prefix trie of X:
+        each distinct prefix is contracted once.
+        input:
+            X: tensor batch of observations, size [batch_size, seq_len]
+        returns:
+            logprobs: tensor of log probs, size [batch_size]
+        Uses log norm stability trick.
+        """
+        parents, symbols, leaves = self._prefix_trie(X)
+        w2 = self.core.square()
+        left_boundary2 = self.left_boundary.square()
+        right_boundary2 = self.right_boundary.square()
+        Z = self.vec_norm(left_boundary2)
+        contractor_unit = (left_boundary2 / Z)[None]
+        accumulated_lognorms = Z.log()[None]
+        # contract the network, from the left boundary through to the last core,
+        # one row per node of the trie
+        for i in range(self.seqlen):
+            if self.homogeneous:
+                w2_selected = w2[symbols[i]]
+            else:
+                w2_selected = w2[i, symbols[i]]
+            contractor_temp = torch.einsum(
+                'bi, bij -> bj',
+                contractor_unit[parents[i]],
+                w2_selected)
+            Zs, _ = contractor_temp.abs().max(axis=1)
+            contractor_unit = contractor_temp / self._divisor(Zs)[:,None]
+            accumulated_lognorms = accumulated_lognorms[parents[i]] + Zs.log()
+        # contract the final bond dimension, then read off each x at its leaf
+        output = torch.einsum(
+            'bi, i -> b', contractor_unit, right_boundary2)
+        logprobs = (accumulated_lognorms + output.log())[leaves]
+        if (output < 0).any():
+            print("Warning! output of contract_at contains negative values...")
+        return logprobs
+
     def _log_contract_all(self):
         """Contract network with a copy of itself across physical index,
         for computing norm.
         """
-        # repeat the core seqlen times
-        if self.homogeneous:
-            # repeat the core seqlen times
-            w = self.core[None].repeat(self.seqlen, 1, 1, 1)
-        else:
-            w = self.core
-        w2 = w.square()
         left_boundary2 = self.left_boundary.square()
         right_boundary2 = self.right_boundary.square()
+        if self.norm_method != 'sweep':
+            # the transfer operator is the sum of the squared core
+            return self._log_contract_power(
+                left_boundary2, self.core.square().sum(0), right_boundary2)
+        if self.homogeneous:
+            # the same squared core at every site, without copies
+            w2 = [self.core.square()] * self.seqlen
+        else:
+            w2 = self.core.square()
         Z = self.vec_norm(left_boundary2)
         contractor_unit = left_boundary2 / Z
         accumulated_lognorm = Z.log()
         # first, left boundary contraction
         # (note: if real-valued conj will have no effect)
         contractor_temp = torch.einsum(
-            'j, ijk -> k', contractor_unit, w2[0, :, :, :])
+            'j, ijk -> k', contractor_unit, w2[0][:self.site_dimensions[0]])
         Z = self.vec_norm(contractor_temp)
         contractor_unit = contractor_temp / Z
         accumulated_lognorm += Z.log()
@@ -239,7 +285,7 @@ class PosMPS(TTrain):
             contractor_temp = torch.einsum(
                 'j, ijk -> k',
                 contractor_unit,
-                w2[i, :, :, :])
+                w2[i][:self.site_dimensions[i]])
             Z = self.vec_norm(contractor_temp)
             contractor_unit = contractor_temp / Z
             accumulated_lognorm += Z.log()
@@ -250,6 +296,57 @@ class PosMPS(TTrain):
         #     print("contract_all", output)
         return logprob
 
+    def _sample_right_environments(self):
+        """Right environments for sampling: the contraction of the squared cores
+        after site i and the squared right boundary, up to a factor.
+        returns:
+            list of seqlen tensors of size [D]
+        """
+        environments = [None] * self.seqlen
+        environment = self.right_boundary.square()
+        for i in reversed(range(self.seqlen)):
+            environments[i] = environment
+            w = self._site_core(i)
+            environment = torch.einsum('iab, b -> a', w.square(), environment)
+            environment = environment / self.vec_norm(environment)
+        return environments
+
+    def _sample_left_boundary(self):
+        """Left contraction before the first site, for sampling, size [1, D]"""
+        return self.left_boundary.square()[None]
+
+    def _conditional_probs(self, left, i, right_environment):
+        """Unnormalized probabilities of the values of site i given the
+        contraction left of each prefix, size [n_prefixes, d]"""
+        w = self._site_core(i)
+        weights = torch.einsum('iab, b -> ia', w.square(), right_environment)
+        return left @ weights.T
+
+    def _absorb(self, left, i, x):
+        """Contraction of the left contraction of each prefix with the squared
+        core of site i at the values x, size [n_prefixes, D]"""
+        w = self._site_core(i)
+        return torch.einsum('na, nab -> nb', left, w[x].square())
+
+    def _marginal_left_boundary(self, n_queries):
+        """Squared left boundary, size [n_queries, D]"""
+        return self.left_boundary.square()[None].expand(n_queries, -1)
+
+    def _marginal_transfer(self, left, i, mask):
+        """Contraction of the left contraction of each pattern with the squared core
+        of site i, summed over the allowed values of site i only.
+        input:
+            left: size [n_queries, D]
+            mask: bool tensor of allowed values of site i, size [n_queries, d]
+        """
+        w = self._site_core(i)
+        return torch.einsum('qa, iab, qi -> qb', left, w.square(), mask[:, :len(w)].to(w.dtype))
+
+    def _marginal_close(self, left):
+        """Contraction of the left contraction of each pattern with the squared
+        right boundary, size [n_queries]"""
+        return left @ self.right_boundary.square()
+
 
 class Born(TTrain):
     """Born model for tensor network with real or complex parameters.
@@ -257,15 +354,34 @@ class Born(TTrain):
     Parameters:
         dtype ([tensor.dtype]): 
             tensor.float for real, or tensor.cfloat for complex
+        canonical (bool): 
+            if True (non-homogeneous only), the cores are kept as left-isometries
+            and the left boundary fixed to the first unit vector, so the norm is the
+            squared norm of the right boundary and _log_contract_all is not needed.
+            Gradients of the cores are projected on the tangent space of the
+            isometries, and the cores are brought back to left-canonical form by
+            a QR sweep after each optimizer step.
+        bond_tolerance (float): 
+            if not None (non-homogeneous only), the bond dimensions are adapted
+            after each epoch of training: each bond is truncated to the fewest
+            singular values whose discarded weight (the fraction of the squared
+            singular values discarded) is at most bond_tolerance, or grown by one,
+            up to D, where nothing can be discarded. The cores are stored with the
+            largest bond dimension as width, so smaller bonds make the
+            contractions cheaper.
     """
     def __init__(
             self, dataset, d, D, dtype, 
             homogeneous=True, w_randomization=None, gradient_clipping_threshold=None,
-            log_stability=True, verbose=False):
+            log_stability=True, prefix_trie=False, canonical=False,
+            bond_tolerance=None, site_dimensions=None, norm_method='sweep',
+            tree_contraction=False, verbose=False):
         super().__init__(
             dataset, d, D, dtype, 
             homogeneous=homogeneous, w_randomization=w_randomization, 
             gradient_clipping_threshold=gradient_clipping_threshold,
+            prefix_trie=prefix_trie, site_dimensions=site_dimensions,
+            norm_method=norm_method, tree_contraction=tree_contraction,
             verbose=verbose)
         self.log_stability = log_stability
         self.name = f"Born ({dtype})"
@@ -282,6 +398,172 @@ class Born(TTrain):
             self.short_name += " non-hom"
         if not log_stability:
             self.name += " without log_stability"
+        self.canonical = canonical
+        if canonical:
+            if homogeneous:
+                raise NotImplementedError('canonical=True not implemented for homogeneous models')
+            self.name += ", canonical"
+            self.left_boundary.requires_grad_(False)
+            self._retract()
+            self.core.register_hook(self._tangent_projection)
+        self.bond_tolerance = bond_tolerance
+        if bond_tolerance is not None:
+            if homogeneous:
+                raise NotImplementedError('bond_tolerance not implemented for homogeneous models')
+            self.name += ", adaptive bonds"
+
+    def _register_hooks(self):
+        """Register the gradient hooks of new parameters, the projection on the
+        tangent space if canonical, and the clipping hooks."""
+        if self.canonical:
+            self.core.register_hook(self._tangent_projection)
+        super()._register_hooks()
+
+    def _retract(self):
+        """Bring the network to left-canonical form with a QR sweep from the left,
+        absorbing the left boundary into the first core and the remainder into the
+        right boundary. The state is unchanged, only its gauge.
+        The bond after site i has effective dimension at most
+        min(d_0*...*d_i, bond_dimensions[i+1]),
+        the rest of each core is set to zero.
+        If not canonical, the parameters beyond the bond dimensions are set to zero.
+        """
+        if not self.canonical:
+            if self.bond_tolerance is not None:
+                self._zero_padding()
+            return
+        with torch.no_grad():
+            carry = self.left_boundary[None]
+            for i in range(self.seqlen):
+                k = carry.shape[0]
+                d_i = self.site_dimensions[i]
+                k_next = self.bond_dimensions[i+1]
+                m = torch.einsum(
+                    'ab, jbc -> ajc', carry,
+                    self.core[i, :d_i, :carry.shape[1], :k_next]).reshape(k*d_i, k_next)
+                q, carry = torch.linalg.qr(m)
+                self.core[i] = 0
+                self.core[i, :d_i, :k, :q.shape[1]] = q.reshape(k, d_i, -1).permute(1, 0, 2)
+            right_boundary = carry @ self.right_boundary[:k_next]
+            self.right_boundary.zero_()
+            self.right_boundary[:right_boundary.shape[0]] = right_boundary
+            self.left_boundary.zero_()
+            self.left_boundary[0] = 1
+
+    def _tangent_projection(self, grad):
+        """Project the gradient of the cores on the tangent space of the
+        left-isometries W at the current cores, G - W (W^H G + G^H W)/2,
+        to be used as a hook on the cores when canonical.
+        The gradient of log|right_boundary|^2 only agrees with the gradient of
+        the norm in these directions."""
+        grad = grad.clone()
+        core = self.core.detach()
+        k = 1
+        for i in range(self.seqlen):
+            d_i = self.site_dimensions[i]
+            k_next = min(k*d_i, self.bond_dimensions[i+1])
+            w = core[i, :d_i, :k, :k_next].permute(1, 0, 2).reshape(k*d_i, k_next)
+            g = grad[i, :d_i, :k, :k_next].permute(1, 0, 2).reshape(k*d_i, k_next)
+            s = w.conj().T @ g
+            g = g - w @ (s + s.conj().T) / 2
+            grad[i, :d_i, :k, :k_next] = g.reshape(k, d_i, k_next).permute(1, 0, 2)
+            k = k_next
+        return grad
+
+    def _zero_padding(self):
+        """Set the parameters beyond the bond dimensions to zero"""
+        b = self.bond_dimensions
+        with torch.no_grad():
+            self.left_boundary[b[0]:] = 0
+            self.right_boundary[b[-1]:] = 0
+            for i in range(self.seqlen):
+                self.core[i, :, b[i]:] = 0
+                self.core[i, :, :, b[i+1]:] = 0
+
+    def _truncation_rank(self, s):
+        """Number of singular values s (in decreasing order) to keep for the
+        discarded weight, the fraction of the squared singular values discarded,
+        to be at most bond_tolerance"""
+        weight = s.square().flip(0).cumsum(0).flip(0)
+        return max(1, int((weight > self.bond_tolerance * weight[0]).sum()))
+
+    def _adapt_bonds(self):
+        """Adapt the bond dimensions with a sweep of SVDs from the left on the
+        right-canonical form of the network, where the singular values of each bond
+        are its Schmidt coefficients. Each bond is truncated to bond_tolerance on
+        its discarded weight, or grown by one where nothing can be discarded.
+        A grown bond carries a zero singular value: the state is unchanged, and
+        the gradient in the new dimension is not zero. The boundaries are absorbed
+        into the cores, so that the boundary bonds have dimension 1. If not
+        canonical, the cores are then rescaled to their norms before the sweep,
+        which keeps the scale of the gradient steps.
+        The cores are stored with the largest bond dimension as width.
+        returns:
+            True if the shapes of the parameters changed
+        """
+        if self.bond_tolerance is None:
+            return False
+        with torch.no_grad():
+            b = self.bond_dimensions
+            cores = [self._site_core(i)[:, :b[i], :b[i+1]] for i in range(self.seqlen)]
+            norms = [core.norm() for core in cores]
+            cores[0] = torch.einsum(
+                'a, iab -> ib', self.left_boundary[:b[0]], cores[0])[:, None]
+            cores[-1] = torch.einsum(
+                'iab, b -> ia', cores[-1], self.right_boundary[:b[-1]])[:, :, None]
+            # right-canonical form, A = R^T Q^T with Q^T having orthonormal rows
+            for i in reversed(range(1, self.seqlen)):
+                d, k, k_next = cores[i].shape
+                q, r = torch.linalg.qr(cores[i].permute(1, 0, 2).reshape(k, d*k_next).T)
+                cores[i] = q.T.reshape(-1, d, k_next).permute(1, 0, 2)
+                cores[i-1] = torch.einsum('iab, cb -> iac', cores[i-1], r)
+            # truncated or grown SVD of each bond, from the left
+            for i in range(self.seqlen - 1):
+                d, k, k_next = cores[i].shape
+                u, s, vh = torch.linalg.svd(cores[i].permute(1, 0, 2).reshape(k*d, k_next))
+                kept = self._truncation_rank(s)
+                if kept == k_next and kept < min(self.D, k*d, cores[i+1].shape[0]*cores[i+1].shape[2]):
+                    kept += 1
+                r = min(kept, len(s))
+                sv = torch.zeros(kept, k_next, dtype=vh.dtype, device=vh.device)
+                sv[:r] = s[:r, None] * vh[:r]
+                cores[i] = u[:, :kept].reshape(k, d, kept).permute(1, 0, 2)
+                cores[i+1] = torch.einsum('ab, ibc -> iac', sv, cores[i+1])
+            # the norm of the state goes to the right boundary
+            d, k = cores[-1].shape[:2]
+            q, r = torch.linalg.qr(cores[-1].permute(1, 0, 2).reshape(k*d, 1))
+            cores[-1] = q.reshape(k, d, 1).permute(1, 0, 2)
+            right_norm = r[0, 0]
+            if not self.canonical:
+                for i in range(self.seqlen):
+                    scale = norms[i] / cores[i].norm()
+                    cores[i] = scale * cores[i]
+                    right_norm = right_norm / scale
+            self.bond_dimensions = [1] + [core.shape[2] for core in cores]
+            width = max(self.bond_dimensions)
+            resized = width != self.core.shape[-1]
+            if resized:
+                # new parameters, with the hooks of the old ones
+                self.core = nn.Parameter(self.core.new_zeros(self.seqlen, self.d, width, width))
+                self.left_boundary = nn.Parameter(
+                    self.left_boundary.new_zeros(width), requires_grad=not self.canonical)
+                self.right_boundary = nn.Parameter(self.right_boundary.new_zeros(width))
+                self._register_hooks()
+            self.core.zero_()
+            for i, core in enumerate(cores):
+                self.core[i, :core.shape[0], :core.shape[1], :core.shape[2]] = core
+            self.left_boundary.zero_()
+            self.left_boundary[0] = 1
+            self.right_boundary.zero_()
+            self.right_boundary[0] = right_norm
+        return resized
+
+    def _log_normalization(self):
+        """Log of the norm of the network, contracted with its conjugate,
+        or in canonical form the squared norm of the right boundary."""
+        if self.canonical:
+            return self.right_boundary.abs().square().sum().log()
+        return self._log_contract_all()
 
     def _logprob(self, x):
         """Compute log probability of one configuration P(x)
@@ -294,7 +576,7 @@ class Born(TTrain):
         """
         if self.log_stability:
             unnorm_logprob = self._log_contract_at(x)
-            log_normalization = self._log_contract_all()
+            log_normalization = self._cached_log_normalization()
             logprob = unnorm_logprob - log_normalization
             # print(output, unnorm_prob, normalization, logprob)
         else:
@@ -304,21 +586,28 @@ class Born(TTrain):
             logprob = unnorm_prob.log() - normalization.log()
         return logprob
 
-    def _logprob_batch(self, X):
+    def _logprob_batch(self, X, weights=None):
         """Compute log P(x) for all x in a batch X
 
         Args:
             X : shape (batch_size, seqlen)
+            weights (optional) : shape (batch_size,), 
+                multiplicity of each x; if given, the log probs are multiplied by it
 
         Returns:
             logprobs (torch.Tensor): size [batchsize]
         """
         if self.log_stability:
-            unnorm_logprobs = self._log_contract_at_batch(X) # tensor size [batchsize]
+            if self.prefix_trie:
+                unnorm_logprobs = self._log_contract_at_trie(X) # tensor size [batchsize]
+            else:
+                unnorm_logprobs = self._log_contract_at_batch(X) # tensor size [batchsize]
             # print(unnorm_logprobs)
             # print([self._log_contract_at(x).item() for x in X])
-            log_normalization = self._log_contract_all() # scalar
+            log_normalization = self._cached_log_normalization() # scalar
             logprobs = unnorm_logprobs - log_normalization
         else:
             raise NotImplementedError('batched=True not implemented for log_stability=False')
+        if weights is not None:
+            logprobs = weights * logprobs
         return logprobs
\ No newline at end of file
@@ -1,9 +1,15 @@
+import os
+import json
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from tqdm import tqdm
 from torch.utils.data import Dataset, DataLoader
 
+# version of the format written by TTrain.save
+_FORMAT_VERSION = 1
+
 class TTrain(nn.Module):
     """Abstract class for Tensor Train models.  Use instantiating class.
 
@@ -12,20 +18,58 @@ class TTrain(nn.Module):
         d (int): physical dimension (number of categories in data)
         dtype ([tensor.dtype]): 
             tensor.float for real, or tensor.cfloat for complex
+        prefix_trie (bool): 
+            if True, batches are contracted over their prefix trie,
+            each distinct prefix being contracted once
+        tree_contraction (bool): 
+            if True, batches are contracted by multiplying the matrices of the
+            sites pairwise in a balanced tree, in log2(seqlen) batched matrix
+            products instead of seqlen matrix-vector products
+        site_dimensions (list): 
+            physical dimension of each site (non-homogeneous only), by default the
+            number of categories of each column of the dataset. The parameters of
+            the other values are zero and are not contracted, and configurations
+            with such a value have log probability -inf.
+        norm_method (str): 
+            how the norm is contracted: 'sweep' site by site, or for a homogeneous
+            model with the seqlen-th power of the transfer operator, computed in
+            O(log seqlen) matrix products by repeated squaring with 'squaring',
+            or from its eigendecomposition with 'eig' (for a diagonalizable
+            transfer operator)
+
+    Attributes:
+        bond_dimensions (list): dimension of each of the seqlen+1 bonds, from the
+            left boundary to the right boundary, at most the width of the cores.
+            The parameters beyond the dimension of a bond are zero.
     """
     def __init__(
             self, dataset, d, D, dtype, 
             homogeneous=True, w_randomization=None, gradient_clipping_threshold=None,
-            verbose=False):
+            prefix_trie=False, site_dimensions=None, norm_method='sweep',
+            tree_contraction=False, verbose=False):
         super().__init__()
         self.D = D
         self.d = d
         self.dtype = dtype
         self.verbose = verbose
         self.homogeneous = homogeneous
+        self.prefix_trie = prefix_trie
+        if norm_method not in ('sweep', 'squaring', 'eig'):
+            raise ValueError(f"norm_method {norm_method!r}, not 'sweep', 'squaring' or 'eig'")
+        if norm_method != 'sweep' and not homogeneous:
+            raise NotImplementedError(f'norm_method={norm_method!r} not implemented for non-homogeneous models')
+        self.norm_method = norm_method
+        self.tree_contraction = tree_contraction
         self.dataset = dataset
         self.n_datapoints = dataset.shape[0]
         self.seqlen = dataset.shape[1]
+        self.bond_dimensions = [D] * (self.seqlen + 1)
+        if homogeneous:
+            self.site_dimensions = [d] * self.seqlen
+        elif site_dimensions is None:
+            self.site_dimensions = [int(k) + 1 for k in torch.as_tensor(dataset).max(0)[0]]
+        else:
+            self.site_dimensions = list(site_dimensions)
         # choose weight initialization scheme
         if w_randomization == 'noisy':
             w_init = self.noisy_ones  # constant at 1, with some noise
@@ -50,6 +94,8 @@ class TTrain(nn.Module):
         else: # initialize seqlen different non-homogeneous cores
             core = k_core * w_init((self.seqlen, d, D, D), dtype=dtype)
             #core = torch.randn(self.seqlen, d, D, D, dtype=dtype)
+            for i, d_i in enumerate(self.site_dimensions):
+                core[i, d_i:] = 0
             self.core = nn.Parameter(core)
         left_boundary = k_vectors * w_init(D, dtype=dtype)
         #left_boundary = torch.randn(D, dtype=dtype)
@@ -58,6 +104,9 @@ class TTrain(nn.Module):
         #right_boundary = torch.randn(D, dtype=dtype)
         self.right_boundary = nn.Parameter(right_boundary)
 
+        self._log_normalization_cache = None
+
+        self.gradient_clipping_threshold = gradient_clipping_threshold
         if gradient_clipping_threshold:
             # clip gradients at gradient_clipping_threshold if not None
             self.add_gradient_hook(clipping_threshold=gradient_clipping_threshold)
@@ -84,6 +133,17 @@ class TTrain(nn.Module):
             out = x + 1*(random2==0) - 1*(random2==1) 
         return torch.tensor(out, dtype=dtype)
 
+    def _site_core(self, i):
+        """Core of site i, restricted to the values of site i, size [d_i, D, D]"""
+        w = self.core if self.homogeneous else self.core[i]
+        return w[:self.site_dimensions[i]]
+
+    @staticmethod
+    def _divisor(Z):
+        """Norms to divide contractions by, 1 for the zero contractions (of a value
+        beyond the dimension of its site), whose log norm -inf gives log prob -inf"""
+        return torch.where(Z > 0, Z, torch.ones_like(Z))
+
     def mat_norm(self, mat):
         """Our norm for matrices: infinity norm"""
         # equivalent to torch.linalg.norm(vec, ord=float('inf')).real
@@ -99,8 +159,8 @@ class TTrain(nn.Module):
         for computing probability of x.
         """
         if self.homogeneous:
-            # repeat the core seqlen times
-            w = self.core[None].repeat(self.seqlen, 1, 1, 1)
+            # the same core at every site, without copies
+            w = [self.core] * self.seqlen
         else:
             w = self.core
         # contract the network, from the left boundary through to the last core
@@ -109,7 +169,7 @@ class TTrain(nn.Module):
             contracting_tensor = torch.einsum(
                 'i, ij -> j',
                 contracting_tensor,
-                w[i, x[i], :, :])
+                w[i][x[i], :, :])
         # contract the final bond dimension
         output = torch.einsum(
             'i, i ->', contracting_tensor, self.right_boundary)
@@ -123,8 +183,8 @@ class TTrain(nn.Module):
         """
 
         if self.homogeneous:
-            # repeat the core seqlen times
-            w = self.core[None].repeat(self.seqlen, 1, 1, 1)
+            # the same core at every site, without copies
+            w = [self.core] * self.seqlen
         else:
             w = self.core
 
@@ -133,19 +193,19 @@ class TTrain(nn.Module):
         contracting_tensor = torch.einsum(
             'ij, ik -> jk',
             torch.einsum(
-                'j, ijk -> ik', self.left_boundary, w[0, :, :, :]),
+                'j, ijk -> ik', self.left_boundary, w[0][:self.site_dimensions[0]]),
             torch.einsum(
-                'j, ijk -> ik', self.left_boundary, w[0, :, :, :].conj())
+                'j, ijk -> ik', self.left_boundary, w[0][:self.site_dimensions[0]].conj())
         )
-        # contract the network
+        # contract the network, with the transfer operator of a homogeneous
+        # model computed once, as a [D*D, D*D] matrix
+        if self.homogeneous:
+            transfer = self._transfer_matrix(self.core)
         for i in range(1, self.seqlen):
-            contracting_tensor = torch.einsum(
-                'ij, ijkl -> kl',
-                contracting_tensor,
-                torch.einsum(
-                    'ijk, ilm -> jlkm',
-                    w[i, :, :, :],
-                    w[i, :, :, :].conj()))
+            if not self.homogeneous:
+                transfer = self._transfer_matrix(w[i][:self.site_dimensions[i]])
+            contracting_tensor = torch.matmul(
+                contracting_tensor.reshape(-1), transfer).reshape(contracting_tensor.shape)
         # contract the final bond dimension with right boundary vector
         output = torch.einsum(
             'ij, i, j ->',
@@ -156,6 +216,17 @@ class TTrain(nn.Module):
         #     print("contract_all", output)
         return output
 
+    def _transfer_matrix(self, core):
+        """Contraction of a core with its conjugate across the physical index,
+        as a matrix from the [D, D] contractions on its left to the ones on its right.
+        input:
+            core: tensor, size [d, D, D]
+        returns:
+            transfer: tensor, size [D*D, D*D]
+        """
+        D = core.shape[-1]
+        return torch.einsum('ijk, ilm -> jlkm', core, core.conj()).reshape(D*D, D*D)
+
     def _log_contract_at(self, x):
         """Contract network at particular values in the physical dimension,
         for computing probability of x.
@@ -163,8 +234,8 @@ class TTrain(nn.Module):
         RETURNS A LOG PROB.
         """
         if self.homogeneous:
-            # repeat the core seqlen times
-            w = self.core[None].repeat(self.seqlen, 1, 1, 1)
+            # the same core at every site, without copies
+            w = [self.core] * self.seqlen
         else:
             w = self.core
         # contract the network, from the left boundary through to the last core
@@ -175,9 +246,9 @@ class TTrain(nn.Module):
             contractor_temp = torch.einsum(
                 'i, ij -> j',
                 contractor_unit,
-                w[i, x[i], :, :])
+                w[i][x[i], :, :])
             Z = self.vec_norm(contractor_temp)
-            contractor_unit = contractor_temp / Z
+            contractor_unit = contractor_temp / self._divisor(Z)
             accumulated_lognorm += Z.log()
         # contract the final bond dimension
         output = torch.einsum(
@@ -201,10 +272,15 @@ class TTrain(nn.Module):
         """Contract network with a copy of itself across physical index,
         for computing norm.
         """
+        if self.norm_method != 'sweep':
+            return self._log_contract_power(
+                torch.outer(self.left_boundary, self.left_boundary.conj()).reshape(-1),
+                self._transfer_matrix(self.core),
+                torch.outer(self.right_boundary, self.right_boundary.conj()).reshape(-1))
 
         if self.homogeneous:
-            # repeat the core seqlen times
-            w = self.core[None].repeat(self.seqlen, 1, 1, 1)
+            # the same core at every site, without copies
+            w = [self.core] * self.seqlen
         else:
             w = self.core
 
@@ -212,29 +288,30 @@ class TTrain(nn.Module):
         # (note: if real-valued conj will have no effect)
         Z = self.vec_norm(self.left_boundary)
         contractor_unit = self.left_boundary / Z
-        accumulated_lognorm = Z.log()
+        # the left boundary and its conjugate are both rescaled by Z
+        accumulated_lognorm = 2*Z.log()
         if not accumulated_lognorm.isfinite():
             print("nonfinite lognorm in contract all! clamping")
             accumulated_lognorm = self.clamp_c(accumulated_lognorm, -1e-20, None)
         contractor_temp = torch.einsum(
             'ij, ik -> jk',
             torch.einsum(
-                'j, ijk -> ik', contractor_unit, w[0, :, :, :]),
+                'j, ijk -> ik', contractor_unit, w[0][:self.site_dimensions[0]]),
             torch.einsum(
-                'j, ijk -> ik', contractor_unit.conj(), w[0, :, :, :].conj())
+                'j, ijk -> ik', contractor_unit.conj(), w[0][:self.site_dimensions[0]].conj())
         )
         Z = self.mat_norm(contractor_temp)
         contractor_unit = contractor_temp / Z
         accumulated_lognorm += Z.log()
-        # contract the network
+        # contract the network, with the transfer operator of a homogeneous
+        # model computed once, as a [D*D, D*D] matrix
+        if self.homogeneous:
+            transfer = self._transfer_matrix(self.core)
         for i in range(1, self.seqlen):
-            contractor_temp = torch.einsum(
-                'ij, ijkl -> kl',
-                contractor_unit,
-                torch.einsum(
-                    'ijk, ilm -> jlkm',
-                    w[i, :, :, :],
-                    w[i, :, :, :].conj()))
+            if not self.homogeneous:
+                transfer = self._transfer_matrix(w[i][:self.site_dimensions[i]])
+            contractor_temp = torch.matmul(
+                contractor_unit.reshape(-1), transfer).reshape(contractor_unit.shape)
             Z = self.mat_norm(contractor_temp)
             contractor_unit = contractor_temp / Z
             accumulated_lognorm += Z.log()
@@ -252,6 +329,78 @@ class TTrain(nn.Module):
         #     print("contract_all", output)
         return lognorm
 
+    def _transfer_power(self, transfer, n):
+        """n-th power of a transfer matrix, in O(log n) matrix products by
+        repeated squaring, with each product rescaled by its norm.
+        input:
+            transfer: tensor, size [k, k]
+            n: int, at least 1
+        returns:
+            power_unit: tensor, size [k, k], the power divided by exp(lognorm)
+            lognorm: tensor, size []
+        """
+        Z = self.mat_norm(transfer)
+        square_unit = transfer / Z
+        square_lognorm = Z.log()
+        power_unit = None
+        while True:
+            # square_unit*exp(square_lognorm) is transfer to the power 2^k,
+            # multiplied into the power for each bit k of n
+            if n & 1:
+                if power_unit is None:
+                    power_unit, lognorm = square_unit, square_lognorm
+                else:
+                    power_temp = torch.matmul(power_unit, square_unit)
+                    Z = self.mat_norm(power_temp)
+                    power_unit = power_temp / Z
+                    lognorm = lognorm + square_lognorm + Z.log()
+            n >>= 1
+            if not n:
+                return power_unit, lognorm
+            square_temp = torch.matmul(square_unit, square_unit)
+            Z = self.mat_norm(square_temp)
+            square_unit = square_temp / Z
+            square_lognorm = 2*square_lognorm + Z.log()
+
+    def _transfer_power_eig(self, transfer, n):
+        """n-th power of a diagonalizable transfer matrix, from its
+        eigendecomposition, divided by the n-th power of its spectral radius.
+        input:
+            transfer: tensor, size [k, k]
+            n: int, at least 1
+        returns:
+            power_unit: tensor, size [k, k], the power divided by exp(lognorm)
+            lognorm: tensor, size []
+        """
+        eigenvalues, eigenvectors = torch.linalg.eig(transfer)
+        Z = eigenvalues.abs().max()
+        # V diag(l^n) V^-1, solving X V = V diag(l^n) for X
+        power_unit = torch.linalg.solve(
+            eigenvectors, eigenvectors * (eigenvalues / Z)**n, left=False)
+        if not transfer.is_complex():
+            power_unit = power_unit.real
+        return power_unit, n*Z.log()
+
+    def _log_contract_power(self, left, transfer, right):
+        """Log norm of a homogeneous network, from its boundaries and the
+        seqlen-th power of its transfer operator (see norm_method).
+        input:
+            left: tensor, size [k], left boundary of the transfer operator
+            transfer: tensor, size [k, k]
+            right: tensor, size [k], right boundary of the transfer operator
+        returns:
+            lognorm: tensor, size [], log |left . transfer^seqlen . right|
+        """
+        if self.norm_method == 'eig':
+            power_unit, lognorm = self._transfer_power_eig(transfer, self.seqlen)
+        else:
+            power_unit, lognorm = self._transfer_power(transfer, self.seqlen)
+        Z_left = self.vec_norm(left)
+        Z_right = self.vec_norm(right)
+        output = torch.einsum(
+            'i, ij, j ->', left / Z_left, power_unit, right / Z_right)
+        return lognorm + Z_left.log() + Z_right.log() + output.abs().log()
+
     def _log_contract_at_batch(self, X):
         """Contract network at particular values in the physical dimension,
         for computing probability of x, for x in X.
@@ -262,25 +411,25 @@ class TTrain(nn.Module):
         Uses log norm stability trick.
         """
         batch_size = X.shape[0]
+        # select the matrix of each site at the observed values by indexing the
+        # cores, w_selected shape is [batchsize, seqlen, D, D]
         if self.homogeneous:
-            # repeat the core seqlen times, and repeat that batch_size times
-            w = self.core[(None,)*2].repeat(batch_size, self.seqlen, 1, 1, 1)
+            w_selected = self.core[X]
         else:
-            # repeat nonhomogenous core batch_size times
-            w = self.core[None].repeat(batch_size, 1, 1, 1, 1)
-        # contract the network, from the left boundary through to the last core
-        left_boundaries = self.left_boundary[None].repeat(batch_size, 1)
-        right_boundaries = self.right_boundary[None].repeat(batch_size, 1)
+            w_selected = self.core[torch.arange(self.seqlen, device=X.device), X]
+        left_boundaries = self.left_boundary[None].expand(batch_size, -1)
+        right_boundaries = self.right_boundary[None].expand(batch_size, -1)
+        if self.tree_contraction:
+            output, lognorms = self._tree_contract(
+                left_boundaries, w_selected, right_boundaries)
+            return 2*(lognorms + output.abs().log())
         # normalizers, one per batch 
         Zs, _ = left_boundaries.abs().max(axis=1) # do vec_norm on each row (!note infinity norm is hardcoded here)
         contractor_unit = left_boundaries / Zs[:,None]
         accumulated_lognorms = Zs.log()
-        if not accumulated_lognorms.isfinite().all():
+        if not (accumulated_lognorms.isfinite() | accumulated_lognorms.isneginf()).all():
             print("nonfinite lognorm in contract_at! clamping")
             accumulated_lognorms = self.clamp_c(accumulated_lognorms, -1e-20, None)
-        # make one hot encoding of data, and select along physical dimension of weights
-        Xh = torch.nn.functional.one_hot(X, num_classes=self.d)
-        w_selected = (w * Xh[:, :, :, None, None]).sum(2) # w_selected shape is [batchsize, seqlen, D, D]
         # contract the network, from the left boundary through to the last core
         for i in range(self.seqlen):
             contractor_temp = torch.einsum(
@@ -288,9 +437,9 @@ class TTrain(nn.Module):
                 contractor_unit,
                 w_selected[:, i, :, :])
             Zs, _ = contractor_temp.abs().max(axis=1)
-            contractor_unit = contractor_temp / Zs[:,None]
+            contractor_unit = contractor_temp / self._divisor(Zs)[:,None]
             accumulated_lognorms += Zs.log()
-            if not accumulated_lognorms.isfinite().all():
+            if not (accumulated_lognorms.isfinite() | accumulated_lognorms.isneginf()).all():
                 print("nonfinite lognorm in contract_at! clamping")
                 accumulated_lognorms = self.clamp_c(accumulated_lognorms, -1e-20, None)
         # contract the final bond dimension
@@ -300,6 +449,280 @@ class TTrain(nn.Module):
         logprobs = probs.log()
         return logprobs
 
+    def _tree_contract(self, left, w_selected, right):
+        """Contract left . w_selected[:, 0] ... w_selected[:, seqlen-1] . right for
+        each element of the batch, multiplying the matrices pairwise in a balanced
+        tree: log2(seqlen) batched matrix products, each rescaled by its norm.
+        input:
+            left: tensor, size [batch_size, D]
+            w_selected: tensor, size [batch_size, seqlen, D, D]
+            right: tensor, size [batch_size, D]
+        returns:
+            output: tensor, size [batch_size], the contraction divided by exp(lognorms)
+            lognorms: tensor, size [batch_size]
+        """
+        mats = w_selected
+        lognorms = torch.zeros(
+            mats.shape[:2], dtype=mats.real.dtype, device=mats.device)
+        while mats.shape[1] > 1:
+            n_pairs = mats.shape[1] // 2
+            products = torch.matmul(mats[:, 0:2*n_pairs:2], mats[:, 1:2*n_pairs:2])
+            # infinity norm of each product
+            Zs = products.abs().sum(-1).amax(-1)
+            products = products / self._divisor(Zs)[:, :, None, None]
+            product_lognorms = (
+                lognorms[:, 0:2*n_pairs:2] + lognorms[:, 1:2*n_pairs:2] + Zs.log())
+            if mats.shape[1] % 2:
+                # the last matrix of an odd number is carried to the next level
+                products = torch.cat([products, mats[:, -1:]], 1)
+                product_lognorms = torch.cat([product_lognorms, lognorms[:, -1:]], 1)
+            mats, lognorms = products, product_lognorms
+        Z_left = left.abs().amax(1)
+        Z_right = right.abs().amax(1)
+        output = torch.einsum(
+            'bi, bij, bj -> b',
+            left / Z_left[:, None], mats[:, 0], right / Z_right[:, None])
+        return output, lognorms[:, 0] + Z_left.log() + Z_right.log()
+
+    def _prefix_trie(self, X):
+        """Build the prefix trie of a batch of observations.
+        input:
+            X: tensor batch of observations, size [batch_size, seq_len]
+        returns:
+            parents: list of seq_len tensors, parents[i][k] is the index of the
+                parent of the k-th node of depth i among the nodes of depth i-1
+                (0 for depth 0, whose parent is the root)
+            symbols: list of seq_len tensors, symbols[i][k] is the value
+                at position i of the k-th node of depth i
+            leaves: tensor size [batch_size], the node of depth seq_len-1 of each x
+        """
+        node = torch.zeros(X.shape[0], dtype=torch.long, device=X.device)
+        parents, symbols = [], []
+        for i in range(self.seqlen):
+            # a node of depth i is a distinct pair (node of depth i-1, x[i])
+            keys, node = torch.unique(node * self.d + X[:, i], return_inverse=True)
+            parents.append(keys // self.d)
+            symbols.append(keys % self.d)
+        return parents, symbols, node
+
+    def _log_contract_at_trie(self, X):
+        """Contract network at particular values in the physical dimension,
+        for computing probability of x, for x in X, over the prefix trie of X:
+        each distinct prefix is contracted once, so the work is proportional
+        to the number of trie nodes instead of batch_size*seq_len.
+        input:
+            X: tensor batch of observations, size [batch_size, seq_len]
+        returns:
+            logprobs: tensor of log probs, size [batch_size]
+        Uses log norm stability trick.
+        """
+        parents, symbols, leaves = self._prefix_trie(X)
+        Z = self.vec_norm(self.left_boundary)
+        contractor_unit = (self.left_boundary / Z)[None]
+        accumulated_lognorms = Z.log()[None]
+        # contract the network, from the left boundary through to the last core,
+        # one row per node of the trie
+        for i in range(self.seqlen):
+            if self.homogeneous:
+                w_selected = self.core[symbols[i]]
+            else:
+                w_selected = self.core[i, symbols[i]]
+            contractor_temp = torch.einsum(
+                'bi, bij -> bj',
+                contractor_unit[parents[i]],
+                w_selected)
+            Zs, _ = contractor_temp.abs().max(axis=1)
+            contractor_unit = contractor_temp / self._divisor(Zs)[:,None]
+            accumulated_lognorms = accumulated_lognorms[parents[i]] + Zs.log()
+            if not (accumulated_lognorms.isfinite() | accumulated_lognorms.isneginf()).all():
+                print("nonfinite lognorm in contract_at! clamping")
+                accumulated_lognorms = self.clamp_c(accumulated_lognorms, -1e-20, None)
+        # contract the final bond dimension, then read off each x at its leaf
+        output = torch.einsum(
+            'bi, i -> b', contractor_unit, self.right_boundary)
+        probs = (accumulated_lognorms.exp() * output).abs().square()
+        logprobs = probs.log()[leaves]
+        return logprobs
+
+    def sample(self, n, random_state=None):
+        """Draw exact samples from the model, by ancestral sampling.
+        The right environments are contracted once, then the value of each site
+        is drawn given the previous ones, for all samples at the same time.
+        Samples are grouped by prefix, as in the prefix trie: each distinct prefix
+        is contracted once and its samples are split among its children with
+        multinomial counts.
+        input:
+            n: number of samples
+            random_state: int seed or torch.Generator (optional)
+        returns:
+            X: tensor of samples, size [n, seqlen], in random order
+        """
+        if isinstance(random_state, int):
+            generator = torch.Generator(device=self.core.device).manual_seed(random_state)
+        else:
+            generator = random_state
+        with torch.no_grad():
+            right_environments = self._sample_right_environments()
+            left = self._sample_left_boundary()
+            counts = torch.tensor([n], device=self.core.device)
+            parents, symbols = [], []
+            for i in range(self.seqlen):
+                probs = self._conditional_probs(left, i, right_environments[i])
+                mass = probs.sum(1)
+                children = self._split_counts(counts, probs / mass[:, None], generator)
+                parent, symbol = children.nonzero(as_tuple=True)
+                parents.append(parent)
+                symbols.append(symbol)
+                counts = children[parent, symbol]
+                # rescale each prefix, the conditionals do not depend on it
+                left = self._absorb(left[parent], i, symbol)
+                left = left / mass[parent].reshape((-1,) + (1,)*(left.dim()-1))
+            # read off the prefixes from the last site back to the first
+            X = torch.zeros(len(counts), self.seqlen, dtype=torch.long, device=counts.device)
+            node = torch.arange(len(counts), device=counts.device)
+            for i in reversed(range(self.seqlen)):
+                X[:, i] = symbols[i][node]
+                node = parents[i][node]
+            X = X.repeat_interleave(counts, dim=0)
+            return X[torch.randperm(n, generator=generator, device=X.device)]
+
+    def _split_counts(self, counts, probs, generator=None):
+        """Multinomial split of the samples of each prefix among the values of the next site.
+        input:
+            counts: number of samples of each prefix, size [n_prefixes]
+            probs: conditional probabilities of the next site, size [n_prefixes, d_i]
+        returns:
+            children: number of samples of each prefix and value, size [n_prefixes, d_i]
+        """
+        d = probs.shape[1]
+        children = torch.zeros(len(counts), d, dtype=torch.long, device=counts.device)
+        # a single sample is one categorical draw
+        single = (counts == 1).nonzero(as_tuple=True)[0]
+        if len(single) > 0:
+            draws = torch.multinomial(probs[single], 1, generator=generator)[:, 0]
+            children[single, draws] = 1
+        # several samples are split by a sequence of binomial draws
+        several = (counts > 1).nonzero(as_tuple=True)[0]
+        remaining = counts[several].to(probs.dtype)
+        remaining_prob = torch.ones_like(remaining)
+        for j in range(d - 1):
+            ratio = (probs[several, j] / remaining_prob.clamp(min=1e-30)).clamp(0, 1)
+            draws = torch.binomial(remaining, ratio, generator=generator)
+            children[several, j] = draws.long()
+            remaining = remaining - draws
+            remaining_prob = remaining_prob - probs[several, j]
+        children[several, d - 1] = remaining.long()
+        return children
+
+    def _sample_right_environments(self):
+        """Right environments for sampling: the contraction of the cores after
+        site i with their conjugates and the right boundary, up to a factor.
+        returns:
+            list of seqlen tensors of size [D, D]
+        """
+        environments = [None] * self.seqlen
+        environment = torch.outer(self.right_boundary, self.right_boundary.conj())
+        for i in reversed(range(self.seqlen)):
+            environments[i] = environment
+            w = self._site_core(i)
+            environment = torch.einsum('iab, bc, idc -> ad', w, environment, w.conj())
+            environment = environment / self.mat_norm(environment)
+        return environments
+
+    def _sample_left_boundary(self):
+        """Left contraction before the first site, for sampling, size [1, D]"""
+        return self.left_boundary[None]
+
+    def _conditional_probs(self, left, i, right_environment):
+        """Unnormalized probabilities of the values of site i given the
+        contraction left of each prefix, size [n_prefixes, d]"""
+        w = self._site_core(i)
+        weights = torch.einsum('iab, bc, idc -> iad', w, right_environment, w.conj())
+        return torch.einsum('na, iad, nd -> ni', left, weights, left.conj()).real
+
+    def _absorb(self, left, i, x):
+        """Contraction of the left contraction of each prefix with the core of
+        site i at the values x, size [n_prefixes, D]"""
+        w = self._site_core(i)
+        return torch.einsum('na, nab -> nb', left, w[x])
+
+    def _evidence_mask(self, evidence):
+        """Allowed values of each site for a batch of evidence patterns.
+        input:
+            evidence: long tensor of observed values with -1 for the summed out sites,
+                size [n_queries, seqlen], or bool tensor of the allowed values,
+                size [n_queries, seqlen, d]
+        returns:
+            mask: bool tensor, size [n_queries, seqlen, d]
+        """
+        evidence = torch.as_tensor(evidence)
+        if evidence.dim() == 3:
+            return evidence.bool()
+        values = torch.arange(self.d, device=evidence.device)
+        return (evidence[:, :, None] == values) | (evidence[:, :, None] < 0)
+
+    def log_marginal(self, evidence):
+        """Log probability of partial evidence: the log of the sum of P(x) over
+        the configurations x allowed by each evidence pattern, with one
+        contraction per pattern. The normalization is contracted in the same
+        batch, as the pattern allowing every configuration.
+        input:
+            evidence: long tensor of observed values with -1 for the summed out sites,
+                size [n_queries, seqlen], or bool tensor of the allowed values,
+                size [n_queries, seqlen, d]
+        returns:
+            logprobs: tensor of log probs, size [n_queries]
+        """
+        mask = self._evidence_mask(evidence).to(self.core.device)
+        mask = torch.cat([mask, torch.ones_like(mask[:1])])
+        left = self._marginal_left_boundary(mask.shape[0])
+        accumulated_lognorms = torch.zeros(mask.shape[0], device=mask.device)
+        for i in range(self.seqlen):
+            contractor_temp = self._marginal_transfer(left, i, mask[:, i])
+            Zs = contractor_temp.abs().reshape(mask.shape[0], -1).max(1)[0].clamp(min=1e-30)
+            left = contractor_temp / Zs.reshape((-1,) + (1,)*(left.dim()-1))
+            accumulated_lognorms += Zs.log()
+        logprobs = accumulated_lognorms + self._marginal_close(left).log()
+        return logprobs[:-1] - logprobs[-1]
+
+    def log_conditional(self, query, evidence):
+        """Log conditional probability of the query patterns given the evidence
+        patterns, for instance of values of missing sites given the observed ones.
+        input:
+            query, evidence: long tensors with -1 for the free sites, size
+                [n_queries, seqlen], or bool tensors of the allowed values,
+                size [n_queries, seqlen, d]
+        returns:
+            logprobs: tensor of log probs, size [n_queries]
+        """
+        evidence = self._evidence_mask(evidence)
+        query = self._evidence_mask(query) & evidence
+        logprobs = self.log_marginal(torch.cat([query, evidence]))
+        return logprobs[:len(query)] - logprobs[len(query):]
+
+    def _marginal_left_boundary(self, n_queries):
+        """Left boundary of the network contracted with its conjugate,
+        size [n_queries, D, D]"""
+        boundary = torch.outer(self.left_boundary, self.left_boundary.conj())
+        return boundary[None].expand(n_queries, -1, -1)
+
+    def _marginal_transfer(self, left, i, mask):
+        """Contraction of the left contraction of each pattern with the core of site i
+        and its conjugate, summed over the allowed values of site i only.
+        input:
+            left: size [n_queries, D, D]
+            mask: bool tensor of allowed values of site i, size [n_queries, d]
+        """
+        w = self._site_core(i)
+        contractor = torch.einsum('qab, iac -> qibc', left, w)
+        return torch.einsum('qibc, ibd, qi -> qcd', contractor, w.conj(), mask[:, :len(w)].to(w.dtype))
+
+    def _marginal_close(self, left):
+        """Contraction of the left contraction of each pattern with the right boundary
+        and its conjugate, size [n_queries]"""
+        return torch.einsum(
+            'qab, a, b -> q', left, self.right_boundary, self.right_boundary.conj()).abs()
+
     def _logprob(self, x):
         """Compute log probability of one configuration P(x)
 
@@ -311,22 +734,66 @@ class TTrain(nn.Module):
         """
         pass
 
-    def _logprob_batch(self, X):
+    def _logprob_batch(self, X, weights=None):
         """Compute log P(x) for all x in a batch X
 
         Args:
             X : shape (batch_size, seqlen)
+            weights (optional) : shape (batch_size,), 
+                multiplicity of each x; if given, the log probs are multiplied by it
 
         Returns:
             logprobs (torch.Tensor): size [batchsize]
         """
         pass
 
+    def _log_normalization(self):
+        """Log of the norm of the network, contracted with its conjugate."""
+        return self._log_contract_all()
+
+    def _cached_log_normalization(self):
+        """_log_normalization, computed again only if a parameter changed since
+        the last call: replaced, moved, or modified in place (which increments
+        its version counter), or if grad mode changed. A value computed in grad
+        mode is dropped by the backward pass through it, which frees its graph.
+        """
+        parameters = list(self.parameters())
+        key = ([(id(p), p._version, p.data_ptr()) for p in parameters],
+               torch.is_grad_enabled())
+        if self._log_normalization_cache is not None:
+            # the cache holds the parameters, so their ids are not reused
+            _, cached_key, log_normalization = self._log_normalization_cache
+            if cached_key == key:
+                return log_normalization
+        log_normalization = self._log_normalization()
+        if log_normalization.requires_grad:
+            log_normalization.register_hook(lambda grad: self.invalidate())
+        self._log_normalization_cache = (parameters, key, log_normalization)
+        return log_normalization
+
+    def invalidate(self):
+        """Drop the cached log normalization. Needed only after modifying the
+        parameters without incrementing their version counters, through .data."""
+        self._log_normalization_cache = None
+
     def forward(self, x):
         return self._logprob(x)
 
-    def forward_batch(self, batch):
-        logprobs = self._logprob_batch(batch)
+    def _retract(self):
+        """Called after each optimizer step, to bring the parameters back
+        to a constrained form. Does nothing by default."""
+        pass
+
+    def _adapt_bonds(self):
+        """Called after each epoch of training, to adapt the bond dimensions.
+        Does nothing by default.
+        returns:
+            True if the shapes of the parameters changed
+        """
+        return False
+
+    def forward_batch(self, batch, weights=None):
+        logprobs = self._logprob_batch(batch, weights)
         return logprobs
 
     @staticmethod
@@ -353,19 +820,113 @@ class TTrain(nn.Module):
     def add_gradient_hook(self, clipping_threshold):
         for param_index, p in enumerate(self.parameters()):
             pnames = list(self.state_dict().keys())
-            p.register_hook(lambda grad: self.clip_grad(grad, clipping_threshold, pnames[param_index], verbose=self.verbose))
+            if p.requires_grad:
+                p.register_hook(lambda grad: self.clip_grad(grad, clipping_threshold, pnames[param_index], verbose=self.verbose))
             if torch.isnan(p).any():
                 print(f"{pnames[param_index]} contains a NaN value!")
 
+    def _register_hooks(self):
+        """Register the gradient hooks of new parameters, the clipping hooks
+        if gradient_clipping_threshold is set."""
+        if self.gradient_clipping_threshold:
+            self.add_gradient_hook(clipping_threshold=self.gradient_clipping_threshold)
+
+    def save(self, path):
+        """Save the model in the directory path, created if it does not exist:
+        each parameter in a .npy file, which load can open as a memory map, and
+        the class and the attributes in the JSON header header.json.
+        The dataset is not saved.
+        input:
+            path: directory
+        """
+        attributes = {}
+        for name, value in self.__dict__.items():
+            if name.startswith('_') or name in ('dataset', 'training'):
+                continue
+            if isinstance(value, torch.dtype):
+                value = str(value).replace('torch.', '')
+            elif name in ('site_dimensions', 'bond_dimensions'):
+                # given by the user, they may hold numpy or torch integers
+                value = [int(k) for k in value]
+            elif isinstance(value, np.generic):
+                value = value.item()
+            attributes[name] = value
+        parameters = {}
+        os.makedirs(path, exist_ok=True)
+        for name, p in self.named_parameters():
+            np.save(os.path.join(path, name + '.npy'), p.detach().cpu().numpy())
+            parameters[name] = p.requires_grad
+        header = {'format_version': _FORMAT_VERSION, 'class': self.__class__.__name__,
+                  'attributes': attributes, 'parameters': parameters}
+        with open(os.path.join(path, 'header.json'), 'w') as f:
+            json.dump(header, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='c'):
+        """Load a model saved by save, without a dataset (set model.dataset
+        before training it) and without initializing new parameters.
+        input:
+            path: directory written by save
+            mmap_mode: memory map mode of the parameters of a non-homogeneous model,
+                see numpy.load. With 'c', they are read lazily from their .npy files
+                and modified in memory only. The parameters of a homogeneous model
+                are read in memory.
+        returns:
+            model: instance of the saved class, which must be cls or a subclass of cls
+        """
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+        if header['format_version'] > _FORMAT_VERSION:
+            raise ValueError(f"model saved in format version {header['format_version']}, "
+                             f"this version reads up to {_FORMAT_VERSION}")
+        classes = [cls]
+        for model_class in classes:
+            classes.extend(model_class.__subclasses__())
+        classes = {model_class.__name__: model_class for model_class in classes}
+        if header['class'] not in classes:
+            raise ValueError(f"model of class {header['class']}, "
+                             f"which is not {cls.__name__} or one of its subclasses")
+        model = classes[header['class']].__new__(classes[header['class']])
+        nn.Module.__init__(model)
+        attributes = header['attributes']
+        attributes['dtype'] = getattr(torch, attributes['dtype'])
+        # attributes added since the first models were saved
+        attributes.setdefault('norm_method', 'sweep')
+        attributes.setdefault('tree_contraction', False)
+        model.__dict__.update(attributes)
+        model.dataset = None
+        model.invalidate()
+        if model.homogeneous:
+            mmap_mode = None
+        for name, requires_grad in header['parameters'].items():
+            w = torch.from_numpy(np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+            setattr(model, name, nn.Parameter(w, requires_grad=requires_grad))
+        model._register_hooks()
+        return model
+
     def train(
             self, batchsize, max_epochs, early_stopping_threshold=0,
             plot=False, tqdm=tqdm, device='cpu', batched=False,
-            verbose=False,
+            verbose=False, compress=False,
             optimizer=torch.optim.Adadelta, clamp_at=None, **optim_kwargs):
+        """Train the model on self.dataset.
+
+        If compress is True, repeated rows of the dataset are collapsed into
+        unique rows with counts. Batches are still drawn over the original rows,
+        but each distinct row of a batch is contracted once and weighted by its
+        number of occurrences in the batch.
+        """
         dataset = self.dataset
         model = self.to(device)
-        trainloader = DataLoader(dataset, batch_size=batchsize, shuffle=True)
-        optimizer = optimizer(model.parameters(), **optim_kwargs)
+        if compress:
+            unique_rows, inverse = torch.unique(
+                torch.as_tensor(dataset), dim=0, return_inverse=True)
+            # batches are drawn as indices into unique_rows, one per original row
+            trainloader = DataLoader(inverse, batch_size=batchsize, shuffle=True)
+        else:
+            trainloader = DataLoader(dataset, batch_size=batchsize, shuffle=True)
+        make_optimizer = optimizer
+        optimizer = make_optimizer(model.parameters(), **optim_kwargs)
         early_stopping_threshold = early_stopping_threshold  # 0 for no early stopping
         loss_values = [] # store by-epoch avg loss values
         print(f'╭───────────────────────────batched={batched}\n│Training {self.name}, on {device}')
@@ -387,8 +948,14 @@ class TTrain(nn.Module):
                                 plt.show()
                             return loss_values
                     model.zero_grad()
+                    batch_len = len(batch)
+                    if compress:
+                        rows, counts = torch.unique(batch, return_counts=True)
+                        batch, counts = unique_rows[rows], counts.to(device)
+                    else:
+                        counts = None
                     if batched:
-                        logprobs = model.forward_batch(batch.to(device))
+                        logprobs = model.forward_batch(batch.to(device), counts)
                         if verbose and (logprobs > 0).any():
                             print(f"├─── Epoch {epoch}, batch {batch_idx}: Warning! logprobs contains positive values (max={logprobs.max()})...")
                         neglogprob = -logprobs.sum(0)
@@ -398,8 +965,10 @@ class TTrain(nn.Module):
                             logprob = model(x.to(device))
                             if verbose and (logprob > 0):
                                 print(f"├─── Batch {batch_idx}[{x_idx}]: Warning! positive logprob...")
+                            if counts is not None:
+                                logprob = counts[x_idx] * logprob
                             neglogprob -= logprob
-                    loss = neglogprob / len(batch)
+                    loss = neglogprob / batch_len
                     if clamp_at:
                         loss = torch.clamp(loss, min=-clamp_at, max=clamp_at)
                     loss.backward()
@@ -413,8 +982,12 @@ class TTrain(nn.Module):
                     #             plt.show()
                     #         return loss_values
                     optimizer.step()
+                    model._retract()
                     # tepoch.set_postfix(loss=loss.item())
                     batch_loss_list.append(loss.item())
+                if model._adapt_bonds():
+                    # the state of the optimizer has the shapes of the old parameters
+                    optimizer = make_optimizer(model.parameters(), **optim_kwargs)
                 av_batch_loss = torch.Tensor(batch_loss_list).mean().item()
                 batch_loss_variance = torch.Tensor(batch_loss_list).var().item()
                 loss_values.append(av_batch_loss)
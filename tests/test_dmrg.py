@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""One sweep of fit_dmrg on a small dataset, with a small learning rate:
+it decreases the negative log-likelihood and keeps the bonds within D."""
+
+import numpy as np
+import pytest
+from tensornetworks.RealBorn import RealBorn
+from tensornetworks.ComplexBorn import ComplexBorn
+
+def training_data():
+    return np.random.RandomState(0).randint(0, 3, (40, 5))
+
+@pytest.mark.parametrize('cls', [RealBorn, ComplexBorn])
+@pytest.mark.parametrize('bond_tolerance', [None, 10**(-2)])
+def test_one_sweep(cls, bond_tolerance):
+    X = training_data()
+    #n_iter=0 only initializes the parameters, as the sweep does with the same random_state
+    initial = cls(D=3, n_iter=0, random_state=0).fit_dmrg(X)
+    model = cls(D=3, n_iter=1, learning_rate=0.01, random_state=0,
+                bond_tolerance=bond_tolerance).fit_dmrg(X)
+    assert model.likelihood(X) < initial.likelihood(X)
+    assert len(model.bond_dimensions) == 4
+    assert np.all(model.bond_dimensions >= 1) and np.all(model.bond_dimensions <= 3)
+    #The parameters beyond the bond dimensions are zero
+    w = model.w.reshape((5,)+model._tensorshape(3,3))
+    left, right = model._bonddimensions()
+    for i in range(5):
+        assert not np.any(w[i,:,left[i]:,:]) and not np.any(w[i,:,:,right[i]:])
+    assert np.isclose(model.norm, model._computenorm())
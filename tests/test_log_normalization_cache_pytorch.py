@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Cache of the log normalization of the torch models: reused while the
+parameters are unchanged, and computed again after they are modified."""
+
+import pytest
+import torch
+from tensornetworks_pytorch.TNModels import PosMPS, Born
+
+def training_data():
+    torch.manual_seed(0)
+    return torch.randint(0, 3, (20, 5))
+
+models = {
+    'PosMPS': lambda X, **kwargs: PosMPS(
+        X, 3, 4, w_randomization='noisy', **kwargs),
+    'rBorn': lambda X, **kwargs: Born(
+        X, 3, 4, dtype=torch.float, w_randomization='gaussian_zeros', **kwargs),
+    'cBorn': lambda X, **kwargs: Born(
+        X, 3, 4, dtype=torch.cfloat, w_randomization='gaussian_zeros', **kwargs),
+}
+
+@pytest.mark.parametrize('name', models)
+@pytest.mark.parametrize('homogeneous', [False, True])
+def test_in_place_update_recomputes(name, homogeneous):
+    model = models[name](training_data(), homogeneous=homogeneous)
+    with torch.no_grad():
+        before = model._cached_log_normalization()
+        assert model._cached_log_normalization() is before
+        # in place update of a parameter, which increments its version counter
+        model.core.mul_(2)
+        after = model._cached_log_normalization()
+    assert after is not before
+    assert not torch.isclose(after, before)
+    with torch.no_grad():
+        assert torch.isclose(after, model._log_normalization())
+
+@pytest.mark.parametrize('name', models)
+def test_update_through_data_needs_invalidate(name):
+    model = models[name](training_data(), homogeneous=False)
+    with torch.no_grad():
+        before = model._cached_log_normalization()
+        model.core.data.mul_(2)
+        # .data does not increment the version counter
+        assert model._cached_log_normalization() is before
+        model.invalidate()
+        assert torch.isclose(model._cached_log_normalization(), model._log_normalization())
+        assert not torch.isclose(model._cached_log_normalization(), before)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Marginal and conditional probabilities of partial evidence against their
+brute force sums over all the configurations of a small network."""
+
+import itertools
+import numpy as np
+import pytest
+from tensornetworks.PositiveMPS import PositiveMPS
+from tensornetworks.RealBorn import RealBorn
+from tensornetworks.ComplexBorn import ComplexBorn
+from tensornetworks.RealLPS import RealLPS
+from tensornetworks.ComplexLPS import ComplexLPS
+
+classes = [PositiveMPS, RealBorn, ComplexBorn, RealLPS, ComplexLPS]
+
+def training_data():
+    X = np.random.RandomState(0).randint(0, 2, (40, 4))
+    #Site 1 has 3 values, the others 2
+    X[:20, 1] = 2
+    return X
+
+#Observed values, -1 for the summed out sites
+evidence = np.array([[-1, -1, -1, -1],
+                     [ 1, -1, -1, -1],
+                     [-1,  2, -1,  0],
+                     [ 0, -1,  1, -1],
+                     [-1, -1, -1,  1],
+                     [ 1,  0,  1,  0]])
+#Queried values of the sites that are not observed
+query = np.array([[ 0,  1, -1, -1],
+                  [-1,  1,  0, -1],
+                  [ 1, -1, -1, -1],
+                  [-1,  2, -1,  0],
+                  [-1, -1,  0, -1],
+                  [-1, -1, -1, -1]])
+
+def brute_force(model, patterns):
+    """Sum of the normalized probabilities of the configurations matching each pattern"""
+    configurations = np.array(list(itertools.product(*[range(k) for k in model.site_dimensions])))
+    probability = model._probability_batch(configurations)/model._computenorm()
+    match = np.all((patterns[:,None,:] < 0) | (patterns[:,None,:] == configurations[None]), 2)
+    return np.dot(match, probability)
+
+@pytest.mark.parametrize('cls', classes)
+def test_marginal(cls):
+    model = cls(D=2, n_iter=2, random_state=0).fit(training_data())
+    assert np.allclose(model.marginal(evidence), brute_force(model, evidence))
+    #Same patterns as boolean arrays of the allowed values
+    mask = (evidence[:,:,None] < 0) | (evidence[:,:,None] == np.arange(model.d))
+    assert np.allclose(model.marginal(mask), brute_force(model, evidence))
+
+@pytest.mark.parametrize('cls', classes)
+def test_conditional(cls):
+    model = cls(D=2, n_iter=2, random_state=0).fit(training_data())
+    joint = np.where(query < 0, evidence, query)
+    assert np.allclose(model.conditional(query, evidence),
+                       brute_force(model, joint)/brute_force(model, evidence))
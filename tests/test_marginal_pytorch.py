@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Log marginal and log conditional probabilities of partial evidence of the
+torch models against their brute force sums over all the configurations of a
+small model."""
+
+import itertools
+import pytest
+import torch
+from tensornetworks_pytorch.TNModels import PosMPS, Born
+
+def training_data():
+    torch.manual_seed(0)
+    X = torch.randint(0, 2, (40, 4))
+    # site 1 has 3 values, the others 2
+    X[:20, 1] = 2
+    return X
+
+models = {
+    'PosMPS': lambda X: PosMPS(
+        X, 3, 2, homogeneous=False, w_randomization='noisy'),
+    'rBorn': lambda X: Born(
+        X, 3, 2, dtype=torch.float, homogeneous=False,
+        w_randomization='gaussian_zeros'),
+    'cBorn': lambda X: Born(
+        X, 3, 2, dtype=torch.cfloat, homogeneous=False,
+        w_randomization='gaussian_zeros'),
+}
+
+# observed values, -1 for the summed out sites
+evidence = torch.tensor([[-1, -1, -1, -1],
+                         [ 1, -1, -1, -1],
+                         [-1,  2, -1,  0],
+                         [ 0, -1,  1, -1],
+                         [-1, -1, -1,  1],
+                         [ 1,  0,  1,  0]])
+# queried values of the sites that are not observed
+query = torch.tensor([[ 0,  1, -1, -1],
+                      [-1,  1,  0, -1],
+                      [ 1, -1, -1, -1],
+                      [-1,  2, -1,  0],
+                      [-1, -1,  0, -1],
+                      [-1, -1, -1, -1]])
+
+def brute_force(model, patterns):
+    """Sum of the probabilities of the configurations matching each pattern"""
+    configurations = torch.tensor(list(itertools.product(
+        *[range(k) for k in model.site_dimensions])))
+    probs = model._logprob_batch(configurations).exp()
+    match = ((patterns[:, None, :] < 0)
+             | (patterns[:, None, :] == configurations[None])).all(2)
+    return match.to(probs.dtype) @ probs
+
+@pytest.mark.parametrize('name', models)
+def test_log_marginal(name):
+    model = models[name](training_data())
+    with torch.no_grad():
+        expected = brute_force(model, evidence)
+        assert torch.allclose(model.log_marginal(evidence).exp(), expected, atol=1e-6)
+        # same patterns as bool tensors of the allowed values
+        mask = (evidence[:, :, None] < 0) | (evidence[:, :, None] == torch.arange(model.d))
+        assert torch.allclose(model.log_marginal(mask).exp(), expected, atol=1e-6)
+
+@pytest.mark.parametrize('name', models)
+def test_log_conditional(name):
+    model = models[name](training_data())
+    joint = torch.where(query < 0, evidence, query)
+    with torch.no_grad():
+        expected = brute_force(model, joint) / brute_force(model, evidence)
+        assert torch.allclose(model.log_conditional(query, evidence).exp(), expected,
+                              rtol=1e-4, atol=1e-6)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Exact sampling: the empirical frequencies of the samples of a small network
+against its normalized probabilities, for all the configurations."""
+
+import itertools
+import numpy as np
+import pytest
+from tensornetworks.PositiveMPS import PositiveMPS
+from tensornetworks.RealBorn import RealBorn
+from tensornetworks.ComplexBorn import ComplexBorn
+from tensornetworks.RealLPS import RealLPS
+from tensornetworks.ComplexLPS import ComplexLPS
+
+classes = [PositiveMPS, RealBorn, ComplexBorn, RealLPS, ComplexLPS]
+
+def training_data():
+    X = np.random.RandomState(0).randint(0, 2, (40, 4))
+    #Site 1 has 3 values, the others 2
+    X[:20, 1] = 2
+    return X
+
+@pytest.mark.parametrize('cls', classes)
+def test_sample_frequencies(cls):
+    model = cls(D=2, n_iter=2, random_state=0).fit(training_data())
+    configurations = np.array(list(itertools.product(*[range(k) for k in model.site_dimensions])))
+    probability = model._probability_batch(configurations)/model._computenorm()
+    assert np.isclose(np.sum(probability), 1)
+    n_samples = 20000
+    X = model.sample(n_samples, random_state=0)
+    assert X.shape == (n_samples, 4)
+    assert np.all(X < model.site_dimensions)
+    counts = np.all(X[:,None,:] == configurations[None],2).sum(0)
+    assert counts.sum() == n_samples
+    #Within 5 standard deviations of the multinomial counts
+    deviation = np.sqrt(n_samples*probability*(1-probability))
+    assert np.all(np.abs(counts-n_samples*probability) <= 5*deviation+1)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Exact sampling of the torch models: the empirical frequencies of the samples
+of a small model against its normalized probabilities, for all the
+configurations."""
+
+import itertools
+import pytest
+import torch
+from tensornetworks_pytorch.TNModels import PosMPS, Born
+
+def training_data():
+    torch.manual_seed(0)
+    X = torch.randint(0, 2, (40, 4))
+    # site 1 has 3 values, the others 2
+    X[:20, 1] = 2
+    return X
+
+models = {
+    'PosMPS': lambda X: PosMPS(
+        X, 3, 2, homogeneous=False, w_randomization='noisy'),
+    'rBorn': lambda X: Born(
+        X, 3, 2, dtype=torch.float, homogeneous=False,
+        w_randomization='gaussian_zeros'),
+    'cBorn': lambda X: Born(
+        X, 3, 2, dtype=torch.cfloat, homogeneous=False,
+        w_randomization='gaussian_zeros'),
+}
+
+@pytest.mark.parametrize('name', models)
+def test_sample_frequencies(name):
+    X = training_data()
+    model = models[name](X)
+    configurations = torch.tensor(list(itertools.product(
+        *[range(k) for k in model.site_dimensions])))
+    with torch.no_grad():
+        probs = model._logprob_batch(configurations).exp().double()
+    assert torch.isclose(probs.sum(), torch.tensor(1., dtype=torch.double), atol=1e-4)
+    n = 20000
+    samples = model.sample(n, random_state=0)
+    assert samples.shape == (n, 4)
+    assert (samples < torch.tensor(model.site_dimensions)).all()
+    counts = (samples[:, None, :] == configurations[None]).all(2).sum(0)
+    assert counts.sum() == n
+    # within 5 standard deviations of the multinomial counts
+    deviation = (n * probs * (1 - probs)).sqrt()
+    assert ((counts - n * probs).abs() <= 5 * deviation + 1).all()
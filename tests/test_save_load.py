@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""Round trip of save and load: the loaded network has the same probabilities,
+and can be trained further without modifying the saved parameters."""
+
+import os
+import numpy as np
+import pytest
+from tensornetworks.PositiveMPS import PositiveMPS
+from tensornetworks.RealBorn import RealBorn
+from tensornetworks.ComplexBorn import ComplexBorn
+from tensornetworks.RealLPS import RealLPS
+from tensornetworks.ComplexLPS import ComplexLPS
+
+classes = [PositiveMPS, RealBorn, ComplexBorn, RealLPS, ComplexLPS]
+
+def training_data():
+    X = np.random.RandomState(0).randint(0, 3, (60, 5))
+    X[:, 2] = X[:, 2] % 2
+    return X
+
+@pytest.mark.parametrize('cls', classes)
+@pytest.mark.parametrize('homogeneous', [False, True])
+def test_save_load(cls, homogeneous, tmp_path):
+    X = training_data()
+    model = cls(D=3, n_iter=2, random_state=0, homogeneous=homogeneous)
+    model.fit(X, site_dimensions=np.full(5, 3, dtype=np.int32))
+    path = str(tmp_path)
+    model.save(path)
+    loaded = cls.load(path)
+    assert type(loaded) is cls
+    assert list(loaded.site_dimensions) == list(model.site_dimensions)
+    assert np.array_equal(loaded.w, model.w)
+    assert np.array_equal(loaded._probability_batch(X)/loaded.norm,
+                          model._probability_batch(X)/model.norm)
+    assert loaded.likelihood(X) == model.likelihood(X)
+    #One step of training changes the parameters in memory only
+    loaded._fit(X[:10])
+    assert not np.array_equal(loaded.w, model.w)
+    assert np.array_equal(np.load(os.path.join(path, 'w.npy')), model.w)
+    loaded.n_iter = 1
+    loaded.fit(X, w_init=loaded.w)
+    assert np.isfinite(loaded.likelihood(X))
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Round trip of save and load of the torch models: the loaded model has the
+same log probabilities, and can be trained further without modifying the
+saved parameters."""
+
+import os
+import numpy as np
+import pytest
+import torch
+from tensornetworks_pytorch.TNModels import PosMPS, Born
+
+def training_data():
+    torch.manual_seed(0)
+    X = torch.randint(0, 3, (60, 5))
+    X[:, 2] = X[:, 2] % 2
+    return X
+
+models = {
+    'PosMPS': lambda X, **kwargs: PosMPS(
+        X, 3, 4, w_randomization='noisy', **kwargs),
+    'rBorn': lambda X, **kwargs: Born(
+        X, 3, 4, dtype=torch.float, w_randomization='gaussian_zeros', **kwargs),
+    'cBorn': lambda X, **kwargs: Born(
+        X, 3, 4, dtype=torch.cfloat, w_randomization='gaussian_zeros', **kwargs),
+}
+
+@pytest.mark.parametrize('name', models)
+@pytest.mark.parametrize('homogeneous', [False, True])
+def test_save_load(name, homogeneous, tmp_path):
+    X = training_data()
+    # numpy integers, which the JSON header cannot hold as they are
+    model = models[name](X, homogeneous=homogeneous,
+                         site_dimensions=np.full(5, 3, dtype=np.int64))
+    path = str(tmp_path)
+    model.save(path)
+    loaded = type(model).load(path)
+    assert loaded.site_dimensions == [int(k) for k in model.site_dimensions]
+    with torch.no_grad():
+        assert torch.equal(loaded._logprob_batch(X), model._logprob_batch(X))
+    saved = {name: np.load(os.path.join(path, name + '.npy'))
+             for name, _ in model.named_parameters()}
+    # one epoch of training changes the parameters in memory only
+    loaded.dataset = X
+    loaded.train(batchsize=20, max_epochs=1, batched=True, lr=1.)
+    assert any(not torch.equal(p, q) for p, q in zip(loaded.parameters(), model.parameters()))
+    for name, w in saved.items():
+        assert np.array_equal(np.load(os.path.join(path, name + '.npy')), w)
+    with torch.no_grad():
+        assert loaded._logprob_batch(X).isfinite().all()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Scoring of held-out configurations with values that do not appear in the
+training data, for the per-site physical dimensions."""
+
+import numpy as np
+import pytest
+from tensornetworks.PositiveMPS import PositiveMPS
+from tensornetworks.RealBorn import RealBorn
+from tensornetworks.ComplexBorn import ComplexBorn
+from tensornetworks.RealLPS import RealLPS
+from tensornetworks.ComplexLPS import ComplexLPS
+
+classes = [PositiveMPS, RealBorn, ComplexBorn, RealLPS, ComplexLPS]
+
+def training_data():
+    X = np.random.RandomState(0).randint(0, 3, (60, 5))
+    #Column 2 only takes the values 0 and 1 in the training data
+    X[:, 2] = X[:, 2] % 2
+    return X
+
+def held_out_data():
+    X = np.random.RandomState(1).randint(0, 3, (20, 5))
+    X[:10, 2] = 2
+    X[10:, 2] = X[10:, 2] % 2
+    return X
+
+@pytest.mark.parametrize('cls', classes)
+@pytest.mark.parametrize('prefix_trie', [False, True])
+def test_unseen_value_has_probability_zero(cls, prefix_trie):
+    X = training_data()
+    Y = held_out_data()
+    model = cls(D=3, n_iter=2, random_state=0, prefix_trie=prefix_trie).fit(X)
+    probability = model._probability_batch(Y)
+    assert np.all(probability[:10] == 0)
+    assert np.all(probability[10:] > 0)
+    assert model._probability(Y[0]) == 0
+    assert np.isclose(model._probability(Y[10]), probability[10])
+    #The unseen configurations are scored at the floor 10**(-50) of likelihood
+    assert np.isclose(model.likelihood(Y),
+                      (-10*np.log(10**(-50))+10*model.likelihood(Y[10:]))/20)
+
+@pytest.mark.parametrize('cls', classes)
+def test_explicit_site_dimensions(cls):
+    X = training_data()
+    Y = held_out_data()
+    model = cls(D=3, n_iter=2, random_state=0).fit(X, site_dimensions=[3]*5)
+    assert list(model.site_dimensions) == [3]*5
+    probability = model._probability_batch(Y)/model.norm
+    assert np.all(probability > 0)
+    assert model.likelihood(Y) < -np.log(10**(-50))
+
+def test_site_dimensions_smaller_than_data():
+    with pytest.raises(ValueError):
+        RealBorn(D=3, n_iter=1).fit(training_data(), site_dimensions=[3, 3, 1, 3, 3])
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Scoring of held-out configurations with values that do not appear in the
+training data, for the per-site physical dimensions of the torch models."""
+
+import pytest
+import torch
+from tensornetworks_pytorch.TNModels import PosMPS, Born
+
+def training_data():
+    torch.manual_seed(0)
+    X = torch.randint(0, 3, (60, 5))
+    # column 2 only takes the values 0 and 1 in the training data
+    X[:, 2] = X[:, 2] % 2
+    return X
+
+def held_out_data():
+    torch.manual_seed(1)
+    X = torch.randint(0, 3, (20, 5))
+    X[:10, 2] = 2
+    X[10:, 2] = X[10:, 2] % 2
+    return X
+
+models = {
+    'PosMPS': lambda X, **kwargs: PosMPS(
+        X, 3, 4, homogeneous=False, w_randomization='noisy', **kwargs),
+    'rBorn': lambda X, **kwargs: Born(
+        X, 3, 4, dtype=torch.float, homogeneous=False,
+        w_randomization='gaussian_zeros', **kwargs),
+    'cBorn': lambda X, **kwargs: Born(
+        X, 3, 4, dtype=torch.cfloat, homogeneous=False,
+        w_randomization='gaussian_zeros', **kwargs),
+}
+
+@pytest.mark.parametrize('name', models)
+@pytest.mark.parametrize('options', [{}, {'prefix_trie': True}, {'tree_contraction': True}])
+def test_unseen_value_has_log_probability_minus_inf(name, options, capsys):
+    X = training_data()
+    Y = held_out_data()
+    torch.manual_seed(0)
+    model = models[name](X, **options)
+    assert model.site_dimensions[2] == 2
+    with torch.no_grad():
+        logprobs = model._logprob_batch(Y)
+        assert (logprobs[:10] == -float('inf')).all()
+        assert logprobs[10:].isfinite().all()
+        assert model._logprob(Y[0]) == -float('inf')
+        assert torch.isclose(model._logprob(Y[10]), logprobs[10])
+    assert 'nonfinite' not in capsys.readouterr().out
+
+@pytest.mark.parametrize('name', models)
+def test_explicit_site_dimensions(name):
+    X = training_data()
+    Y = held_out_data()
+    torch.manual_seed(0)
+    model = models[name](X, site_dimensions=[3]*5)
+    with torch.no_grad():
+        assert model._logprob_batch(Y).isfinite().all()